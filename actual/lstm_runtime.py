@@ -0,0 +1,306 @@
+"""NumPy inference for the Keras LSTM disease model, without importing TensorFlow.
+
+model/LSTM_timeSeries.py saves a Sequential model (LSTM -> Dropout -> Dense
+-> Dense softmax) as .h5 and, next to it, the StandardScaler and
+LabelEncoder it was trained with as ``<model>.preprocessing.pkl``.
+``LSTMRuntime`` reads the layer configs and weights with h5py and runs
+batched forward passes in NumPy: the input projection for every timestep
+is one matmul, then one small matmul per timestep for the recurrence.
+
+    python lstm_runtime.py                                  # check against Keras + time the model in model/
+    python lstm_runtime.py --record-keras-reference         # save Keras outputs to check against (needs TensorFlow)
+    python lstm_runtime.py --fit-preprocessing data.csv     # rebuild the scaler/encoder file from the training CSV
+
+The preprocessing must be fitted on the CSV the model was trained on:
+data/data_generator.py regenerates it (seeded) for the shipped model.
+"""
+import json
+import os
+
+import h5py
+import joblib
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# ---------------------- CONFIG ----------------------
+LSTM_MODEL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model", "potato_disease_lstm_model.h5")
+KERAS_REFERENCE_PATH = os.path.join(os.path.dirname(LSTM_MODEL_PATH), "potato_disease_lstm_model.keras_reference.npz")
+TIMESTEPS = 5
+# fit_preprocessing refuses a CSV unless the model then predicts at least this share of its labels
+MIN_TRAINING_AGREEMENT = 0.9
+# -----------------------------------------------------
+
+
+def preprocessing_path(model_path):
+    return f"{os.path.splitext(model_path)[0]}.preprocessing.pkl"
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _hard_sigmoid(x):
+    return np.clip(x / 6.0 + 0.5, 0.0, 1.0)
+
+
+def _softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "sigmoid": _sigmoid,
+    "hard_sigmoid": _hard_sigmoid,
+    "tanh": np.tanh,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "linear": lambda x: x,
+    "softmax": _softmax,
+}
+
+
+def _activation(name):
+    try:
+        return ACTIVATIONS[name]
+    except KeyError:
+        raise ValueError(f"Unsupported activation '{name}'") from None
+
+
+def _layer_weights(group):
+    """{kernel, recurrent_kernel, bias} datasets anywhere under a layer's weight group."""
+    weights = {}
+    group.visititems(lambda name, obj: weights.__setitem__(name.rsplit("/", 1)[-1], np.asarray(obj, np.float32))
+                     if isinstance(obj, h5py.Dataset) else None)
+    return weights
+
+
+class LSTMRuntime:
+    """A Keras Sequential LSTM classifier as NumPy arrays, plus its preprocessing.
+
+    ``layers`` is a list of ("lstm", kernel, recurrent_kernel, bias,
+    activation, recurrent_activation) and ("dense", kernel, bias,
+    activation) tuples. Keras packs the four LSTM gates as input, forget,
+    cell, output along the last axis of each kernel. Dropout is a no-op at
+    inference and is skipped.
+    """
+
+    def __init__(self, layers, timesteps, n_features, scaler=None, label_encoder=None, feature_cols=None):
+        self.layers = layers
+        self.timesteps = timesteps
+        self.n_features = n_features
+        self.scaler = scaler
+        self.label_encoder = label_encoder
+        self.feature_cols = list(feature_cols) if feature_cols is not None else None
+        self.classes_ = np.asarray(label_encoder.classes_) if label_encoder is not None else None
+
+    @classmethod
+    def load(cls, path, preprocessing=None):
+        """Read an .h5 saved by Keras; ``preprocessing`` defaults to the file saved beside it (if any)."""
+        layers = []
+        with h5py.File(path, "r") as f:
+            config = json.loads(f.attrs["model_config"])
+            if config["class_name"] != "Sequential":
+                raise ValueError(f"Only Sequential models are supported, got {config['class_name']}")
+            timesteps = n_features = None
+            for layer in config["config"]["layers"]:
+                kind, cfg = layer["class_name"], layer["config"]
+                if kind == "InputLayer":
+                    _, timesteps, n_features = cfg.get("batch_shape") or cfg["batch_input_shape"]
+                elif kind == "LSTM":
+                    if cfg.get("return_sequences") or cfg.get("go_backwards") or cfg.get("stateful"):
+                        raise ValueError("Only a final-state, forward, stateless LSTM is supported")
+                    w = _layer_weights(f["model_weights"][cfg["name"]])
+                    layers.append(("lstm", w["kernel"], w["recurrent_kernel"], w["bias"],
+                                   _activation(cfg["activation"]), _activation(cfg["recurrent_activation"])))
+                elif kind == "Dense":
+                    w = _layer_weights(f["model_weights"][cfg["name"]])
+                    bias = w.get("bias", np.zeros(w["kernel"].shape[1], np.float32))
+                    layers.append(("dense", w["kernel"], bias, _activation(cfg["activation"])))
+                elif kind != "Dropout":
+                    raise ValueError(f"Unsupported layer '{kind}'")
+        if timesteps is None:
+            timesteps, n_features = config["config"]["build_input_shape"][1:]
+        runtime = cls(layers, timesteps, n_features)
+        preprocessing = preprocessing or preprocessing_path(path)
+        if os.path.exists(preprocessing):
+            runtime = runtime.with_preprocessing(joblib.load(preprocessing))
+        return runtime
+
+    def with_preprocessing(self, saved):
+        """The same network with the {scaler, label_encoder, feature_cols} saved at training time."""
+        return type(self)(self.layers, self.timesteps, self.n_features, saved.get("scaler"),
+                          saved.get("label_encoder"), saved.get("feature_cols"))
+
+    # ---------------------- INFERENCE ----------------------
+    def scale(self, X):
+        """Raw feature values -> the scaled inputs the network was trained on."""
+        X = np.asarray(X, dtype=np.float32)
+        if self.scaler is None:
+            return X
+        mean = np.asarray(self.scaler.mean_, np.float32)
+        scale = np.asarray(self.scaler.scale_, np.float32)
+        return (X - mean) / scale
+
+    def forward(self, X):
+        """Network output for already-scaled sequences of shape (n, timesteps, n_features)."""
+        out = np.asarray(X, dtype=np.float32)
+        if out.ndim == 2:
+            out = out[None]
+        for layer in self.layers:
+            if layer[0] == "lstm":
+                _, kernel, recurrent, bias, activation, recurrent_activation = layer
+                units = recurrent.shape[0]
+                projected = out @ kernel + bias                       # (n, T, 4 * units), all steps at once
+                h = np.zeros((out.shape[0], units), np.float32)
+                c = np.zeros_like(h)
+                for t in range(out.shape[1]):
+                    z = projected[:, t] + h @ recurrent
+                    i = recurrent_activation(z[:, :units])
+                    f = recurrent_activation(z[:, units:2 * units])
+                    g = activation(z[:, 2 * units:3 * units])
+                    o = recurrent_activation(z[:, 3 * units:])
+                    c = f * c + i * g
+                    h = o * activation(c)
+                out = h
+            else:
+                _, kernel, bias, activation = layer
+                out = activation(out @ kernel + bias)
+        return out
+
+    def predict_proba(self, X):
+        """Class probabilities for raw (unscaled) sequences."""
+        return self.forward(self.scale(X))
+
+    def predict(self, X):
+        """Most likely label per sequence (class index without a label encoder)."""
+        best = self.predict_proba(X).argmax(axis=1)
+        return self.classes_[best] if self.classes_ is not None else best
+
+    def frame_features(self, frame):
+        """The model's feature columns from a frame, matching "Temperature" to "Temperature (°C)"."""
+        if self.feature_cols is None:
+            raise ValueError("No preprocessing saved with the model; feature columns unknown")
+        columns = []
+        for name in self.feature_cols:
+            if name not in frame:
+                name = name.split(" (")[0]
+            if name not in frame:
+                raise ValueError(f"Missing feature '{name}'")
+            columns.append(np.asarray(frame[name], dtype=np.float32))
+        return np.column_stack(columns)
+
+
+def load_lstm(path, version=None):
+    """Registry loader: ``registry.register("lstm", path, loader=load_lstm)``."""
+    return LSTMRuntime.load(path)
+
+
+def fit_preprocessing(csv_path, model_path=LSTM_MODEL_PATH, target="Disease"):
+    """Refit the scaler and label encoder the way LSTM_timeSeries.py does and save them beside the model.
+
+    Only the model's own training CSV reproduces its scaling; another CSV
+    with the same columns gives different means and silently skews every
+    prediction. So the CSV is refused unless, scaled this way, the model
+    predicts at least MIN_TRAINING_AGREEMENT of its own labels (the shipped
+    model gets 99% on its training CSV and under 50% on the other CSV in data/).
+    """
+    import pandas as pd
+    from sklearn.preprocessing import LabelEncoder, StandardScaler
+
+    df = pd.read_csv(csv_path)
+    le = LabelEncoder().fit(df[target])
+    feature_cols = df.select_dtypes(include=["number"]).columns.tolist()
+    network = LSTMRuntime.load(model_path)
+    if len(feature_cols) != network.n_features or len(le.classes_) != network.layers[-1][1].shape[1]:
+        raise ValueError(f"{csv_path} has {len(feature_cols)} features and {len(le.classes_)} classes; the model "
+                         f"takes {network.n_features} and predicts {network.layers[-1][1].shape[1]}")
+    scaler = StandardScaler().fit(df[feature_cols])
+    fitted = network.with_preprocessing({"scaler": scaler, "label_encoder": le, "feature_cols": feature_cols})
+    features = fitted.scale(df[feature_cols].to_numpy())
+    windows = sliding_window_view(features, network.timesteps, axis=0)[:-1].transpose(0, 2, 1)
+    agreement = float(np.mean(fitted.forward(windows).argmax(axis=1) == le.transform(df[target])[network.timesteps:]))
+    if agreement < MIN_TRAINING_AGREEMENT:
+        raise ValueError(f"The model predicts only {agreement:.0%} of the labels in {csv_path} with this scaling; "
+                         "it does not look like the CSV the model was trained on")
+    joblib.dump({"scaler": scaler, "label_encoder": le, "feature_cols": feature_cols, "timesteps": TIMESTEPS},
+                preprocessing_path(model_path))
+    return preprocessing_path(model_path)
+
+
+def record_keras_reference(path=LSTM_MODEL_PATH, out=KERAS_REFERENCE_PATH, n=64):
+    """Save Keras ``model.predict`` outputs for fixed inputs; the benchmark checks the NumPy runtime against them."""
+    from tensorflow import keras
+
+    model = keras.models.load_model(path, compile=False)
+    _, timesteps, n_features = model.input_shape
+    # Scaled inputs, spread wide enough to reach the saturated ends of the gates
+    inputs = np.random.default_rng(0).normal(scale=2.0, size=(n, timesteps, n_features)).astype(np.float32)
+    np.savez_compressed(out, inputs=inputs, outputs=model.predict(inputs, verbose=0))
+    return out
+
+
+# ---------------------- BENCHMARK ----------------------
+def _reference(runtime, X):
+    # Unbatched float64 forward pass written straight from the Keras LSTM equations
+    out = []
+    (_, W, U, b, _, _), dense = runtime.layers[0], runtime.layers[1:]
+    units = U.shape[0]
+    for seq in np.asarray(X, np.float64):
+        h, c = np.zeros(units), np.zeros(units)
+        for x in seq:
+            z = x @ W + h @ U + b
+            i, f, g, o = (z[k * units:(k + 1) * units] for k in range(4))
+            c = _sigmoid(f) * c + _sigmoid(i) * np.tanh(g)
+            h = _sigmoid(o) * np.tanh(c)
+        y = h
+        for _, kernel, bias, activation in dense:
+            y = activation((y @ kernel + bias)[None])[0]
+        out.append(y)
+    return np.array(out)
+
+
+def _benchmark(path=LSTM_MODEL_PATH, n=10000):
+    import sys
+    import time
+
+    start = time.perf_counter()
+    runtime = LSTMRuntime.load(path)
+    load = time.perf_counter() - start
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(n, runtime.timesteps, runtime.n_features)).astype(np.float32)
+    diff = np.abs(runtime.forward(X[:500]) - _reference(runtime, X[:500])).max()
+    if os.path.exists(KERAS_REFERENCE_PATH):
+        keras = np.load(KERAS_REFERENCE_PATH)
+        keras_diff = np.abs(runtime.forward(keras["inputs"]) - keras["outputs"]).max()
+        assert keras_diff < 1e-5, f"NumPy runtime differs from Keras by {keras_diff:.1e}"
+        print(f"matches Keras model.predict on {len(keras['inputs'])} saved inputs: max |diff| {keras_diff:.1e}")
+    else:
+        print(f"no {os.path.basename(KERAS_REFERENCE_PATH)}: not checked against Keras "
+              "(python lstm_runtime.py --record-keras-reference)")
+    start = time.perf_counter()
+    proba = runtime.forward(X)
+    batch = time.perf_counter() - start
+    one = min(_time(lambda: runtime.forward(X[:1])) for _ in range(50))
+    print(f"loaded in {load * 1e3:.1f} ms, tensorflow imported: {'tensorflow' in sys.modules}, "
+          f"max |diff| vs float64 reference {diff:.1e}, rows sum to 1 within {np.abs(proba.sum(1) - 1).max():.1e}")
+    print(f"{n} sequences in {batch * 1e3:.1f} ms ({n / batch:,.0f}/s); 1 sequence {one * 1e6:.0f} us")
+    if runtime.scaler is None:
+        print(f"no {os.path.basename(preprocessing_path(path))}: outputs are for pre-scaled inputs only")
+
+
+def _time(fn):
+    import time
+
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) == 3 and sys.argv[1] == "--fit-preprocessing":
+        print("saved", fit_preprocessing(sys.argv[2]))
+    elif len(sys.argv) == 2 and sys.argv[1] == "--record-keras-reference":
+        print("saved", record_keras_reference())
+    else:
+        _benchmark()
@@ -2,16 +2,41 @@ from fastapi import FastAPI, Request, HTTPException
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import pandas as pd
-import joblib
-import requests
-from datetime import datetime
 from pydantic import BaseModel
 from typing import List, Dict
+import asyncio
 import json
+import math
 import os
+import sys
+import time
 
-app = FastAPI(title="Smart Agriculture API")
+# Add the repository root to sys.path to share the standalone helpers there (not the root app's utils.py)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from met_client import MET_CACHE_TTL, MetAPIError, close_async_client, get_parsed_met_forecast_async, met_flight, met_stats
+from prefetch import PrefetchScheduler
+from resilience import CircuitOpenError, SingleFlight, TTLCache
+from history_store import get_history_store, location_id
+from model_registry import registry
+from risk_engine import risk_records, score_fields
+from lstm_runtime import load_lstm, preprocessing_path
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if PREFETCH_ENABLED:
+        prefetcher.start()
+    yield
+    await prefetcher.stop()
+    await close_async_client()
+
+
+app = FastAPI(title="Smart Agriculture API", lifespan=lifespan)
 
 # Mount static files and templates
 app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -21,116 +46,116 @@ templates = Jinja2Templates(directory="templates")
 MODEL_PATH = "model/risk_predictor_model.pkl"
 DISEASE_ENCODER_PATH = "model/disease_label_encoder.pkl"
 RISK_ENCODER_PATH = "model/risk_label_encoder.pkl"
+LSTM_MODEL_PATH = "model/potato_disease_lstm_model.h5"
 FIELDS_FILE = "data/fields.json"
+# MET refreshes locationforecast roughly hourly; warm every field once per update
+PREFETCH_INTERVAL = float(os.environ.get("PREFETCH_INTERVAL", 3600))
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "1") == "1"
+# Append every forecast pulled and prediction made to history_store
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "1") == "1"
+# Add each day's min/max temperature, rain total, humid hours and mean leaf wetness to the risk records
+DAILY_AGGREGATES = os.environ.get("DAILY_AGGREGATES", "0") == "1"
+
+# Concurrent requests for the same field share one MET fetch + prediction
+forecast_flight = SingleFlight()
+# Latest risk predictions per location, kept warm by the prefetch scheduler (when enabled).
+# Each entry expires with the MET forecast it was scored from; see cache_risk
+risk_cache = TTLCache(maxsize=4096, ttl=MET_CACHE_TTL)
 
-# Load models
-model = joblib.load(MODEL_PATH)
-le_disease = joblib.load(DISEASE_ENCODER_PATH)
-le_risk = joblib.load(RISK_ENCODER_PATH)
+# Models load on first use and hot-reload when the files change
+registry.register("risk", MODEL_PATH)
+registry.register("disease_encoder", DISEASE_ENCODER_PATH)
+registry.register("risk_encoder", RISK_ENCODER_PATH)
+# NumPy runtime for the Keras LSTM: no TensorFlow in this process
+registry.register("lstm", LSTM_MODEL_PATH, loader=load_lstm)
+registry.register("lstm_preprocessing", preprocessing_path(LSTM_MODEL_PATH))
 
 class Field(BaseModel):
     name: str
     lat: float
     lon: float
 
-def estimate_leaf_wetness(humidity: float, rainfall: float) -> float:
-    if humidity > 90 and rainfall > 0:
-        return 13 + (humidity - 90) * 0.1 + rainfall * 0.5
-    elif humidity > 90:
-        return 11 + (humidity - 90) * 0.2
-    elif rainfall > 0:
-        return 10 + rainfall * 0.5
-    else:
-        return 8
-
-def get_met_weather_forecast(lat: float, lon: float):
-    url = f"https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat}&lon={lon}"
-    headers = {
-        "User-Agent": "smart-agri-dashboard/1.0 contact@example.com"
-    }
-
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise HTTPException(status_code=response.status_code, detail=f"MET API Error: {response.text}")
+async def get_met_weather_forecast(lat: float, lon: float, refresh: bool = False):
+    # (forecast, seconds it stays fresh); parsed once per MET payload, in the threadpool, and shared
+    try:
+        return await get_parsed_met_forecast_async(lat, lon, refresh=refresh, daily=DAILY_AGGREGATES)
+    except MetAPIError as e:
+        retry_after = e.headers.get("Retry-After") if e.headers is not None else None
+        raise HTTPException(status_code=e.status_code, detail=f"MET API Error: {e.text}",
+                            headers={"Retry-After": retry_after} if retry_after else None)
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e),
+                            headers={"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None)
 
-    data = response.json()
-    timeseries = data['properties']['timeseries']
-    forecast_list = []
-    seen_dates = set()
+def cache_risk(lat: float, lon: float, risk_predictions: List[Dict], fresh_for: float):
+    # Risk is only as fresh as its forecast: cache it until MET's Expires, and not at all if the forecast was stale
+    if fresh_for > 0:
+        risk_cache.set((lat, lon), risk_predictions, ttl=fresh_for)
 
-    for entry in timeseries:
-        timestamp = entry['time']
-        dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+def predict_risk_for_all_diseases(forecast_data: List[Dict]):
+    return risk_records(score_fields({None: forecast_data})).get(None, [])
 
-        if dt.hour == 12 and dt.date() not in seen_dates:
-            details = entry['data']['instant']['details']
-            rain = entry['data'].get('next_6_hours', {}).get('details', {}).get('precipitation_amount', 0.0)
+async def forecast_for_location(lat: float, lon: float, refresh: bool = False):
+    forecast_data, fresh_for = await get_met_weather_forecast(lat, lon, refresh=refresh)
+    # model.predict is CPU-bound; keep it off the event loop
+    risk_predictions = await run_in_threadpool(predict_risk_for_all_diseases, forecast_data)
+    cache_risk(lat, lon, risk_predictions, fresh_for)
+    if HISTORY_ENABLED:
+        # Opening the store and converting timestamps is blocking work too
+        await run_in_threadpool(record_history, lat, lon, forecast_data, risk_predictions)
+    return risk_predictions
 
-            forecast = {
-                'Date': dt.strftime('%Y-%m-%d'),
-                'Temperature': details.get('air_temperature', 0),
-                'Humidity': details.get('relative_humidity', 0),
-                'Rainfall': rain,
-                'Cloud Cover': details.get('cloud_area_fraction', 0),
-                'Wind Speed': details.get('wind_speed', 0),
-            }
+def record_history(lat: float, lon: float, forecast_data: List[Dict], risk_predictions: List[Dict]):
+    # The parsed forecast holds the 12:00 UTC sample of each day
+    try:
+        store = get_history_store()
+        issued = time.time()
+        location = location_id(lat, lon)
+        store.record_forecast(
+            location, "met", issued, [f"{f['Date']}T12:00Z" for f in forecast_data],
+            temp=[f["Temperature"] for f in forecast_data],
+            humidity=[f["Humidity"] for f in forecast_data],
+            rain=[f["Rainfall"] for f in forecast_data],
+            wind=[f["Wind Speed"] for f in forecast_data],
+            cloud=[f["Cloud Cover"] for f in forecast_data],
+        )
+        store.record_predictions(
+            location, "risk", issued, [f"{r['date']}T12:00Z" for r in risk_predictions],
+            labels=[r["risk"] for r in risk_predictions],
+            targets=[r["disease"] for r in risk_predictions],
+        )
+    except Exception as e:
+        print("Error recording history:", e)
 
-            forecast['Leaf Wetness'] = round(estimate_leaf_wetness(forecast['Humidity'], forecast['Rainfall']), 2)
-            forecast_list.append(forecast)
-            seen_dates.add(dt.date())
+async def prefetch_location(lat: float, lon: float):
+    await forecast_flight.do_async((lat, lon, "prefetch"), forecast_for_location, lat, lon, True)
 
-        if len(forecast_list) == 7:
-            break
+async def load_fields_async():
+    return await run_in_threadpool(read_fields)
 
-    return forecast_list
-
-def predict_risk_for_all_diseases(forecast_data: List[Dict]):
-    forecast_df = pd.DataFrame(forecast_data)
-    all_results = []
-    
-    for disease_name in le_disease.classes_:
-        disease_encoded = le_disease.transform([disease_name])[0]
-        temp_df = forecast_df.copy()
-        temp_df["Disease_enc"] = disease_encoded
-
-        features = ["Disease_enc", "Temperature", "Humidity", "Rainfall",
-                   "Cloud Cover", "Wind Speed", "Leaf Wetness"]
-        X = temp_df[features]
-        predictions = model.predict(X)
-        
-        for idx, row in temp_df.iterrows():
-            result = {
-                "date": row["Date"],
-                "disease": disease_name,
-                "risk": le_risk.inverse_transform([predictions[idx]])[0],
-                "temperature": row["Temperature"],
-                "humidity": row["Humidity"],
-                "rainfall": row["Rainfall"],
-                "cloud_cover": row["Cloud Cover"],
-                "leaf_wetness": row["Leaf Wetness"]
-            }
-            all_results.append(result)
-    
-    return all_results
+prefetcher = PrefetchScheduler(load_fields_async, prefetch_location, interval=PREFETCH_INTERVAL)
 
 @app.get("/")
 async def home(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
+def read_fields():
+    if os.path.exists(FIELDS_FILE):
+        with open(FIELDS_FILE, "r") as f:
+            return json.load(f)
+    return {}
+
+def write_fields(fields: Dict):
+    os.makedirs(os.path.dirname(FIELDS_FILE), exist_ok=True)
+    with open(FIELDS_FILE, "w") as f:
+        json.dump(fields, f, indent=2)
+
 @app.post("/api/fields")
 async def add_field(field: Field):
     try:
-        fields = {}
-        if os.path.exists(FIELDS_FILE):
-            with open(FIELDS_FILE, "r") as f:
-                fields = json.load(f)
-        
+        fields = await run_in_threadpool(read_fields)
         fields[field.name] = {"lat": field.lat, "lon": field.lon}
-        
-        os.makedirs(os.path.dirname(FIELDS_FILE), exist_ok=True)
-        with open(FIELDS_FILE, "w") as f:
-            json.dump(fields, f, indent=2)
-            
+        await run_in_threadpool(write_fields, fields)
         return {"message": "Field added successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -138,30 +163,108 @@ async def add_field(field: Field):
 @app.get("/api/fields")
 async def get_fields():
     try:
-        if os.path.exists(FIELDS_FILE):
-            with open(FIELDS_FILE, "r") as f:
-                return json.load(f)
-        return {}
+        return await run_in_threadpool(read_fields)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/forecast/{field_name}")
 async def get_forecast(field_name: str):
     try:
-        with open(FIELDS_FILE, "r") as f:
-            fields = json.load(f)
-        
+        fields = await run_in_threadpool(read_fields)
+
         if field_name not in fields:
             raise HTTPException(status_code=404, detail="Field not found")
-            
+
         field = fields[field_name]
-        forecast_data = get_met_weather_forecast(field["lat"], field["lon"])
-        risk_predictions = predict_risk_for_all_diseases(forecast_data)
-        
-        return risk_predictions
+        risk_predictions = risk_cache.get((field["lat"], field["lon"]))
+        if risk_predictions is None:
+            risk_predictions = await forecast_flight.do_async((field["lat"], field["lon"]), forecast_for_location,
+                                                              field["lat"], field["lon"])
+        # The records are plain JSON already; skip FastAPI's per-value encoder walk on the event loop
+        return JSONResponse(risk_predictions)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/api/forecast")
+async def get_all_forecasts():
+    """Risk for every saved field; fields not in the cache are fetched together and scored in one predict."""
+    fields = await run_in_threadpool(read_fields)
+    results, missing = {}, {}
+    for name, field in fields.items():
+        cached = risk_cache.get((field["lat"], field["lon"]))
+        if cached is not None:
+            results[name] = cached
+        else:
+            missing[name] = field
+    if missing:
+        fetched = await asyncio.gather(*(get_met_weather_forecast(f["lat"], f["lon"]) for f in missing.values()),
+                                       return_exceptions=True)
+        forecasts, fresh_for = {}, {}
+        for name, data in zip(missing, fetched):
+            if isinstance(data, Exception):
+                results[name] = {"error": getattr(data, "detail", None) or str(data)}
+            else:
+                forecasts[name], fresh_for[name] = data
+        scored = await run_in_threadpool(lambda: risk_records(score_fields(forecasts)))
+        for name in forecasts:
+            field = missing[name]
+            results[name] = scored.get(name, [])
+            cache_risk(field["lat"], field["lon"], results[name], fresh_for[name])
+        if HISTORY_ENABLED:
+            await run_in_threadpool(lambda: [record_history(missing[name]["lat"], missing[name]["lon"],
+                                                            forecasts[name], results[name]) for name in forecasts])
+    return JSONResponse({name: results[name] for name in fields})
+
+def disease_outlook(forecast_data: List[Dict]):
+    # Each run of TIMESTEPS forecast days predicts the disease of the day that follows it
+    if not registry.exists("lstm_preprocessing"):
+        raise HTTPException(status_code=503, detail=f"{preprocessing_path(LSTM_MODEL_PATH)} not found; retrain, or "
+                                                    "refit it from the model's training CSV with "
+                                                    "lstm_runtime.py --fit-preprocessing")
+    lstm = registry.get("lstm").with_preprocessing(registry.get("lstm_preprocessing"))
+    if len(forecast_data) < lstm.timesteps:
+        return []
+    days = lstm.frame_features(pd.DataFrame(forecast_data))
+    proba = lstm.predict_proba(sliding_window_view(days, lstm.timesteps, axis=0).transpose(0, 2, 1))
+    best = proba.argmax(axis=1)
+    return [{"window_end": forecast_data[i + lstm.timesteps - 1]["Date"],
+             "disease": str(lstm.classes_[best[i]]),
+             "confidence": float(proba[i, best[i]]),
+             "probabilities": dict(zip(map(str, lstm.classes_), proba[i].astype(float).round(4).tolist()))}
+            for i in range(len(proba))]
+
+@app.get("/api/disease_outlook/{field_name}")
+async def get_disease_outlook(field_name: str):
+    """LSTM disease prediction after every 5-day run of a saved field's forecast."""
+    fields = await run_in_threadpool(read_fields)
+    if field_name not in fields:
+        raise HTTPException(status_code=404, detail="Field not found")
+    field = fields[field_name]
+    forecast_data, _ = await get_met_weather_forecast(field["lat"], field["lon"])
+    return await run_in_threadpool(disease_outlook, forecast_data)
+
+@app.get("/api/history/{field_name}")
+async def get_history(field_name: str, kind: str = "risk", start: str = None, end: str = None):
+    """Past predictions (kind=risk|...) or forecasts (kind=forecast) for a saved field."""
+    fields = await run_in_threadpool(read_fields)
+    if field_name not in fields:
+        raise HTTPException(status_code=404, detail="Field not found")
+    location = location_id(fields[field_name]["lat"], fields[field_name]["lon"])
+    store = get_history_store()
+    if kind == "forecast":
+        df = await run_in_threadpool(store.forecast_history, location, start, end)
+    else:
+        df = await run_in_threadpool(store.prediction_history, location, kind, start, end)
+    df["issue_time"] = df["issue_time"].astype(str)
+    df["valid_time"] = df["valid_time"].astype(str)
+    return df.astype(object).where(df.notna(), None).to_dict(orient="records")
+
+@app.get("/api/prefetch/status")
+async def prefetch_status():
+    return {**prefetcher.stats(), "cache": risk_cache.stats(), "met": {**met_stats, **met_flight.stats()}}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,491 @@
+import asyncio
+import httpx
+import numpy as np
+import os
+import pandas as pd
+import requests
+import sys
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Add the repository root to sys.path to share the standalone cache/breaker helpers in resilience.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from resilience import CircuitBreaker, LastGoodStore, SingleFlight, TTLCache
+
+# ---------------------- CONFIG ----------------------
+MET_URL = os.environ.get("MET_URL", "https://api.met.no/weatherapi/locationforecast/2.0/compact")
+USER_AGENT = "smart-agri-dashboard/1.0 contact@example.com"
+MET_TIMEOUT = httpx.Timeout(10.0, connect=3.05)
+MET_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+MET_CACHE_TTL = 1800     # used only when MET omits the Expires header
+MET_STALE_TTL = 6 * 3600
+LAST_GOOD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".met_cache")
+# -----------------------------------------------------
+
+met_cache = TTLCache(maxsize=1024, ttl=MET_CACHE_TTL, stale_ttl=MET_STALE_TTL)
+met_breaker = CircuitBreaker()
+met_last_good = LastGoodStore(LAST_GOOD_DIR)
+# Cold misses, revalidations and the prefetcher for one location share a single MET call
+met_flight = SingleFlight()
+_refreshing = {}
+
+
+class MetAPIError(Exception):
+    def __init__(self, status_code, text, headers=None):
+        super().__init__(f"MET API Error: {status_code} - {text}")
+        self.status_code = status_code
+        self.text = text
+        # Kept so the breaker can honour Retry-After on a 429
+        self.headers = headers
+
+
+class MetEntry:
+    """A cached locationforecast payload, the validator MET sent with it and its parses.
+
+    ``parsed`` maps parse options to parse_met_forecast output for this body;
+    a 304 keeps the body and so carries the parses over, a 200 starts afresh.
+    ``fresh_until`` is the monotonic time MET's Expires falls on.
+    """
+
+    __slots__ = ("data", "last_modified", "parsed", "fresh_until")
+
+    def __init__(self, data, last_modified=None, parsed=None):
+        self.data = data
+        self.last_modified = last_modified
+        self.parsed = parsed if parsed is not None else {}
+        self.fresh_until = 0.0
+
+
+# Counters for how often MET actually had to send a body
+met_stats = {"downloads": 0, "not_modified": 0}
+
+_async_client = None
+_session = None
+
+
+def get_async_client():
+    """Shared keep-alive client; created lazily inside the running event loop."""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            headers={"User-Agent": USER_AGENT},
+            timeout=MET_TIMEOUT,
+            limits=MET_LIMITS,
+        )
+    return _async_client
+
+
+def get_session():
+    """Shared requests session for the Streamlit app and scripts."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        _session.headers["User-Agent"] = USER_AGENT
+    return _session
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def met_key(lat, lon):
+    # MET asks clients to send at most 4 decimals, so that is the natural cache cell
+    return (round(lat, 4), round(lon, 4))
+
+
+def _seconds_until_expires(headers):
+    """Freshness lifetime from MET's Expires header; MET_CACHE_TTL when it is missing."""
+    expires = headers.get("Expires")
+    if not expires:
+        return MET_CACHE_TTL
+    try:
+        delta = parsedate_to_datetime(expires) - datetime.now(timezone.utc)
+    except (TypeError, ValueError):
+        return MET_CACHE_TTL
+    return max(0.0, delta.total_seconds())
+
+
+def _request_args(key, previous):
+    headers = {}
+    if previous is not None and previous.last_modified:
+        headers["If-Modified-Since"] = previous.last_modified
+    return {"params": {"lat": key[0], "lon": key[1]}, "headers": headers}
+
+
+def _accept(key, response, previous):
+    """Cache a 200 (new body) or 304 (reuse ``previous``) until the response's Expires."""
+    if response.status_code == 304 and previous is not None:
+        met_stats["not_modified"] += 1
+        entry = MetEntry(previous.data, response.headers.get("Last-Modified", previous.last_modified),
+                         previous.parsed)
+    elif response.status_code == 200:
+        met_stats["downloads"] += 1
+        entry = MetEntry(response.json(), response.headers.get("Last-Modified"))
+    else:
+        raise MetAPIError(response.status_code, response.text, response.headers)
+    ttl = _seconds_until_expires(response.headers)
+    entry.fresh_until = time.monotonic() + ttl
+    met_cache.set(key, entry, ttl=ttl)
+    return entry
+
+
+async def fetch_met_forecast_async(key, previous=None):
+    """Conditional GET without blocking the event loop; a 304 reuses ``previous``."""
+    response = await get_async_client().get(MET_URL, **_request_args(key, previous))
+    # Decoding a full MET payload takes milliseconds; do it in a worker thread
+    return await asyncio.to_thread(_accept, key, response, previous)
+
+
+def fetch_met_forecast(key, previous=None):
+    response = get_session().get(MET_URL, timeout=(MET_TIMEOUT.connect, MET_TIMEOUT.read),
+                                 **_request_args(key, previous))
+    return _accept(key, response, previous)
+
+
+async def get_met_forecast_async(lat, lon):
+    """Raw MET payload, honouring Expires / Last-Modified, for the async app.
+
+    Payloads are fresh until MET's Expires time; after that the cached copy
+    is returned at once while one background task revalidates it with
+    If-Modified-Since (a 304 just extends its lifetime). Upstream failures
+    trip ``met_breaker`` so later calls fail fast, and fall back to the
+    last good payload saved on disk.
+    """
+    return (await _cached_entry_async(met_key(lat, lon))).data
+
+
+async def refresh_met_forecast_async(lat, lon):
+    """Make sure the cached payload is current (used by the prefetch scheduler).
+
+    Goes upstream only once the cached copy has passed its Expires time.
+    """
+    return (await _current_entry_async(met_key(lat, lon))).data
+
+
+async def get_parsed_met_forecast_async(lat, lon, refresh=False, days=7, daily=False):
+    """``(parse_met_forecast records, seconds until they pass MET's Expires)`` for the cached payload.
+
+    Parsed once per body and off the event loop. The records are shared
+    between requests until MET sends a new body; treat them as read-only.
+    Anything derived from them is only fresh for the returned number of
+    seconds (0 when a stale copy was served).
+    """
+    key = met_key(lat, lon)
+    entry = await (_current_entry_async(key) if refresh else _cached_entry_async(key))
+    options = (days, daily)
+    parsed = entry.parsed.get(options)
+    if parsed is None:
+        parsed = entry.parsed[options] = await asyncio.to_thread(parse_met_forecast, entry.data, days, daily)
+    return parsed, max(0.0, entry.fresh_until - time.monotonic())
+
+
+async def _cached_entry_async(key):
+    entry, fresh = met_cache.lookup(key)
+    if entry is not None:
+        if not fresh and key not in _refreshing:
+            _refreshing[key] = asyncio.create_task(_refresh_quietly(key))
+        return entry
+    return await _refresh(key)
+
+
+async def _current_entry_async(key):
+    entry = met_cache.peek(key)
+    if entry is not None:
+        return entry
+    return await _refresh(key)
+
+
+async def _refresh_quietly(key):
+    try:
+        await _refresh(key)
+    except Exception as e:
+        print("Error refreshing MET forecast:", e)
+    finally:
+        _refreshing.pop(key, None)
+
+
+async def _refresh(key):
+    return await met_flight.do_async(key, _refresh_leader, key)
+
+
+async def _refresh_leader(key):
+    # A leader that finished just before this call was made may already have refreshed the entry
+    current = met_cache.peek(key)
+    if current is not None:
+        return current
+    previous = met_cache.peek(key, stale=True)
+    try:
+        entry = await met_breaker.call_async(fetch_met_forecast_async, key, previous)
+    except Exception as e:
+        return await asyncio.to_thread(_fallback, key, previous, e)
+    if previous is None or entry.data is not previous.data:
+        await asyncio.to_thread(met_last_good.save, key, entry.data)
+    return entry
+
+
+def get_met_forecast(lat, lon):
+    """Blocking twin of get_met_forecast_async for the Streamlit app and scripts.
+
+    Shares the same cache and single-flight; expired payloads are revalidated inline.
+    """
+    key = met_key(lat, lon)
+    entry, fresh = met_cache.lookup(key)
+    if entry is not None and fresh:
+        return entry.data
+    return met_flight.do(key, _refresh_blocking, key).data
+
+
+def _refresh_blocking(key):
+    current = met_cache.peek(key)
+    if current is not None:
+        return current
+    previous = met_cache.peek(key, stale=True)
+    try:
+        entry = met_breaker.call(fetch_met_forecast, key, previous)
+    except Exception as e:
+        return _fallback(key, previous, e)
+    if previous is None or entry.data is not previous.data:
+        met_last_good.save(key, entry.data)
+    return entry
+
+
+def _fallback(key, previous, error):
+    """Stale cached copy, else the last good payload on disk, else re-raise."""
+    if previous is not None:
+        return previous
+    data = met_last_good.load(key)
+    if data is None:
+        raise error
+    entry = MetEntry(data)
+    met_cache.set(key, entry, ttl=0)
+    return entry
+
+
+# 🌿 Leaf Wetness Estimate
+def estimate_leaf_wetness(humidity, rainfall):
+    if humidity > 90 and rainfall > 0:
+        return 13 + (humidity - 90) * 0.1 + rainfall * 0.5
+    elif humidity > 90:
+        return 11 + (humidity - 90) * 0.2
+    elif rainfall > 0:
+        return 10 + rainfall * 0.5
+    else:
+        return 8
+
+
+def estimate_leaf_wetness_array(humidity, rainfall):
+    """estimate_leaf_wetness over whole arrays at once."""
+    humid = humidity > 90
+    wet = rainfall > 0
+    return np.select(
+        [humid & wet, humid, wet],
+        [13 + (humidity - 90) * 0.1 + rainfall * 0.5, 11 + (humidity - 90) * 0.2, 10 + rainfall * 0.5],
+        default=8,
+    )
+
+
+# 🌦️ Columnar parse of the full MET timeseries
+MET_INSTANT_FIELDS = {
+    "air_temperature": "temp",
+    "relative_humidity": "humidity",
+    "cloud_area_fraction": "cloud",
+    "wind_speed": "wind",
+    "wind_from_direction": "wind_dir",
+    "air_pressure_at_sea_level": "pressure",
+}
+MET_PERIOD_FIELDS = {
+    "next_1_hours": "rain_1h",
+    "next_6_hours": "rain_6h",
+}
+HUMID_HOURS_THRESHOLD = 90
+_NO_DETAILS = {"details": {}}
+
+
+def parse_met_timeseries(data):
+    """All time steps of a MET payload as one compact frame indexed by UTC time.
+
+    This is not a single pass: each field gets its own list comprehension
+    over the timeseries, straight into a float column (NaN where MET left a
+    value out), which still beats building a dict per entry. The timestamps
+    are parsed by NumPy in bulk. MET is hourly for the first
+    ~2.5 days and 6-hourly after that, so ``step_hours`` gives the length of
+    each step and ``rain`` the precipitation falling during it.
+    """
+    timeseries = data['properties']['timeseries']
+    nan = float("nan")
+    blocks = [entry['data'] for entry in timeseries]
+    instant = [block['instant']['details'] for block in blocks]
+
+    columns = {}
+    for field, name in MET_INSTANT_FIELDS.items():
+        columns[name] = np.array([details.get(field, nan) for details in instant], dtype=np.float64)
+    for period, name in MET_PERIOD_FIELDS.items():
+        columns[name] = np.array(
+            [block.get(period, _NO_DETAILS)['details'].get('precipitation_amount', nan) for block in blocks],
+            dtype=np.float64)
+
+    # "2024-05-01T12:00:00Z" -> drop the Z so NumPy reads it as naive UTC
+    seconds = np.array([entry['time'][:19] for entry in timeseries], dtype="datetime64[s]").astype(np.int64)
+    step = np.diff(seconds)
+    step = np.append(step, step[-1] if len(step) else 3600)[:len(seconds)]
+    step_hours = step / 3600
+
+    rain_1h, rain_6h = columns["rain_1h"], columns["rain_6h"]
+    rain = np.where(step_hours <= 1, rain_1h, rain_6h)
+    # Fill a missing window from the other one, scaled to the step length
+    rain = np.where(np.isnan(rain), np.where(np.isnan(rain_1h), rain_6h * np.minimum(step_hours, 6) / 6, rain_1h), rain)
+    columns["step_hours"] = step_hours
+    columns["rain"] = np.nan_to_num(rain)
+    columns["leaf_wetness"] = estimate_leaf_wetness_array(
+        columns["humidity"], columns["rain"] / np.maximum(step_hours, 1))
+
+    index = pd.DatetimeIndex(seconds.astype("datetime64[s]"), name="time").tz_localize("UTC")
+    return pd.DataFrame(columns, index=index)
+
+
+def daily_met_summary(hourly, humidity_threshold=HUMID_HOURS_THRESHOLD):
+    """Per-day (UTC) aggregates of a parse_met_timeseries frame.
+
+    The frame is already sorted by time, so each day is a contiguous slice
+    and every aggregate is a single ``ufunc.reduceat`` over the columns.
+    """
+    day_index = hourly.index.floor("D")
+    days = day_index.asi8
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]]) if len(days) else np.empty(0, dtype=np.intp)
+
+    def reduce(ufunc, column):
+        return ufunc.reduceat(column, starts) if len(starts) else column[:0]
+
+    def mean(column):
+        seen = ~np.isnan(column)
+        with np.errstate(invalid="ignore"):
+            return reduce(np.add, np.where(seen, column, 0)) / reduce(np.add, seen.astype(np.float64))
+
+    temp, humidity = hourly["temp"].to_numpy(), hourly["humidity"].to_numpy()
+    step_hours = hourly["step_hours"].to_numpy()
+    humid_hours = np.where(humidity > humidity_threshold, step_hours, 0)
+    daily = pd.DataFrame({
+        "temp_min": reduce(np.fmin, temp),
+        "temp_max": reduce(np.fmax, temp),
+        "temp_mean": mean(temp),
+        "humidity_mean": mean(humidity),
+        "humidity_max": reduce(np.fmax, humidity),
+        "rain_sum": reduce(np.add, hourly["rain"].to_numpy()),
+        "cloud_mean": mean(hourly["cloud"].to_numpy()),
+        "wind_max": reduce(np.fmax, hourly["wind"].to_numpy()),
+        "leaf_wetness_mean": mean(hourly["leaf_wetness"].to_numpy()),
+        "humid_hours": reduce(np.add, humid_hours),
+        "hours_covered": reduce(np.add, step_hours),
+    }, index=pd.DatetimeIndex(day_index[starts], name="date"))
+    return daily
+
+
+# 🌦️ One 12:00 UTC sample per day, up to 7 days (what the risk model was trained on)
+# With daily=True, each day's aggregates over every time step ride along with its sample
+DAILY_RECORD_COLUMNS = {
+    "temp_min": "Temperature Min",
+    "temp_max": "Temperature Max",
+    "rain_sum": "Rain Total",
+    "humid_hours": "Humid Hours",
+    "leaf_wetness_mean": "Leaf Wetness Mean",
+}
+
+
+def parse_met_forecast(data, days=7, daily=False):
+    """The noon samples the risk model takes; ``daily=True`` adds DAILY_RECORD_COLUMNS.
+
+    The noon loop stops after ``days`` samples, so the default stays cheap on
+    the request path. The aggregates need the columnar parse of every step
+    (a few ms per payload), so they are opt-in.
+    """
+    forecast_list = _parse_noon_loop(data, days)
+    if daily and forecast_list:
+        summary = daily_met_summary(parse_met_timeseries(data))
+        values = summary[list(DAILY_RECORD_COLUMNS)].round(2).to_numpy().tolist()
+        by_date = dict(zip(summary.index.strftime('%Y-%m-%d'), values))
+        missing = [float("nan")] * len(DAILY_RECORD_COLUMNS)
+        for forecast in forecast_list:
+            row = by_date.get(forecast['Date'], missing)
+            forecast.update((name, None if v != v else v) for name, v in zip(DAILY_RECORD_COLUMNS.values(), row))
+    return forecast_list
+
+
+def _parse_noon_loop(data, days=7):
+    timeseries = data['properties']['timeseries']
+    forecast_list = []
+    seen_dates = set()
+
+    for entry in timeseries:
+        timestamp = entry['time']
+        dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
+
+        if dt.hour == 12 and dt.date() not in seen_dates:
+            details = entry['data']['instant']['details']
+            rain = entry['data'].get('next_6_hours', {}).get('details', {}).get('precipitation_amount', 0.0)
+
+            forecast = {
+                'Date': dt.strftime('%Y-%m-%d'),
+                'Temperature': details.get('air_temperature', 0),
+                'Humidity': details.get('relative_humidity', 0),
+                'Rainfall': rain,
+                'Cloud Cover': details.get('cloud_area_fraction', 0),
+                'Wind Speed': details.get('wind_speed', 0),
+            }
+
+            forecast['Leaf Wetness'] = round(estimate_leaf_wetness(forecast['Humidity'], forecast['Rainfall']), 2)
+            forecast_list.append(forecast)
+            seen_dates.add(dt.date())
+
+        if len(forecast_list) == days:
+            break
+
+    return forecast_list
+
+
+def _parse_all_steps_loop(data):
+    """parse_met_forecast's loop kept going over every step: the benchmark baseline."""
+    rows = []
+    for entry in data['properties']['timeseries']:
+        details = entry['data']['instant']['details']
+        rows.append({
+            'time': datetime.fromisoformat(entry['time'].replace("Z", "+00:00")),
+            'temp': details.get('air_temperature'),
+            'humidity': details.get('relative_humidity'),
+            'cloud': details.get('cloud_area_fraction'),
+            'wind': details.get('wind_speed'),
+            'rain_1h': entry['data'].get('next_1_hours', {}).get('details', {}).get('precipitation_amount'),
+            'rain_6h': entry['data'].get('next_6_hours', {}).get('details', {}).get('precipitation_amount'),
+        })
+    return pd.DataFrame(rows).set_index('time')
+
+
+def _benchmark(hours=(216, 2160, 21600), repeat=20):
+    """Columnar parse vs. the per-entry loop on synthetic payloads of growing length."""
+    import timeit
+    from weather_standin import synthetic_met
+
+    base = synthetic_met(0.0, 0.0)["properties"]["timeseries"]
+    for n in hours:
+        series = [dict(entry, time=(pd.Timestamp(base[0]["time"]) + pd.Timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ"))
+                  for i, entry in enumerate(base * (n // len(base) + 1))][:n]
+        payload = {"properties": {"timeseries": series}}
+        # The noon loop stops after 7 noons, so also time the same loop keeping every step
+        noon_only = parse_met_forecast(payload)
+        assert [{k: r[k] for k in e} for r, e in zip(parse_met_forecast(payload, daily=True), noon_only)] == noon_only
+        loop_daily = timeit.timeit(lambda: parse_met_forecast(payload), number=repeat) / repeat
+        noon = timeit.timeit(lambda: parse_met_forecast(payload, daily=True), number=repeat) / repeat
+        loop_full = timeit.timeit(lambda: _parse_all_steps_loop(payload), number=repeat) / repeat
+        columnar = timeit.timeit(lambda: parse_met_timeseries(payload), number=repeat) / repeat
+        summary = timeit.timeit(lambda: daily_met_summary(parse_met_timeseries(payload)), number=repeat) / repeat
+        print(f"{n:>6} steps | parse_met_forecast {loop_daily * 1e3:7.2f} ms | daily=True {noon * 1e3:7.2f} ms | "
+              f"loop all steps {loop_full * 1e3:7.2f} ms | columnar hourly {columnar * 1e3:7.2f} ms | "
+              f"+ daily {summary * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -1,53 +1,106 @@
+import math
+import sys
 import pandas as pd
 import numpy as np
+import joblib
 from sklearn.preprocessing import LabelEncoder, StandardScaler
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import LSTM, Dense, Dropout
+from tensorflow.keras.utils import Sequence
 from sklearn.model_selection import train_test_split
+from lstm_sequences import BATCH_SIZE, TIMESTEPS, count_batches, make_sequences, scan_csv, stream_windows
 
-# Load dataset
-df = pd.read_csv('data/potato_disease_environment_dataset.csv')
+# Usage: python LSTM_timeSeries.py [dataset.csv] [--stream]
+# --stream reads the CSV in chunks instead of loading it, for multi-million-row histories
+args = [a for a in sys.argv[1:] if a != '--stream']
+DATA_PATH = args[0] if args else 'data/potato_disease_environment_dataset.csv'
+STREAM = '--stream' in sys.argv
+EPOCHS = 30
 
-# Encode target labels (e.g., "Late Blight", etc.)
-le = LabelEncoder()
-df['Disease_Encoded'] = le.fit_transform(df['Disease'])
 
-# Drop non-numeric columns (exclude 'Disease' and 'Risk Label' from features)
-feature_cols = df.select_dtypes(include=['number']).drop(columns=['Disease_Encoded']).columns.tolist()
+class WindowBatches(Sequence):
+    """Batches gathered from the strided window view; only the current batch is copied."""
 
-# Scale features
-scaler = StandardScaler()
-features_scaled = scaler.fit_transform(df[feature_cols])
+    def __init__(self, X, y, indices, batch_size=BATCH_SIZE, shuffle=True, **kwargs):
+        super().__init__(**kwargs)
+        self.X, self.y = X, y
+        self.indices = np.array(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
 
-# Prepare sequences for LSTM (we'll use 5 timesteps per sample)
-TIMESTEPS = 5
-X = []
-y = []
+    def __len__(self):
+        return math.ceil(len(self.indices) / self.batch_size)
 
-for i in range(len(features_scaled) - TIMESTEPS):
-    X.append(features_scaled[i:i+TIMESTEPS])
-    y.append(df['Disease_Encoded'].iloc[i + TIMESTEPS])
+    def __getitem__(self, k):
+        idx = self.indices[k * self.batch_size:(k + 1) * self.batch_size]
+        return self.X[idx], self.y[idx]
 
-X = np.array(X)
-y = np.array(y)
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
 
-# Split into train and test sets
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+
+def repeat_stream(validation):
+    # Keras takes one endless generator; each epoch re-reads the file with a new shuffle
+    epoch = 0
+    while True:
+        yield from stream_windows(DATA_PATH, scaler, le, feature_cols, validation=validation,
+                                  seed=None if validation else epoch)
+        epoch += 1
+
+
+if STREAM:
+    # Fit the scaler and encoder in one chunked pass; windows are streamed from disk while training
+    scaler, le, feature_cols, chunk_rows = scan_csv(DATA_PATH)
+    train_data = repeat_stream(validation=False)
+    val_data = repeat_stream(validation=True)
+    fit_args = {'steps_per_epoch': count_batches(chunk_rows),
+                'validation_steps': count_batches(chunk_rows, validation=True)}
+else:
+    # Load dataset
+    df = pd.read_csv(DATA_PATH)
+    # Rows with no Disease label can't be encoded; drop them, as the streamed path does
+    df = df.dropna(subset=['Disease']).reset_index(drop=True)
+
+    # Encode target labels (e.g., "Late Blight", etc.)
+    le = LabelEncoder()
+    df['Disease_Encoded'] = le.fit_transform(df['Disease'])
+
+    # Drop non-numeric columns (exclude 'Disease' and 'Risk Label' from features)
+    feature_cols = df.select_dtypes(include=['number']).drop(columns=['Disease_Encoded']).columns.tolist()
+
+    # Scale features
+    scaler = StandardScaler()
+    features_scaled = scaler.fit_transform(df[feature_cols])
+
+    # Prepare sequences for LSTM (5 timesteps per sample) as a strided view: no window is copied
+    X, y = make_sequences(features_scaled, df['Disease_Encoded'].to_numpy(), TIMESTEPS)
+
+    # Split window numbers into train and test sets, then hold out the last 20% of train for validation
+    train_idx, test_idx = train_test_split(np.arange(len(y)), test_size=0.2, random_state=42)
+    split_at = math.ceil(len(train_idx) * 0.8)
+    train_data = WindowBatches(X, y, train_idx[:split_at])
+    val_data = WindowBatches(X, y, train_idx[split_at:], shuffle=False)
+    fit_args = {}
 
 # Build LSTM model
 model = Sequential()
-model.add(LSTM(64, input_shape=(X.shape[1], X.shape[2]), return_sequences=False))
+model.add(LSTM(64, input_shape=(TIMESTEPS, len(feature_cols)), return_sequences=False))
 model.add(Dropout(0.3))
 model.add(Dense(32, activation='relu'))
-model.add(Dense(len(np.unique(y)), activation='softmax'))
+model.add(Dense(len(le.classes_), activation='softmax'))
 
 # Compile model
 model.compile(loss='sparse_categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
 
 # Train model
-model.fit(X_train, y_train, epochs=30, batch_size=32, validation_split=0.2)
+model.fit(train_data, validation_data=val_data, epochs=EPOCHS, **fit_args)
 
 # Save model
 model.save('potato_disease_lstm_model.h5')
 print("✅ Model trained and saved as 'potato_disease_lstm_model.h5'")
- 
\ No newline at end of file
+
+# Save the scaler and encoder beside it so lstm_runtime.py can serve the model without TensorFlow
+joblib.dump({'scaler': scaler, 'label_encoder': le, 'feature_cols': feature_cols, 'timesteps': TIMESTEPS},
+            'potato_disease_lstm_model.preprocessing.pkl')
+print("✅ Preprocessing saved as 'potato_disease_lstm_model.preprocessing.pkl'")
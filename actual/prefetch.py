@@ -0,0 +1,69 @@
+import asyncio
+import random
+import time
+
+
+class PrefetchScheduler:
+    """Keep every saved field's forecast warm in the background.
+
+    Each cycle reloads the fields store and refreshes the fields one by one,
+    spread evenly over ``interval`` seconds with a random jitter inside each
+    slot, so upstream sees a steady trickle instead of a burst on the hour.
+    """
+
+    def __init__(self, load_fields, refresh, interval=3600, jitter=0.5):
+        self.load_fields = load_fields
+        self.refresh = refresh
+        self.interval = interval
+        self.jitter = jitter
+        self._task = None
+        self.cycles = 0
+        self.refreshed = 0
+        self.failures = 0
+        self.last_cycle_started = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            cycle_start = loop.time()
+            self.last_cycle_started = time.time()
+            try:
+                fields = await self.load_fields()
+            except Exception as e:
+                print("Prefetch could not load fields:", e)
+                fields = {}
+            slot = self.interval / max(len(fields), 1)
+            for i, (name, field) in enumerate(fields.items()):
+                due = cycle_start + i * slot + random.uniform(0, slot * self.jitter)
+                await asyncio.sleep(max(0.0, due - loop.time()))
+                try:
+                    await self.refresh(field["lat"], field["lon"])
+                    self.refreshed += 1
+                except Exception as e:
+                    self.failures += 1
+                    print(f"Prefetch failed for field '{name}':", e)
+            self.cycles += 1
+            await asyncio.sleep(max(0.0, cycle_start + self.interval - loop.time()))
+
+    def stats(self):
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "interval": self.interval,
+            "cycles": self.cycles,
+            "refreshed": self.refreshed,
+            "failures": self.failures,
+            "last_cycle_started": self.last_cycle_started,
+        }
@@ -0,0 +1,144 @@
+"""Disease risk for many fields x every disease x every forecast day in one predict.
+
+The risk model takes the disease as an encoded input, so scoring a field
+used to mean one copy of its forecast and one ``predict`` per disease, and
+an ``inverse_transform`` per row to read the labels. Here the forecasts of
+all fields are stacked once, the (field, disease, day) cross product is
+built with index arithmetic, the model is called once and the labels are
+decoded with one lookup.
+
+    python risk_engine.py        # check against the per-disease loop and time 1,000 fields
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Add the repository root to sys.path to share the model registry
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from model_registry import registry
+
+# ---------------------- CONFIG ----------------------
+RISK_FEATURES = ["Disease_enc", "Temperature", "Humidity", "Rainfall",
+                 "Cloud Cover", "Wind Speed", "Leaf Wetness"]
+# parsed MET forecast column -> key in the API's risk records
+RECORD_COLUMNS = {"Date": "date", "Disease": "disease", "Predicted Risk": "risk", "Temperature": "temperature",
+                  "Humidity": "humidity", "Rainfall": "rainfall", "Cloud Cover": "cloud_cover",
+                  "Leaf Wetness": "leaf_wetness",
+                  # Daily aggregates over every MET time step (parse_met_forecast daily=True), when present
+                  "Temperature Min": "temperature_min", "Temperature Max": "temperature_max",
+                  "Rain Total": "rain_total", "Humid Hours": "humid_hours",
+                  "Leaf Wetness Mean": "leaf_wetness_mean"}
+# -----------------------------------------------------
+
+
+def score_fields(forecasts, model=None, le_disease=None, le_risk=None):
+    """Risk for every field in ``forecasts`` ({field: forecast rows or frame}) under every disease.
+
+    Returns one frame ordered field, then disease, then forecast day: the
+    forecast columns plus "Field", "Disease_enc", "Predicted Risk" and
+    "Disease". Models default to the registry's "risk", "disease_encoder"
+    and "risk_encoder".
+    """
+    model = registry.get("risk") if model is None else model
+    le_disease = registry.get("disease_encoder") if le_disease is None else le_disease
+    le_risk = registry.get("risk_encoder") if le_risk is None else le_risk
+
+    names = list(forecasts)
+    frames = [pd.DataFrame(forecasts[name]) for name in names]
+    weather = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=RISK_FEATURES[1:])
+    diseases = np.asarray(le_disease.classes_)
+    encoded = le_disease.transform(diseases)
+
+    # Row k of the cross product is field f, disease (pos // days), day (pos % days)
+    days = np.array([len(f) for f in frames], dtype=np.intp)
+    first_row = np.concatenate(([0], np.cumsum(days)[:-1])).astype(np.intp)
+    per_field = days * len(diseases)
+    field = np.repeat(np.arange(len(frames), dtype=np.intp), per_field)
+    pos = np.arange(per_field.sum(), dtype=np.intp) - np.repeat(np.cumsum(per_field) - per_field, per_field)
+    disease = pos // days[field] if len(pos) else pos
+    row = first_row[field] + (pos % days[field] if len(pos) else pos)
+
+    out = weather.take(row).reset_index(drop=True)
+    out.insert(0, "Field", np.asarray(names, dtype=object)[field] if names else [])
+    out["Disease_enc"] = encoded[disease]
+    if len(out):
+        out["Predicted Risk"] = le_risk.inverse_transform(np.asarray(model.predict(out[RISK_FEATURES])))
+    else:
+        out["Predicted Risk"] = pd.Series(dtype=object)
+    out["Disease"] = diseases[disease]
+    return out
+
+
+def predict_risk_frame(forecast_df, **models):
+    """One field's forecast frame -> its rows under every disease, disease by disease."""
+    return score_fields({None: forecast_df}, **models).drop(columns="Field")
+
+
+def risk_records(scored):
+    """``score_fields`` rows -> {field: [{"date", "disease", "risk", ...}, ...]}, in field order."""
+    renamed = scored.rename(columns=RECORD_COLUMNS)
+    columns = renamed[[c for c in RECORD_COLUMNS.values() if c in renamed]].astype(object)
+    records = columns.where(columns.notna(), None).to_dict(orient="records")
+    grouped = {}
+    for name, record in zip(scored["Field"], records):
+        grouped.setdefault(name, []).append(record)
+    return grouped
+
+
+# ---------------------- BENCHMARK ----------------------
+def _per_disease_loop(forecast_df, model, le_disease, le_risk):
+    # How every app scored one field: a forecast copy and a predict per disease
+    results = []
+    for disease_name in le_disease.classes_:
+        temp_df = forecast_df.copy()
+        temp_df["Disease_enc"] = le_disease.transform([disease_name])[0]
+        predictions = model.predict(temp_df[RISK_FEATURES])
+        temp_df["Predicted Risk"] = [le_risk.inverse_transform([p])[0] for p in predictions]
+        temp_df["Disease"] = disease_name
+        results.append(temp_df)
+    return pd.concat(results, ignore_index=True)
+
+
+def _benchmark(n_fields=1000, days=7):
+    import time
+    import warnings
+
+    warnings.filterwarnings("ignore")
+    here = os.path.dirname(os.path.abspath(__file__))
+    registry.register("risk", os.path.join(here, "model", "risk_predictor_model.pkl"))
+    registry.register("disease_encoder", os.path.join(here, "model", "disease_label_encoder.pkl"))
+    registry.register("risk_encoder", os.path.join(here, "model", "risk_label_encoder.pkl"))
+    model, le_disease, le_risk = registry.get("risk"), registry.get("disease_encoder"), registry.get("risk_encoder")
+
+    rng = np.random.default_rng(0)
+    dates = pd.date_range("2026-06-01", periods=days).strftime("%Y-%m-%d")
+    forecasts = {}
+    for k in range(n_fields):
+        humidity = rng.uniform(40, 100, days)
+        rain = rng.uniform(0, 15, days)
+        forecasts[f"field-{k}"] = pd.DataFrame({
+            "Date": dates, "Temperature": rng.uniform(8, 32, days), "Humidity": humidity, "Rainfall": rain,
+            "Cloud Cover": rng.uniform(0, 100, days), "Wind Speed": rng.uniform(0, 12, days),
+            "Leaf Wetness": rng.uniform(0, 24, days)})
+
+    start = time.perf_counter()
+    scored = score_fields(forecasts)
+    batched = time.perf_counter() - start
+    sample = list(forecasts)[:20]
+    start = time.perf_counter()
+    looped = [_per_disease_loop(forecasts[name], model, le_disease, le_risk) for name in sample]
+    per_field = (time.perf_counter() - start) / len(sample)
+
+    expected = pd.concat(looped, ignore_index=True)
+    got = scored[scored["Field"].isin(sample)].drop(columns="Field").reset_index(drop=True)
+    same = got.equals(expected[got.columns])
+    print(f"{n_fields} fields x {len(le_disease.classes_)} diseases x {days} days = {len(scored)} rows: "
+          f"one call {batched * 1e3:.0f} ms vs {per_field * n_fields:.1f} s looping per disease "
+          f"(identical output: {same})")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -1,7 +1,13 @@
-import requests
 import pandas as pd
-import joblib
-from datetime import datetime
+import os
+import sys
+from met_client import get_met_forecast, parse_met_forecast
+
+# Add the repository root to sys.path to share the model registry
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from model_registry import registry
+from risk_engine import predict_risk_frame
 
 # ---------------------- CONFIG ----------------------
 LAT = 15.3
@@ -12,85 +18,19 @@ DISEASE_ENCODER_PATH = "disease_label_encoder.pkl"
 RISK_ENCODER_PATH = "risk_label_encoder.pkl"
 # -----------------------------------------------------
 
-# 🌿 Estimate Leaf Wetness (hrs)
-def estimate_leaf_wetness(humidity, rainfall):
-    if humidity > 90 and rainfall > 0:
-        return 13 + (humidity - 90) * 0.1 + rainfall * 0.5
-    elif humidity > 90:
-        return 11 + (humidity - 90) * 0.2
-    elif rainfall > 0:
-        return 10 + rainfall * 0.5
-    else:
-        return 8
+# Loaded once per process on first use instead of on every prediction
+registry.register("risk", MODEL_PATH)
+registry.register("disease_encoder", DISEASE_ENCODER_PATH)
+registry.register("risk_encoder", RISK_ENCODER_PATH)
 
-# 🌦️ Fetch 7-day forecast from MET Norway
+# 🌦️ MET API Forecast (No key needed; cached until Expires, revalidated with If-Modified-Since)
 def get_met_weather_forecast(lat, lon):
-    url = f"https://api.met.no/weatherapi/locationforecast/2.0/compact?lat={lat}&lon={lon}"
-    headers = {
-        "User-Agent": "smart-agri-dashboard/1.0 yuvaraj@example.com"
-    }
-
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        raise Exception(f"MET API Error: {response.status_code} - {response.text}")
-
-    data = response.json()
-    timeseries = data['properties']['timeseries']
-
-    forecast_list = []
-    seen_dates = set()
-
-    for entry in timeseries:
-        timestamp = entry['time']
-        dt = datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-
-        if dt.hour == 12 and dt.date() not in seen_dates:
-            details = entry['data']['instant']['details']
-            rain = entry['data'].get('next_6_hours', {}).get('details', {}).get('precipitation_amount', 0.0)
-
-            forecast = {
-                'Date': dt.strftime('%Y-%m-%d'),
-                'Temperature': details.get('air_temperature', 0),
-                'Humidity': details.get('relative_humidity', 0),
-                'Rainfall': rain,
-                'Cloud Cover': details.get('cloud_area_fraction', 0),
-                'Wind Speed': details.get('wind_speed', 0)
-            }
-
-            forecast['Leaf Wetness'] = round(estimate_leaf_wetness(forecast['Humidity'], forecast['Rainfall']), 2)
-
-            forecast_list.append(forecast)
-            seen_dates.add(dt.date())
-
-        if len(forecast_list) == 7:
-            break
-
-    return pd.DataFrame(forecast_list)
+    return pd.DataFrame(parse_met_forecast(get_met_forecast(lat, lon)))
 
 # 🧠 Predict risk level using trained model
 def predict_risk_for_all_diseases(forecast_df):
-    model = joblib.load(MODEL_PATH)
-    le_disease = joblib.load(DISEASE_ENCODER_PATH)
-    le_risk = joblib.load(RISK_ENCODER_PATH)
-
-    all_results = []
-
-    for disease_name in le_disease.classes_:
-        disease_encoded = le_disease.transform([disease_name])[0]
-        temp_df = forecast_df.copy()
-        temp_df["Disease_enc"] = disease_encoded
-
-        features = ["Disease_enc", "Temperature", "Humidity", "Rainfall",
-                    "Cloud Cover", "Wind Speed", "Leaf Wetness"]
-        X = temp_df[features]
-
-        predictions = model.predict(X)
-        temp_df["Predicted Risk"] = le_risk.inverse_transform(predictions)
-        temp_df["Disease"] = disease_name
-
-        all_results.append(temp_df)
-
-    return pd.concat(all_results, ignore_index=True)
+    # Every disease in one predict call, rows grouped disease by disease
+    return predict_risk_frame(forecast_df)
 
 # 🚀 Main Program
 if __name__ == "__main__":
@@ -1,29 +1,57 @@
 import streamlit as st
 import pandas as pd
 import matplotlib.pyplot as plt
-import joblib
 import numpy as np
 from streamlit_folium import st_folium
 import folium
 from utils import fetch_weather_data, get_hourly_forecast, recommend_fertilizer, predict_stress_level, get_7_day_forecast, generate_weather_alerts
 import os
-
-# Load Crop Model
-crop_model_path = os.path.join('model', 'crop_model.pkl')
-if os.path.exists(crop_model_path):
-    crop_model = joblib.load(crop_model_path)
-    crop_model_loaded = True
-else:
-    crop_model_loaded = False
-
-# Load Other Models
-yield_model = joblib.load("model/yield_model.pkl")
-time_model = joblib.load("model/best_window_model.pkl")
-fert_model = joblib.load("model/fertilizer_model.pkl")
-stress_model = joblib.load("model/stress_model.pkl")
+from model_registry import registry
+from response_surface import YIELD_APPROXIMATE, surface_for
+from sensitivity import forecast_instances, sensitivity_for
+from spray_windows import SPRAY_WINDOW_HOURS, describe, spray_windows
+
+# Models (loaded once per process on first use, not on every Streamlit rerun)
+registry.register("crop", os.path.join('model', 'crop_model.pkl'))
+crop_model_loaded = registry.exists("crop")
+registry.register("yield", "model/yield_model.pkl")
+registry.register("spray", "model/best_window_model.pkl")
+registry.register("fertilizer", "model/fertilizer_model.pkl")
+registry.register("stress", "model/stress_model.pkl")
 
 st.set_page_config(page_title="Smart Potato Farming", layout="wide")
 
+FEATURE_LABELS = {
+    "ozone": "Ozone Level (ppb)",
+    "temp": "Temperature (°C)",
+    "rain": "Rainfall (mm)",
+    "soil": "Soil Moisture (m³/m³)",
+    "ph": "Soil pH",
+}
+
+def plot_sensitivity(result, inputs, ylabel):
+    """PD line plus one faint ICE curve per forecast day (today's dashed) for each swept input."""
+    for feature, curve in result["features"].items():
+        fig, ax = plt.subplots()
+        for i, ice in enumerate(curve.get("ice", [])):
+            if i == 0:
+                ax.plot(curve["values"], ice, color='green', linestyle='--', linewidth=1, label="Today")
+            else:
+                ax.plot(curve["values"], ice, color='grey', alpha=0.3, linewidth=1)
+        ax.plot(curve["values"], curve["pd"], color='green', linewidth=2.5, label="Average over forecast")
+        ax.axvline(inputs[feature], color='orange', linestyle=':', label="Your input")
+        ax.set_xlabel(FEATURE_LABELS.get(feature, feature))
+        ax.set_ylabel(ylabel)
+        ax.legend()
+        st.pyplot(fig)
+    for pair in result["pairs"]:
+        fig, ax = plt.subplots()
+        mesh = ax.pcolormesh(pair["y"], pair["x"], np.array(pair["pd"]), shading='auto', cmap='Greens')
+        fig.colorbar(mesh, ax=ax, label=ylabel)
+        ax.set_xlabel(FEATURE_LABELS.get(pair["features"][1], pair["features"][1]))
+        ax.set_ylabel(FEATURE_LABELS.get(pair["features"][0], pair["features"][0]))
+        st.pyplot(fig)
+
 st.title("🥔 Smart Potato Farming Dashboard")
 
 # Sidebar Navigation
@@ -34,6 +62,8 @@ page = st.sidebar.radio("Choose a Feature", [
     "⚠️ Crop Stress Level Prediction",
     "🌱 Crop Recommendation"
 ])
+approximate_yield = st.sidebar.checkbox("⚡ Fast approximate yield", value=YIELD_APPROXIMATE,
+                                        help="Interpolate a precomputed grid of yield predictions")
 
 st.subheader("🌍 Select Your Location on Map")
 
@@ -93,25 +123,29 @@ if output and output['last_clicked']:
 
         if page == "📈 Yield Prediction":
             st.header("📊 Potato Yield Prediction")
-            features = pd.DataFrame([[ozone, temp, rain, soil]], columns=["ozone", "temp", "rain", "soil"])
-            prediction = yield_model.predict(features)[0]
+            if approximate_yield:
+                yield_model = surface_for("yield")
+                prediction = yield_model.predict_one({"ozone": ozone, "temp": temp, "rain": rain, "soil": soil})
+            else:
+                yield_model = registry.get("yield")
+                features = pd.DataFrame([[ozone, temp, rain, soil]], columns=["ozone", "temp", "rain", "soil"])
+                prediction = yield_model.predict(features)[0]
             st.success(f"📊 Predicted Potato Yield: **{prediction:.2f} tonnes/hectare**")
-
-            st.subheader("📉 Ozone vs Yield Sensitivity for Potato")
-            ozone_vals = np.linspace(30, 100, 50)
-            pred_df = pd.DataFrame({
-                "ozone": ozone_vals,
-                "temp": temp,
-                "rain": rain,
-                "soil": soil
-            })
-            predictions = yield_model.predict(pred_df)
-            fig, ax = plt.subplots()
-            ax.plot(ozone_vals, predictions, color='green')
-            ax.set_xlabel("Ozone Level (ppb)")
-            ax.set_ylabel("Predicted Yield (tonnes/ha)")
-            ax.set_title("Ozone Impact on Potato Yield")
-            st.pyplot(fig)
+            if approximate_yield:
+                st.caption(f"⚡ Approximate: within {yield_model.max_error:.2f} t/ha of the full model")
+
+            st.subheader("📉 What-if: Yield Sensitivity for Potato")
+            yield_inputs = {"ozone": ozone, "temp": temp, "rain": rain, "soil": soil}
+            sweep = st.multiselect("Inputs to vary", ["ozone", "temp", "rain", "soil"], default=["ozone"],
+                                   format_func=FEATURE_LABELS.get)
+            pair = st.selectbox("Two-way interaction", ["None", "ozone × temp", "ozone × soil", "temp × rain",
+                                                        "rain × soil"])
+            result = sensitivity_for(
+                "yield", forecast_instances(lat, lon, yield_inputs),
+                model=yield_model if approximate_yield else None,
+                features=sweep, pairs=[] if pair == "None" else [tuple(pair.split(" × "))],
+            )
+            plot_sensitivity(result, yield_inputs, "Predicted Yield (tonnes/ha)")
 
         elif page == "🕒 Best Fertilizer Window":
             st.header("🕒 Fertilizer Spray Timing Prediction")
@@ -119,23 +153,28 @@ if output and output['last_clicked']:
             if not hourly_data.empty:
                 st.write("### Hourly Forecast Preview:")
                 st.dataframe(hourly_data)
-                hourly_data['probability'] = time_model.predict_proba(
+                hourly_data['probability'] = registry.get("spray").predict_proba(
                     hourly_data[["hour", "temp", "humidity", "wind", "ozone", "rain"]]
                 )[:, 1]
 
-                best_window = None
-                best_score = -1
-                for i in range(len(hourly_data) - 2):
-                    window = hourly_data.iloc[i:i+3]
-                    avg_prob = window['probability'].mean()
-                    if avg_prob > best_score:
-                        best_score = avg_prob
-                        best_window = f"{int(window.iloc[0]['hour'])}:00 to {int(window.iloc[2]['hour']) + 1}:00"
-
-                if best_score >= 0.5:
-                    st.success(f"✅ Best 3-hour window to spray: **{best_window}** (Confidence: {best_score:.2f})")
+                col1, col2 = st.columns(2)
+                width = col1.slider("Window length (hours)", 1, 8, SPRAY_WINDOW_HOURS)
+                top = col2.slider("Windows to show", 1, 5, 1)
+                daylight = st.checkbox("Daylight only", value=True)
+                per_day = st.checkbox("Best window for each day")
+                rain_free_hours = None
+                if st.checkbox("No rain during the window"):
+                    rain_free_hours = st.slider("...nor in the hours after it", 0, 24, 6)
+                windows = spray_windows(hourly_data, width=width, top=top, per_day=per_day, daylight=daylight,
+                                        rain_free_hours=rain_free_hours)
+
+                best = max(windows, key=lambda w: w["confidence"]) if windows else None
+                if best is not None and best["ideal"]:
+                    st.success(f"✅ {describe(best, width)}")
                 else:
-                    st.warning(f"⚠️ No ideal 3-hour window, but highest confidence: **{best_window}** (Confidence: {best_score:.2f})")
+                    st.warning(f"⚠️ {describe(best, width)}")
+                if len(windows) > 1:
+                    st.dataframe(pd.DataFrame(windows)[["date", "window", "confidence", "ideal"]])
             else:
                 st.warning("⚠️ No hourly forecast data available for prediction.")
 
@@ -143,24 +182,30 @@ if output and output['last_clicked']:
             st.header("🧪 AI-Based Fertilizer Recommendation")
             ph = st.slider("Soil pH", 4.5, 7.5, 5.8)
             stage = st.selectbox("Current Growth Stage", ["Pre-Planting", "Early Growth", "Tuberization", "Bulking"])
-            input_df = pd.DataFrame([{
+            inputs = {
                 "ozone": ozone,
                 "temp": temp,
                 "rain": rain,
                 "soil": soil,
                 "ph": ph,
                 "stage": stage
-            }])
-            prediction = recommend_fertilizer(input_df, fert_model)
+            }
+            prediction = recommend_fertilizer(inputs, registry.get("fertilizer"))
             st.success(f"🌿 Recommended Fertilizer: **{prediction}**")
 
+            with st.expander("📉 What would change this recommendation?"):
+                sweep = st.multiselect("Inputs to vary", ["ph", "soil", "ozone", "temp", "rain"], default=["ph"],
+                                       format_func=FEATURE_LABELS.get)
+                result = sensitivity_for("fertilizer", forecast_instances(lat, lon, inputs), features=sweep,
+                                         target=prediction)
+                plot_sensitivity(result, inputs, f"Probability of {prediction}")
+
         elif page == "⚠️ Crop Stress Level Prediction":
             st.header("⚠️ Crop Stress Level Prediction")
             color = st.selectbox("Leaf Color Observation", ["Dark Green", "Yellowing", "Purple Tint", "Brown Spots"])
             symptom = st.selectbox("Symptom on Leaf/Plant", ["None", "Wilting", "Curling", "Stunted Growth"])
-            input_df = pd.DataFrame([[ozone, temp, humidity, color, symptom]],
-                                    columns=["ozone", "temp", "humidity", "color", "symptom"])
-            level, explanation = predict_stress_level(stress_model, input_df)
+            inputs = {"ozone": ozone, "temp": temp, "humidity": humidity, "color": color, "symptom": symptom}
+            level, explanation = predict_stress_level(registry.get("stress"), inputs)
             st.info(f"Stress Level: **{level}**")
             st.write(explanation)
 
@@ -179,7 +224,7 @@ if output and output['last_clicked']:
                 if st.button("Recommend Crop"):
                     features = [[N, P, K, temperature, humidity, ph, rainfall, ozone]]
                     try:
-                        pred = crop_model.predict(features)[0]
+                        pred = registry.get("crop").predict(features)[0]
                         st.success(f"Recommended Crop: **{pred}**")
                     except Exception as e:
                         st.warning("No preferred crop available for the given conditions.")
@@ -1,5 +1,5 @@
 from flask import Flask, render_template, request, jsonify
-from utils import fetch_weather_data, get_hourly_forecast, recommend_fertilizer, predict_stress_level
+from utils import FERTILIZER_SCHEMA, STRESS_SCHEMA, fetch_weather_data, get_hourly_forecast, record_prediction, stress_explanation
 
 app = Flask(__name__)
 
@@ -22,14 +22,28 @@ def get_agri_data():
     return jsonify({'weather': weather, 'recommendations': recommendations})
 
 # --- Dashboard API endpoints ---
-import joblib
-import pandas as pd
-
-yield_model = joblib.load("model/yield_model.pkl")
-fert_model = joblib.load("model/fert_model.pkl")
-stress_model = joblib.load("model/stress_model.pkl")
-time_model = joblib.load("model/best_window_model.pkl")
-crop_model = joblib.load("model/crop_model.pkl")
+from batching import model_batcher
+from bulk import (BulkRequestError, bulk_crop, bulk_fertilizer, bulk_spray, bulk_stress, bulk_yield, load_saved_fields,
+                  parse_request)
+from feature_schema import UnknownCategoryError
+from model_registry import registry
+from prediction_cache import prediction_cache
+from sensitivity import sensitivity_request
+from spray_schedule import schedule_request
+from spray_windows import SPRAY_WINDOW_HOURS, spray_response, spray_windows
+
+# Models load on first use and hot-reload when the files change
+registry.register("yield", "model/yield_model.pkl")
+registry.register("fert", "model/fert_model.pkl")
+registry.register("stress", "model/stress_model.pkl")
+registry.register("spray", "model/best_window_model.pkl")
+registry.register("fertilizer", "model/fertilizer_model.pkl")
+registry.register("crop", "model/crop_model.pkl")
+
+# Concurrent one-row predictions from the request threads are predicted together
+yield_batcher = model_batcher("yield")
+fert_batcher = model_batcher("fert", schema=FERTILIZER_SCHEMA)
+stress_batcher = model_batcher("stress", schema=STRESS_SCHEMA)
 @app.route('/recommend_crop')
 def recommend_crop():
     # Get input features from request.args
@@ -37,7 +51,9 @@ def recommend_crop():
         features = [float(request.args.get(f)) for f in ['N','P','K','temperature','humidity','ph','rainfall','ozone']]
     except Exception:
         return jsonify({'error': 'Invalid or missing input'}), 400
-    pred = crop_model.predict([features])[0]
+    if not registry.exists("crop"):
+        return jsonify({'error': 'Crop recommendation model not found'}), 503
+    pred = registry.get("crop").predict([features])[0]
     return jsonify({'recommended_crop': pred})
 @app.route('/best_time_to_spray')
 def best_time_to_spray():
@@ -49,22 +65,19 @@ def best_time_to_spray():
     if hourly_data.empty:
         return jsonify({'result': 'No hourly forecast data available.', 'window': None})
     # Predict probability for each hour
-    hourly_data['probability'] = time_model.predict_proba(
+    hourly_data['probability'] = registry.get("spray").predict_proba(
         hourly_data[["hour", "temp", "humidity", "wind", "ozone", "rain"]]
     )[:, 1]
-    best_window = None
-    best_score = -1
-    for i in range(len(hourly_data) - 2):
-        window = hourly_data.iloc[i:i+3]
-        avg_prob = window['probability'].mean()
-        if avg_prob > best_score:
-            best_score = avg_prob
-            best_window = f"{int(window.iloc[0]['hour'])}:00 to {int(window.iloc[2]['hour']) + 1}:00"
-    if best_score >= 0.5:
-        msg = f"Best 3-hour window to spray: {best_window} (Confidence: {best_score:.2f})"
-    else:
-        msg = f"No ideal 3-hour window, but highest confidence: {best_window} (Confidence: {best_score:.2f})"
-    return jsonify({'result': msg, 'window': best_window, 'confidence': best_score})
+    record_prediction(lat, lon, "spray", values=hourly_data['probability'], valid_times=hourly_data['time'])
+    width = request.args.get('hours', SPRAY_WINDOW_HOURS, type=int)
+    try:
+        windows = spray_windows(hourly_data, width=width, top=request.args.get('top', 1, type=int),
+                                per_day=request.args.get('per_day', 'false').lower() == 'true',
+                                daylight=request.args.get('daylight', 'false').lower() == 'true',
+                                rain_free_hours=request.args.get('rain_free_hours', type=int))
+    except ValueError as e:
+        return jsonify({'result': None, 'window': None, 'error': str(e)}), 400
+    return jsonify(spray_response(windows, width))
 
 @app.route('/predict_yield')
 def predict_yield():
@@ -77,8 +90,8 @@ def predict_yield():
         return jsonify({'result': None}), 400
     temp = weather['temp']
     rain = weather['rain']
-    features = pd.DataFrame([[ozone, temp, rain, soil]], columns=["ozone", "temp", "rain", "soil"])
-    prediction = yield_model.predict(features)[0]
+    prediction = yield_batcher.predict({"ozone": ozone, "temp": temp, "rain": rain, "soil": soil})
+    record_prediction(lat, lon, "yield", values=[prediction])
     return jsonify({'result': f"Predicted Potato Yield: {prediction:.2f} tonnes/hectare"})
 
 @app.route('/recommend_fertilizer')
@@ -94,15 +107,19 @@ def recommend_fertilizer_api():
         return jsonify({'result': None}), 400
     temp = weather['temp']
     rain = weather['rain']
-    input_df = pd.DataFrame([{
+    inputs = {
         "ozone": ozone,
         "temp": temp,
         "rain": rain,
         "soil": soil,
         "ph": ph,
         "stage": stage
-    }])
-    result = recommend_fertilizer(input_df, fert_model)
+    }
+    try:
+        result = fert_batcher.predict(inputs)
+    except UnknownCategoryError as e:
+        return jsonify({'result': None, 'error': str(e)}), 400
+    record_prediction(lat, lon, "fertilizer", labels=[result])
     return jsonify({'result': f"Recommended Fertilizer: {result}"})
 
 @app.route('/predict_stress')
@@ -114,10 +131,58 @@ def predict_stress():
     humidity = request.args.get('humidity', type=float)
     color = request.args.get('color', type=str)
     symptom = request.args.get('symptom', type=str)
-    input_df = pd.DataFrame([[ozone, temp, humidity, color, symptom]],
-                            columns=["ozone", "temp", "humidity", "color", "symptom"])
-    level, explanation = predict_stress_level(stress_model, input_df)
+    inputs = {"ozone": ozone, "temp": temp, "humidity": humidity, "color": color, "symptom": symptom}
+    level = stress_batcher.predict(inputs)
+    explanation = stress_explanation(level)
     return jsonify({'result': f"Stress Level: {level}", 'explanation': explanation})
 
+# --- Bulk endpoints: POST {"rows": [...], "fields": {...}}, see bulk.py ---
+def _bulk(score):
+    try:
+        rows, fields = parse_request(request.get_json(silent=True))
+    except BulkRequestError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(score(rows, fields))
+
+@app.route('/predict_yield/batch', methods=['POST'])
+def predict_yield_batch():
+    return _bulk(bulk_yield)
+
+@app.route('/recommend_fertilizer/batch', methods=['POST'])
+def recommend_fertilizer_batch():
+    return _bulk(bulk_fertilizer)
+
+@app.route('/predict_stress/batch', methods=['POST'])
+def predict_stress_batch():
+    return _bulk(bulk_stress)
+
+@app.route('/recommend_crop/batch', methods=['POST'])
+def recommend_crop_batch():
+    if not registry.exists("crop"):
+        return jsonify({'error': 'Crop recommendation model not found'}), 503
+    return _bulk(bulk_crop)
+
+@app.route('/best_time_to_spray/batch', methods=['POST'])
+def best_time_to_spray_batch():
+    return _bulk(bulk_spray)
+
+@app.route('/prediction_cache/stats')
+def prediction_cache_stats():
+    return jsonify(prediction_cache.stats())
+
+@app.route('/spray_schedule', methods=['POST'])
+def spray_schedule():
+    try:
+        return jsonify(schedule_request(request.get_json(silent=True), load_saved_fields))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/sensitivity', methods=['POST'])
+def sensitivity_api():
+    try:
+        return jsonify(sensitivity_request(request.get_json(silent=True)))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
 if __name__ == '__main__':
     app.run(debug=True)
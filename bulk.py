@@ -0,0 +1,276 @@
+"""Bulk scoring for the ``POST .../batch`` endpoints in main_fastapi.py and app_web.py.
+
+A request body looks like::
+
+    {"fields": {"north": {"lat": 12.97, "lon": 77.59}},
+     "rows": [{"id": "a", "field": "north", "ozone": 40, "soil": 0.3},
+              {"id": "b", "lat": 13.01, "lon": 77.61, "ozone": 55, "soil": 0.25}]}
+
+Each row names a ``field`` (from the request's ``fields`` or the saved
+fields file) or gives ``lat``/``lon`` itself, plus the model inputs. Weather
+is fetched once per grid cell for the whole batch, every row is encoded
+into one matrix and the model is called once. Results come back in row
+order as ``{"id": ..., <outputs>}`` or ``{"id": ..., "error": "..."}``, so
+one bad row never fails the batch.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from batching import predict_items
+from model_registry import registry
+from spray_windows import IDEAL_CONFIDENCE, SPRAY_WINDOW_HOURS, best_in_segments, window_label
+from utils import (FERTILIZER_SCHEMA, STRESS_SCHEMA, fetch_forecast_bundles, record_predictions_many,
+                   stress_explanation)
+
+# ---------------------- CONFIG ----------------------
+BULK_MAX_ROWS = int(os.environ.get("BULK_MAX_ROWS", 10000))
+# Saved fields that rows can refer to by name when the request has no "fields" entry for them
+BULK_FIELDS_FILE = os.environ.get(
+    "BULK_FIELDS_FILE",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "actual", "data", "fields.json"),
+)
+CROP_FEATURES = ["N", "P", "K", "temperature", "humidity", "ph", "rainfall", "ozone"]
+SPRAY_FEATURES = ["hour", "temp", "humidity", "wind", "ozone", "rain"]
+# -----------------------------------------------------
+
+
+class BulkRequestError(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_request(body):
+    """Validate a request body -> (rows, fields)."""
+    if isinstance(body, list):
+        body = {"rows": body}
+    if not isinstance(body, dict) or not isinstance(body.get("rows"), list):
+        raise BulkRequestError("Body must be {'rows': [...]} (optionally with 'fields')")
+    rows = body["rows"]
+    if len(rows) > BULK_MAX_ROWS:
+        raise BulkRequestError(f"At most {BULK_MAX_ROWS} rows per request, got {len(rows)}", status=413)
+    if not all(isinstance(row, dict) for row in rows):
+        raise BulkRequestError("Every row must be an object")
+    fields = body.get("fields") or {}
+    if not isinstance(fields, dict):
+        raise BulkRequestError("'fields' must map field names to {'lat', 'lon'}")
+    return rows, fields
+
+
+def load_saved_fields(path=BULK_FIELDS_FILE):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _row_id(row, i):
+    return row.get("id", row.get("field", i))
+
+
+def _locate(rows, fields):
+    """(lat, lon) per row, or None plus an entry in ``errors``."""
+    locations = [None] * len(rows)
+    errors = {}
+    saved = None
+    for i, row in enumerate(rows):
+        try:
+            if row.get("field") is not None:
+                field = fields.get(row["field"])
+                if field is None:
+                    saved = load_saved_fields() if saved is None else saved
+                    field = saved.get(row["field"])
+                if field is None:
+                    errors[i] = f"Unknown field '{row['field']}'"
+                    continue
+                locations[i] = (float(field["lat"]), float(field["lon"]))
+            elif row.get("lat") is not None and row.get("lon") is not None:
+                locations[i] = (float(row["lat"]), float(row["lon"]))
+            else:
+                errors[i] = "Row needs a 'field' or 'lat' and 'lon'"
+        except (KeyError, TypeError, ValueError):
+            errors[i] = "Invalid location"
+    return locations, errors
+
+
+def _bundles(locations):
+    """One forecast bundle per distinct location, fetched per grid cell in a few upstream calls."""
+    unique = list(dict.fromkeys(loc for loc in locations if loc is not None))
+    fetched = fetch_forecast_bundles({str(k): {"lat": lat, "lon": lon} for k, (lat, lon) in enumerate(unique)})
+    return {loc: fetched[str(k)] for k, loc in enumerate(unique)}
+
+
+def _current_weather(locations, errors):
+    weather = {}
+    for loc, bundle in _bundles(locations).items():
+        try:
+            weather[loc] = bundle.current() if bundle is not None else None
+        except Exception as e:
+            print("Error reading current weather:", e)
+            weather[loc] = None
+    current = [None] * len(locations)
+    for i, loc in enumerate(locations):
+        if loc is None:
+            continue
+        if weather.get(loc) is None:
+            errors[i] = "Weather data unavailable"
+        else:
+            current[i] = weather[loc]
+    return current
+
+
+def _score(rows, inputs, errors, model_name, schema=None):
+    """Predict every row without an error in one call -> {row index: prediction}."""
+    positions = [i for i in range(len(rows)) if i not in errors]
+    if not positions:
+        return {}
+    out = predict_items(registry.get(model_name), [inputs[i] for i in positions], schema=schema)
+    predictions = {}
+    for i, value in zip(positions, out):
+        if isinstance(value, Exception):
+            errors[i] = str(value)
+        else:
+            predictions[i] = value
+    return predictions
+
+
+def _results(rows, errors, outputs):
+    results = []
+    for i, row in enumerate(rows):
+        if i in errors:
+            results.append({"id": _row_id(row, i), "error": errors[i]})
+        else:
+            results.append({"id": _row_id(row, i), **outputs[i]})
+    return results
+
+
+def _record(kind, locations, predictions, labels=False):
+    """One history write for the whole batch."""
+    located = [i for i in predictions if locations[i] is not None]
+    output = [predictions[i] for i in located]
+    record_predictions_many(kind, [locations[i] for i in located],
+                            labels=output if labels else None, values=None if labels else output)
+
+
+def _summary(results, **extra):
+    failed = sum(1 for r in results if "error" in r)
+    return {"count": len(results), "failed": failed, **extra, "results": results}
+
+
+# ---------------------- MODELS ----------------------
+def bulk_yield(rows, fields=None):
+    """Rows need ozone and soil; temp and rain come from the current weather at the row's location."""
+    locations, errors = _locate(rows, fields or {})
+    current = _current_weather(locations, errors)
+    inputs = [{"ozone": row.get("ozone"), "soil": row.get("soil"),
+               "temp": w["temp"] if w else None, "rain": w["rain"] if w else None}
+              for row, w in zip(rows, current)]
+    predictions = _score(rows, inputs, errors, "yield")
+    _record("yield", locations, predictions)
+    outputs = {i: {"yield": float(p), "temp": current[i]["temp"], "rain": current[i]["rain"]}
+               for i, p in predictions.items()}
+    return _summary(_results(rows, errors, outputs), locations=len(set(filter(None, locations))))
+
+
+def bulk_fertilizer(rows, fields=None):
+    """Rows need ozone, soil, ph and stage; temp and rain come from the current weather."""
+    locations, errors = _locate(rows, fields or {})
+    current = _current_weather(locations, errors)
+    inputs = [{"ozone": row.get("ozone"), "soil": row.get("soil"), "ph": row.get("ph"), "stage": row.get("stage"),
+               "temp": w["temp"] if w else None, "rain": w["rain"] if w else None}
+              for row, w in zip(rows, current)]
+    predictions = _score(rows, inputs, errors, "fert", FERTILIZER_SCHEMA)
+    _record("fertilizer", locations, predictions, labels=True)
+    outputs = {i: {"fertilizer": str(p)} for i, p in predictions.items()}
+    return _summary(_results(rows, errors, outputs), locations=len(set(filter(None, locations))))
+
+
+def bulk_stress(rows, fields=None):
+    """Rows carry every input (ozone, temp, humidity, color, symptom); a location is optional."""
+    locations, _ = _locate(rows, fields or {})
+    errors = {}
+    predictions = _score(rows, rows, errors, "stress", STRESS_SCHEMA)
+    _record("stress", locations, predictions, labels=True)
+    outputs = {i: {"stress_level": str(p), "explanation": stress_explanation(p)} for i, p in predictions.items()}
+    return _summary(_results(rows, errors, outputs))
+
+
+def bulk_crop(rows, fields=None):
+    """Rows carry N, P, K, temperature, humidity, ph, rainfall and ozone; no weather is needed."""
+    model = registry.get("crop")
+    errors = {}
+    X = np.empty((len(rows), len(CROP_FEATURES)), dtype=np.float64)
+    for i, row in enumerate(rows):
+        try:
+            X[i] = [float(row[f]) for f in CROP_FEATURES]
+        except KeyError as e:
+            errors[i] = f"Missing input {e}"
+        except (TypeError, ValueError):
+            errors[i] = "Invalid or missing input"
+    positions = [i for i in range(len(rows)) if i not in errors]
+    outputs = {}
+    if positions:
+        for i, crop in zip(positions, model.predict(pd.DataFrame(X[positions], columns=CROP_FEATURES))):
+            outputs[i] = {"recommended_crop": str(crop)}
+    return _summary(_results(rows, errors, outputs))
+
+
+def bulk_spray(rows, fields=None):
+    """Best 3-hour spray window per row's location, from one predict_proba over every distinct forecast."""
+    locations, errors = _locate(rows, fields or {})
+    bundles = _bundles(locations)
+    # Locations in the same grid cell share a bundle, and so the same forecast and window
+    frames, cells = [], {}
+    for loc, bundle in bundles.items():
+        if bundle is None or id(bundle) in cells:
+            continue
+        try:
+            frame = bundle.hourly()
+        except Exception as e:
+            print("Error reading hourly forecast:", e)
+            continue
+        if not frame.empty:
+            cells[id(bundle)] = len(frames)
+            frames.append(frame)
+
+    windows = {}
+    if frames:
+        lengths = np.array([len(f) for f in frames])
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        model = registry.get("spray")
+        X = pd.concat([f[SPRAY_FEATURES] for f in frames], ignore_index=True)
+        probability = model.predict_proba(X)[:, 1]
+        for k, (offset, score) in enumerate(best_in_segments(probability, starts, lengths)):
+            if offset is None:
+                continue
+            window = window_label(frames[k]["hour"].to_numpy(), offset)
+            hours_in_window = slice(offset, offset + SPRAY_WINDOW_HOURS)
+            windows[k] = {"window": window, "confidence": score, "ideal": score >= IDEAL_CONFIDENCE,
+                          "probability": probability[starts[k]:starts[k] + lengths[k]][hours_in_window],
+                          "time": frames[k]["time"].dt.tz_convert("UTC").dt.tz_localize(None)
+                                  .to_numpy()[hours_in_window]}
+
+    outputs = {}
+    recorded = {}
+    for i, loc in enumerate(locations):
+        if loc is None:
+            continue
+        k = cells.get(id(bundles[loc]))
+        if k is None or k not in windows:
+            errors[i] = "No hourly forecast data available"
+            continue
+        best = windows[k]
+        outputs[i] = {"window": best["window"], "confidence": best["confidence"], "ideal": best["ideal"]}
+        recorded[loc] = k
+    if recorded:
+        # Only the chosen window's hours per location; a full forecast for each of thousands
+        # of fields would be hundreds of thousands of history rows per request
+        segments = list(recorded.values())
+        record_predictions_many("spray", [loc for loc in recorded for _ in range(SPRAY_WINDOW_HOURS)],
+                                values=np.concatenate([windows[k]["probability"] for k in segments]),
+                                valid_times=np.concatenate([windows[k]["time"] for k in segments]))
+    return _summary(_results(rows, errors, outputs), locations=len(bundles), forecasts=len(frames))
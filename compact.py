@@ -0,0 +1,354 @@
+"""Shrink the RandomForest pickles in model/ within an accuracy budget.
+
+Most of the forests are far bigger than what they model needs: the yield
+forest has 100 unbounded-depth trees for a four-input, nearly linear
+target. ``compact`` searches the number of trees, a maximum depth and
+sibling-leaf merging, scores every candidate against the original forest
+on held-out probe inputs, and keeps the smallest one whose outputs stay
+within ``--tolerance``. The result is a plain sklearn forest, so the
+registry and FlatForest load it like the original.
+
+    python compact.py                              # every forest in model/, 1% tolerance
+    python compact.py model/yield_model.pkl --tolerance 0.02 --out model/yield_model.pkl
+
+Fidelity is the share of probe inputs whose class matches the original
+(classifiers) or R^2 against the original's predictions (regressors); the
+tolerance is how much of it may be lost. Each run writes
+``<name>.compact.pkl`` plus a ``<name>.compact.json`` report of size, load
+time and predict latency before and after, unless ``--out`` says otherwise.
+Where a model's training generator is in the repo (LABELLED_DATA), the
+report also gives the original's and the compacted forest's accuracy on
+freshly drawn labelled rows.
+"""
+import argparse
+import copy
+import glob
+import json
+import os
+import time
+import timeit
+import warnings
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.tree._tree import Tree
+
+from flat_forest import FlatForest, is_flattenable, split_ranges
+
+# ---------------------- CONFIG ----------------------
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "model")
+DEFAULT_TOLERANCE = 0.01
+PROBE_ROWS = 20000            # split in half: one half picks the candidate, the other reports on it
+LABELLED_ROWS = 5000          # fresh labelled rows from a model's training generator, when there is one
+TREE_COUNTS = (5, 10, 15, 20, 30, 40, 50, 75)
+MAX_DEPTHS = (3, 4, 5, 6, 8, 10, 12, 15)
+# Sibling leaves closer than this are merged: a share of the prediction spread
+# (regressors) or a difference in class probability (classifiers)
+MERGE_STEPS = (0.0, 0.01, 0.02, 0.05, 0.1)
+TREE_LEAF = -1
+TREE_UNDEFINED = -2
+# -----------------------------------------------------
+
+
+# ---------------------- PROBE INPUTS ----------------------
+def one_hot_groups(names):
+    """{prefix: [column indices]} for ``prefix_value`` columns that come in groups (get_dummies output)."""
+    groups = {}
+    for i, name in enumerate(names):
+        if "_" in name:
+            groups.setdefault(name.rsplit("_", 1)[0], []).append(i)
+    return {prefix: columns for prefix, columns in groups.items() if len(columns) > 1}
+
+
+def probe_inputs(model, n, rng):
+    """Inputs spread a little past every split range, with one column set per one-hot group."""
+    names = [str(f) for f in getattr(model, "feature_names_in_", range(model.n_features_in_))]
+    groups = one_hot_groups(names)
+    one_hot = {i for columns in groups.values() for i in columns}
+    X = np.zeros((n, len(names)))
+    for j, r in enumerate(split_ranges(model)):
+        if j in one_hot:
+            continue
+        lo, hi = r if r is not None else (0.0, 1.0)
+        margin = 0.1 * (hi - lo) or 1.0
+        X[:, j] = rng.uniform(lo - margin, hi + margin, n)
+    for columns in groups.values():
+        X[np.arange(n), rng.choice(columns, n)] = 1.0
+    return pd.DataFrame(X, columns=names) if hasattr(model, "feature_names_in_") else X
+
+
+# ---------------------- LABELLED DATA ----------------------
+def yield_rows(n, seed):
+    """New draws from data/sample_data.py, the generator model/model_training.py fits yield_model on."""
+    from data.sample_data import generate_data
+
+    np.random.seed(seed)
+    df = generate_data(n)
+    return df[["ozone", "temp", "rain", "soil"]], df["yield"]
+
+
+def spray_rows(n, seed):
+    """New draws from the simulation and labelling rule of model/best_time_model_training.py."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "hour": rng.integers(0, 24, n),
+        "temp": rng.uniform(15, 35, n),
+        "humidity": rng.uniform(30, 90, n),
+        "wind": rng.uniform(0, 10, n),
+        "ozone": rng.uniform(30, 100, n),
+        "rain": rng.uniform(0, 10, n),
+    })
+    spray = ((df["rain"] < 2) & (df["wind"] < 4) & (df["humidity"] > 40) & (df["ozone"] < 70)).astype(int)
+    return df, spray
+
+
+# Models whose training data can be drawn again. data/fertilizer.csv has none of
+# fertilizer_model's features, and fert_model was fitted to random labels.
+LABELLED_DATA = {
+    "yield_model.pkl": ("data/sample_data.generate_data", yield_rows),
+    "time_model.pkl": ("model/best_time_model_training.py rule", spray_rows),
+    "best_window_model.pkl": ("model/best_time_model_training.py rule", spray_rows),
+}
+
+
+def labelled_score(model, X, y):
+    """Accuracy (classifiers) or R^2 (regressors) against true labels."""
+    predicted = model.predict(X)
+    if hasattr(model, "classes_"):
+        return float((predicted == np.asarray(y)).mean())
+    y = np.asarray(y, dtype=np.float64)
+    return float(1.0 - ((y - predicted) ** 2).sum() / ((y - y.mean()) ** 2).sum())
+
+
+# ---------------------- PRUNING ----------------------
+def node_depths(left, right):
+    depth = np.zeros(len(left), dtype=np.intp)
+    for i in range(len(left)):
+        if left[i] != TREE_LEAF:
+            depth[left[i]] = depth[right[i]] = depth[i] + 1
+    return depth
+
+
+def leaf_mask(tree, max_depth=None, merge=0.0):
+    """Nodes that become leaves: every node at ``max_depth`` and parents of near-identical leaves."""
+    left, right = tree.children_left, tree.children_right
+    leaf = left == TREE_LEAF
+    if max_depth is not None:
+        leaf |= node_depths(left, right) >= max_depth
+    if merge > 0:
+        value = tree.value[:, 0, :]
+        # Children always come after their parent, so one backwards pass merges bottom-up
+        for i in range(tree.node_count - 1, -1, -1):
+            if not leaf[i] and leaf[left[i]] and leaf[right[i]] \
+                    and np.abs(value[left[i]] - value[right[i]]).max() <= merge:
+                leaf[i] = True
+    return leaf
+
+
+def pruned_tree(tree, leaf):
+    """A new sklearn Tree keeping only the nodes reachable above ``leaf``; internal values are the node means."""
+    state = tree.__getstate__()
+    nodes, values = state["nodes"], state["values"]
+    keep, stack = [], [0]
+    while stack:
+        i = stack.pop()
+        keep.append(i)
+        if not leaf[i]:
+            stack.extend((nodes["right_child"][i], nodes["left_child"][i]))
+    keep = np.array(keep, dtype=np.intp)
+    new_id = np.full(tree.node_count, -1, dtype=np.intp)
+    new_id[keep] = np.arange(len(keep))
+
+    new_nodes = nodes[keep].copy()
+    cut = leaf[keep]
+    for column in ("left_child", "right_child"):
+        new_nodes[column] = np.where(cut, TREE_LEAF, new_id[nodes[column][keep]])
+    new_nodes["feature"][cut] = TREE_UNDEFINED
+    new_nodes["threshold"][cut] = TREE_UNDEFINED
+    depth = node_depths(new_nodes["left_child"], new_nodes["right_child"])
+    pruned = Tree(tree.n_features, np.asarray(tree.n_classes, dtype=np.intp), tree.n_outputs)
+    pruned.__setstate__({"max_depth": int(depth.max()), "node_count": len(keep), "nodes": new_nodes,
+                         "values": np.ascontiguousarray(values[keep])})
+    return pruned
+
+
+def compacted(model, n_trees, max_depth=None, merge=0.0):
+    """A copy of ``model`` with its first ``n_trees`` trees, each pruned."""
+    small = copy.copy(model)
+    small.estimators_ = []
+    for estimator in model.estimators_[:n_trees]:
+        estimator = copy.copy(estimator)
+        estimator.tree_ = pruned_tree(estimator.tree_, leaf_mask(estimator.tree_, max_depth, merge))
+        small.estimators_.append(estimator)
+    small.n_estimators = len(small.estimators_)
+    return small
+
+
+def node_count(model):
+    return sum(e.tree_.node_count for e in model.estimators_)
+
+
+# ---------------------- SEARCH ----------------------
+def _tree_outputs(trees, X):
+    """Per-tree outputs: (n_trees, n_rows, n_classes) class probabilities or (n_trees, n_rows) values."""
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    out = np.stack([t.predict(X) for t in trees])
+    if out.shape[-1] == 1:
+        return out.reshape(len(trees), -1)
+    if out.ndim == 4:
+        out = out[:, :, 0, :]
+    return out / np.clip(out.sum(axis=2, keepdims=True), 1e-12, None)
+
+
+def fidelity(reference, candidate, classifier):
+    """Class agreement, or R^2 of ``candidate`` against ``reference`` predictions."""
+    if classifier:
+        return float((reference.argmax(axis=1) == candidate.argmax(axis=1)).mean())
+    spread = ((reference - reference.mean()) ** 2).sum()
+    return float(1.0 - ((reference - candidate) ** 2).sum() / spread) if spread else 1.0
+
+
+def search(model, X_search, tolerance, tree_counts=TREE_COUNTS, max_depths=MAX_DEPTHS, merge_steps=MERGE_STEPS):
+    """Smallest (n_trees, max_depth, merge) whose fidelity on ``X_search`` is at least 1 - tolerance.
+
+    Each pruning setting is applied to every tree once; the per-tree
+    outputs are then averaged over the first k trees for every k.
+    """
+    classifier = hasattr(model, "classes_")
+    X = np.ascontiguousarray(X_search, dtype=np.float32)
+    reference = _tree_outputs([e.tree_ for e in model.estimators_], X).mean(axis=0)
+    scale = 1.0 if classifier else float(reference.std()) or 1.0
+    deepest = max(e.tree_.max_depth for e in model.estimators_)
+    counts = sorted({k for k in tree_counts if k < len(model.estimators_)} | {len(model.estimators_)})
+    depths = [d for d in max_depths if d < deepest] + [None]
+
+    best = None
+    for depth in depths:
+        for step in merge_steps:
+            merge = step * scale
+            trees = [pruned_tree(e.tree_, leaf_mask(e.tree_, depth, merge)) for e in model.estimators_]
+            sizes = np.cumsum([t.node_count for t in trees])
+            running = np.cumsum(_tree_outputs(trees, X), axis=0)
+            for k in counts:
+                score = fidelity(reference, running[k - 1] / k, classifier)
+                if score >= 1.0 - tolerance:
+                    candidate = (int(sizes[k - 1]), -score, k, depth or deepest, merge)
+                    if best is None or candidate < best:
+                        best = candidate
+                    break   # more trees at this setting only grow the model
+    if best is None:
+        return None
+    size, score, k, depth, merge = best
+    return {"n_trees": k, "max_depth": None if depth == deepest else depth, "merge": merge, "nodes": size, "search_fidelity": -score}
+
+
+# ---------------------- REPORT ----------------------
+def _timings(path, model, X, repeat=20):
+    start = time.perf_counter()
+    joblib.load(path)
+    load = time.perf_counter() - start
+    one, batch = X.iloc[:1] if isinstance(X, pd.DataFrame) else X[:1], X[:1000]
+    flat = FlatForest.from_sklearn(model)
+    return {
+        "bytes": os.path.getsize(path),
+        "load_ms": load * 1e3,
+        "nodes": node_count(model),
+        "trees": len(model.estimators_),
+        "max_depth": max(e.tree_.max_depth for e in model.estimators_),
+        "predict_1_ms": timeit.timeit(lambda: model.predict(one), number=repeat) / repeat * 1e3,
+        "predict_1000_ms": timeit.timeit(lambda: model.predict(batch), number=max(1, repeat // 4))
+                           / max(1, repeat // 4) * 1e3,
+        "flat_predict_1_ms": timeit.timeit(lambda: flat.predict(one), number=repeat) / repeat * 1e3,
+    }
+
+
+def compact(path, tolerance=DEFAULT_TOLERANCE, out=None, probes=PROBE_ROWS, seed=0):
+    """Search, write the compacted pickle and its JSON report; returns the report (None if not a forest)."""
+    model = joblib.load(path)
+    if not is_flattenable(model):
+        print(f"{os.path.basename(path)}: not a single-output RandomForest, skipped")
+        return None
+    rng = np.random.default_rng(seed)
+    X = probe_inputs(model, probes, rng)
+    half = probes // 2
+    X_search, X_held_out = (X.iloc[:half], X.iloc[half:]) if isinstance(X, pd.DataFrame) else (X[:half], X[half:])
+
+    choice = search(model, X_search, tolerance)
+    classifier = hasattr(model, "classes_")
+    if choice is None:
+        choice = {"n_trees": len(model.estimators_), "max_depth": None, "merge": 0.0, "nodes": node_count(model),
+                  "search_fidelity": 1.0}
+    small = compacted(model, choice["n_trees"], choice["max_depth"], choice["merge"])
+
+    if classifier:
+        held_out = float((model.predict(X_held_out) == small.predict(X_held_out)).mean())
+    else:
+        held_out = fidelity(model.predict(X_held_out), small.predict(X_held_out), classifier=False)
+
+    labelled = None
+    if os.path.basename(path) in LABELLED_DATA:
+        source, rows = LABELLED_DATA[os.path.basename(path)]
+        X_labelled, y_labelled = rows(LABELLED_ROWS, 1000 + seed)
+        labelled = {"source": source, "rows": LABELLED_ROWS, "metric": "accuracy" if classifier else "R^2",
+                    "original": labelled_score(model, X_labelled, y_labelled),
+                    "compacted": labelled_score(small, X_labelled, y_labelled)}
+
+    # Measure the original before writing: --out may overwrite it
+    original = _timings(path, model, X_held_out)
+    out = out or f"{os.path.splitext(path)[0]}.compact.pkl"
+    tmp = f"{out}.{os.getpid()}.tmp"
+    joblib.dump(small, tmp)
+    os.replace(tmp, out)
+    report = {
+        "source": os.path.relpath(path),
+        "output": os.path.relpath(out),
+        "metric": "class agreement" if classifier else "R^2 vs original",
+        "tolerance": tolerance,
+        "choice": choice,
+        "held_out_fidelity": held_out,
+        "within_tolerance": held_out >= 1.0 - tolerance,
+        "labelled": labelled,
+        "original": original,
+        "compacted": _timings(out, small, X_held_out),
+    }
+    with open(f"{os.path.splitext(out)[0]}.json", "w") as f:
+        json.dump(report, f, indent=2)
+    return report
+
+
+def _print_report(report):
+    a, b = report["original"], report["compacted"]
+    c = report["choice"]
+    print(f"{report['source']} -> {report['output']}")
+    print(f"  {c['n_trees']} trees, max depth {c['max_depth'] or 'unbounded'}, merge {c['merge']:.3g}: "
+          f"held-out {report['metric']} {report['held_out_fidelity']:.4f} "
+          f"({'within' if report['within_tolerance'] else 'OUTSIDE'} tolerance {report['tolerance']})")
+    if report["labelled"]:
+        d = report["labelled"]
+        print(f"  {d['metric']} on {d['rows']} new rows from {d['source']}: {d['original']:.4f} -> {d['compacted']:.4f}")
+    for label, key, fmt in (("size", "bytes", "{:,.0f} B"), ("nodes", "nodes", "{:,}"), ("load", "load_ms", "{:.1f} ms"),
+                            ("predict 1 row", "predict_1_ms", "{:.2f} ms"),
+                            ("predict 1000 rows", "predict_1000_ms", "{:.2f} ms"),
+                            ("flat predict 1 row", "flat_predict_1_ms", "{:.3f} ms")):
+        print(f"  {label:<19} {fmt.format(a[key]):>14} -> {fmt.format(b[key]):>14}  (x{a[key] / max(b[key], 1e-9):.1f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact RandomForest pickles within an accuracy tolerance.")
+    parser.add_argument("models", nargs="*", help="pickles to compact (default: every model/*.pkl)")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fidelity that may be lost against the original (default 0.01)")
+    parser.add_argument("--out", help="output path (one model only); default <name>.compact.pkl")
+    parser.add_argument("--probes", type=int, default=PROBE_ROWS, help="probe inputs, half of them held out")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    warnings.filterwarnings("ignore")
+    paths = args.models or sorted(p for p in glob.glob(os.path.join(MODEL_DIR, "*.pkl")) if ".compact" not in p)
+    if args.out and len(paths) != 1:
+        parser.error("--out needs exactly one model")
+    for path in paths:
+        report = compact(path, args.tolerance, args.out, args.probes, args.seed)
+        if report is not None:
+            _print_report(report)
@@ -0,0 +1,193 @@
+"""Compiled feature layouts for models trained on ``pd.get_dummies`` output.
+
+A ``FeatureSchema`` is built once per model from its ``feature_names_in_``
+and maps raw inputs (numbers plus categorical labels such as ``stage``,
+``color`` and ``symptom``) straight into the model's column order, one
+preallocated NumPy row at a time or a whole batch at once.
+"""
+import threading
+import weakref
+from collections import Counter
+from collections.abc import Mapping
+
+import numpy as np
+import pandas as pd
+
+from flat_forest import FlatForest
+
+# Distinct unknown labels remembered per input; later ones are counted under UNKNOWN_OTHER
+MAX_UNKNOWN_TRACKED = 100
+UNKNOWN_OTHER = "<other>"
+
+
+class UnknownCategoryError(ValueError):
+    def __init__(self, column, value, known):
+        super().__init__(f"Unknown {column} '{value}'; expected one of: {', '.join(known)}")
+        self.column = column
+        self.value = value
+        self.known = known
+
+
+class FeatureSchema:
+    """Raw inputs -> the column layout a model was trained on.
+
+    Numeric inputs fill one column each. A categorical input ``name`` fills
+    the matching one-hot column ``name_<value>`` after ``aliases`` have
+    mapped UI labels onto the labels the model was trained with. A value
+    with no column is an unknown category, and ``unknown`` decides what
+    happens: ``"error"`` raises UnknownCategoryError, ``"zero"`` leaves every
+    one-hot column of that input at 0 (what get_dummies + reindex did
+    silently). Either way it is counted in ``unknown_seen``, which keeps
+    the first MAX_UNKNOWN_TRACKED distinct labels per input and lumps the
+    rest under UNKNOWN_OTHER, so arbitrary user strings cannot grow it.
+
+    Inputs the model has no column for are ignored. A missing numeric input
+    is an error unless ``defaults`` gives a value for it.
+    """
+
+    def __init__(self, feature_names, categorical=(), aliases=None, unknown="error", defaults=None):
+        if unknown not in ("error", "zero"):
+            raise ValueError("unknown must be 'error' or 'zero'")
+        self.feature_names = [str(f) for f in feature_names]
+        self.unknown = unknown
+        self.aliases = {name: dict(mapping) for name, mapping in (aliases or {}).items()}
+        self.defaults = dict(defaults or {})
+        self.unknown_seen = Counter()
+        self._tracked = Counter()
+        self._lock = threading.Lock()
+
+        index = {name: i for i, name in enumerate(self.feature_names)}
+        self.categories = {}
+        for name in categorical:
+            prefix = f"{name}_"
+            columns = {f[len(prefix):]: i for f, i in index.items() if f.startswith(prefix)}
+            if columns:
+                self.categories[name] = columns
+        one_hot = {i for columns in self.categories.values() for i in columns.values()}
+        self.numeric = {f: i for f, i in index.items() if i not in one_hot}
+
+        self._template = np.zeros(len(self.feature_names), dtype=np.float32)
+        for name, value in self.defaults.items():
+            if name in self.numeric:
+                self._template[self.numeric[name]] = value
+
+    @property
+    def n_features(self):
+        return len(self.feature_names)
+
+    def _column_for(self, name, value):
+        value = self.aliases.get(name, {}).get(value, value)
+        column = self.categories[name].get(value)
+        if column is None:
+            with self._lock:
+                key = (name, value)
+                if key not in self.unknown_seen and self._tracked[name] >= MAX_UNKNOWN_TRACKED:
+                    key = (name, UNKNOWN_OTHER)
+                elif key not in self.unknown_seen:
+                    self._tracked[name] += 1
+                self.unknown_seen[key] += 1
+            if self.unknown == "error":
+                raise UnknownCategoryError(name, value, sorted(self.categories[name]))
+        return column
+
+    def _missing(self, name):
+        if name not in self.defaults:
+            raise ValueError(f"Missing input '{name}'")
+
+    def transform_one(self, inputs):
+        """One input mapping -> a (1, n_features) float32 row; no pandas involved."""
+        row = self._template.copy()
+        for name, column in self.numeric.items():
+            value = inputs.get(name)
+            if value is None:
+                self._missing(name)
+            else:
+                row[column] = value
+        for name in self.categories:
+            column = self._column_for(name, inputs.get(name))
+            if column is not None:
+                row[column] = 1.0
+        return row.reshape(1, -1)
+
+    def transform(self, data):
+        """A batch -> (n_rows, n_features) matrix.
+
+        ``data`` is a DataFrame, a mapping of column arrays, or a list of
+        input mappings.
+        """
+        if isinstance(data, pd.DataFrame):
+            columns = {c: data[c].to_numpy() for c in data.columns}
+            n = len(data)
+        elif isinstance(data, Mapping):
+            columns = {c: np.asarray(v) for c, v in data.items()}
+            n = len(next(iter(columns.values()))) if columns else 0
+        else:
+            n = len(data)
+            names = set(self.numeric) | set(self.categories)
+            columns = {c: np.array([row.get(c) for row in data], dtype=object) for c in names}
+
+        X = np.tile(self._template, (n, 1))
+        for name, column in self.numeric.items():
+            values = columns.get(name)
+            if values is None:
+                self._missing(name)
+                continue
+            missing = pd.isna(values)
+            if missing.any():
+                self._missing(name)
+                values = np.where(missing, self.defaults[name], values)
+            X[:, column] = np.asarray(values, dtype=np.float32)
+        rows = np.arange(n)
+        for name in self.categories:
+            values = columns.get(name)
+            if values is None:
+                values = np.full(n, None, dtype=object)
+            # Resolve each distinct label once; missing values (code -1) resolve like a None input
+            codes, labels = pd.factorize(np.asarray(values, dtype=object))
+            labels = list(labels)
+            if (codes < 0).any():
+                codes = np.where(codes < 0, len(labels), codes)
+                labels.append(None)
+            lookup = np.array([-1 if (c := self._column_for(name, label)) is None else c for label in labels],
+                              dtype=np.intp)
+            target = lookup[codes]
+            hit = target >= 0
+            X[rows[hit], target[hit]] = 1.0
+        return X
+
+    def model_input(self, model, X):
+        """FlatForest takes the matrix as-is; sklearn estimators get named columns so they don't warn."""
+        if isinstance(model, FlatForest) or not hasattr(model, "feature_names_in_"):
+            return X
+        return pd.DataFrame(X, columns=self.feature_names)
+
+
+_schemas = weakref.WeakKeyDictionary()
+_schemas_lock = threading.Lock()
+
+
+def _freeze(value):
+    """A hashable copy of schema options (dicts and lists become sorted / plain tuples)."""
+    if isinstance(value, Mapping):
+        return tuple(sorted((str(k), _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def compile_schema(model, **options):
+    """The FeatureSchema for ``model`` and ``options``, built on first use and dropped with the model.
+
+    Each distinct set of options gets its own schema. A model reloaded by
+    the registry is a new object, so it gets fresh schemas from its own
+    ``feature_names_in_``.
+    """
+    key = _freeze(options)
+    with _schemas_lock:
+        schemas = _schemas.get(model)
+        if schemas is None:
+            schemas = _schemas[model] = {}
+        schema = schemas.get(key)
+        if schema is None:
+            schema = schemas[key] = FeatureSchema(model.feature_names_in_, **options)
+        return schema
@@ -0,0 +1,246 @@
+"""Flat-array inference for the RandomForest models.
+
+sklearn's ``predict`` re-validates its input and dispatches tree by tree,
+which costs far more than the tree walk for the one-row requests the apps
+make. ``FlatForest`` concatenates every tree of a fitted forest into one set
+of contiguous node arrays and walks all trees for all rows at once, one
+NumPy step per tree level.
+
+    python flat_forest.py          # check against sklearn and benchmark every model
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+
+ARRAYS = ("feature", "threshold", "children", "value", "roots")
+
+
+def is_flattenable(model):
+    return isinstance(model, (RandomForestClassifier, RandomForestRegressor)) and model.n_outputs_ == 1
+
+
+def split_ranges(model):
+    """(lowest, highest) split threshold per input feature of a forest; None for features never split on.
+
+    Beyond these the forest's output no longer changes along that feature.
+    """
+    if isinstance(model, FlatForest):
+        split = model.children[0::2] != np.arange(len(model.feature))
+        features, thresholds = model.feature[split], model.threshold[split]
+    else:
+        trees = [e.tree_ for e in model.estimators_]
+        features = np.concatenate([t.feature[t.children_left >= 0] for t in trees])
+        thresholds = np.concatenate([t.threshold[t.children_left >= 0] for t in trees])
+    ranges = []
+    for j in range(model.n_features_in_):
+        t = thresholds[features == j]
+        ranges.append((float(t.min()), float(t.max())) if len(t) else None)
+    return ranges
+
+
+class FlatForest:
+    """A fitted forest as contiguous node arrays.
+
+    Node ``i`` of the whole forest splits on ``feature[i]`` at
+    ``threshold[i]`` and continues at ``children[2 * i + go_left]``, i.e.
+    the right child is stored first. Leaves point back at themselves, which
+    is how the walk notices a (row, tree) pair is done. ``value`` holds
+    each leaf's class probabilities (classifier) or prediction (regressor),
+    and ``roots`` the offset of each tree's first node.
+
+    Like sklearn, inputs are cast to float32 before comparing with
+    ``<= threshold``, so predictions match ``model.predict`` exactly up to
+    float rounding of the final average.
+    """
+
+    def __init__(self, feature, threshold, children, value, roots, max_depth,
+                 classes=None, feature_names=None, n_features=None):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.classes_ = None if classes is None else np.asarray(classes)
+        if self.classes_ is not None and self.classes_.dtype.kind in "US":
+            # sklearn keeps string labels as Python str objects
+            self.classes_ = self.classes_.astype(object)
+        self.feature_names_in_ = None if feature_names is None else np.asarray(feature_names, dtype=object)
+        self.n_features_in_ = int(n_features if n_features is not None else len(self.feature_names_in_))
+
+    @property
+    def is_classifier(self):
+        return self.classes_ is not None
+
+    @property
+    def n_estimators(self):
+        return len(self.roots)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        if not is_flattenable(model):
+            raise TypeError(f"Cannot flatten {type(model).__name__}")
+        classifier = isinstance(model, RandomForestClassifier)
+        features, thresholds, children, values, roots = [], [], [], [], []
+        offset = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            n = tree.node_count
+            ids = np.arange(n, dtype=np.int32)
+            leaf = tree.children_left < 0
+            features.append(np.where(leaf, 0, tree.feature).astype(np.int32))
+            thresholds.append(np.where(leaf, 0.0, tree.threshold))
+            pair = np.empty((n, 2), dtype=np.int32)
+            pair[:, 0] = np.where(leaf, ids, tree.children_right)
+            pair[:, 1] = np.where(leaf, ids, tree.children_left)
+            children.append(pair.ravel() + offset)
+            value = tree.value[:, 0, :]
+            if classifier:
+                # Same normalisation as DecisionTreeClassifier.predict_proba
+                total = value.sum(axis=1, keepdims=True)
+                value = value / np.where(total == 0, 1, total)
+            values.append(value)
+            roots.append(offset)
+            offset += n
+        return cls(
+            feature=np.concatenate(features),
+            threshold=np.concatenate(thresholds),
+            children=np.concatenate(children),
+            value=np.ascontiguousarray(np.concatenate(values)),
+            roots=np.array(roots, dtype=np.int32),
+            max_depth=max(e.tree_.max_depth for e in model.estimators_),
+            classes=model.classes_ if classifier else None,
+            feature_names=getattr(model, "feature_names_in_", None),
+            n_features=model.n_features_in_,
+        )
+
+    # ---------------------- INFERENCE ----------------------
+    def _as_array(self, X):
+        if isinstance(X, pd.DataFrame) and self.feature_names_in_ is not None:
+            X = X[list(self.feature_names_in_)]
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[1]} features, but the model expects {self.n_features_in_}")
+        return X
+
+    def apply(self, X):
+        """Leaf index (into the flat arrays) of every row in every tree: shape (n_rows, n_trees)."""
+        X = self._as_array(X)
+        n_rows, n_trees = X.shape[0], len(self.roots)
+        flat_X = X.ravel()
+        node = np.tile(self.roots, n_rows)
+        row_start = np.repeat(np.arange(n_rows, dtype=np.intp) * X.shape[1], n_trees)
+        # Only (row, tree) pairs that have not reached a leaf are advanced
+        active = np.arange(node.size)
+        for _ in range(self.max_depth):
+            current = node[active]
+            go_left = flat_X[row_start[active] + self.feature[current]] <= self.threshold[current]
+            nxt = self.children[2 * current + go_left]
+            node[active] = nxt
+            active = active[nxt != current]
+            if not active.size:
+                break
+        return node.reshape(n_rows, n_trees)
+
+    def _mean_leaf_value(self, X):
+        return self.value[self.apply(X)].mean(axis=1)
+
+    def predict_proba(self, X):
+        if not self.is_classifier:
+            raise AttributeError("predict_proba is only available for classifiers")
+        return self._mean_leaf_value(X)
+
+    def predict(self, X):
+        out = self._mean_leaf_value(X)
+        if self.is_classifier:
+            return self.classes_[np.argmax(out, axis=1)]
+        return out[:, 0]
+
+    # ---------------------- STORAGE ----------------------
+    def save(self, directory):
+        """One .npy per array plus meta.json, written to a temp dir and renamed into place."""
+        tmp = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(tmp, f"{name}.npy"), getattr(self, name))
+        meta = {
+            "max_depth": self.max_depth,
+            "classes": None if self.classes_ is None else self.classes_.tolist(),
+            "feature_names": None if self.feature_names_in_ is None else self.feature_names_in_.tolist(),
+            "n_features": self.n_features_in_,
+        }
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            # Another worker got there first; its copy is identical
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+    @classmethod
+    def load(cls, directory, mmap_mode="r"):
+        """Memory-mapped by default, so every worker shares the same node pages."""
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        arrays = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in ARRAYS}
+        return cls(**arrays, **meta)
+
+
+# ---------------------- BENCHMARK ----------------------
+def _sample_inputs(flat, n, rng):
+    """Rows spread over the range of thresholds each feature is split on."""
+    split = flat.children[0::2] != np.arange(len(flat.feature))
+    X = np.empty((n, flat.n_features_in_), dtype=np.float64)
+    for j in range(flat.n_features_in_):
+        t = flat.threshold[split & (flat.feature == j)]
+        lo, hi = (t.min() - 1, t.max() + 1) if len(t) else (0.0, 1.0)
+        X[:, j] = rng.uniform(lo, hi, n)
+    if flat.feature_names_in_ is not None:
+        return pd.DataFrame(X, columns=list(flat.feature_names_in_))
+    return X
+
+
+def _benchmark(paths, batch=1000, repeat=50):
+    import timeit
+    import warnings
+
+    import joblib
+
+    warnings.filterwarnings("ignore")
+    rng = np.random.default_rng(0)
+    for path in paths:
+        model = joblib.load(path)
+        if not is_flattenable(model):
+            continue
+        flat = FlatForest.from_sklearn(model)
+        X = _sample_inputs(flat, batch, rng)
+        one = X.iloc[:1] if isinstance(X, pd.DataFrame) else X[:1]
+        if flat.is_classifier:
+            diff = np.abs(model.predict_proba(X) - flat.predict_proba(X)).max()
+            same = (model.predict(X) == flat.predict(X)).mean()
+        else:
+            diff = np.abs(model.predict(X) - flat.predict(X)).max()
+            same = float(diff < 1e-9)
+        t_sk1 = timeit.timeit(lambda: model.predict(one), number=repeat) / repeat
+        t_fl1 = timeit.timeit(lambda: flat.predict(one), number=repeat) / repeat
+        t_skn = timeit.timeit(lambda: model.predict(X), number=max(1, repeat // 10)) / max(1, repeat // 10)
+        t_fln = timeit.timeit(lambda: flat.predict(X), number=max(1, repeat // 10)) / max(1, repeat // 10)
+        print(f"{os.path.basename(path):<28} max|diff| {diff:.1e} agree {same:6.1%} | 1 row: sklearn "
+              f"{t_sk1 * 1e3:6.2f} ms flat {t_fl1 * 1e3:6.2f} ms | {batch} rows: sklearn {t_skn * 1e3:7.2f} ms "
+              f"flat {t_fln * 1e3:7.2f} ms")
+
+
+if __name__ == "__main__":
+    import glob
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    _benchmark(sorted(glob.glob(os.path.join(here, "model", "*.pkl")))
+               + sorted(glob.glob(os.path.join(here, "actual", "model", "*.pkl"))))
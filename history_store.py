@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+# ---------------------- CONFIG ----------------------
+HISTORY_DB = os.environ.get(
+    "HISTORY_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".history", "history.sqlite3"),
+)
+RETENTION_DAYS = 400      # a bit more than one full season, year over year
+THIN_AFTER_DAYS = 30      # older forecasts keep only the latest issue per valid time
+COMPACT_EVERY = 24 * 3600
+# -----------------------------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS forecasts (
+    location   TEXT    NOT NULL,
+    source     TEXT    NOT NULL,
+    issue_time INTEGER NOT NULL,
+    valid_time INTEGER NOT NULL,
+    temp       REAL,
+    humidity   REAL,
+    rain       REAL,
+    wind       REAL,
+    cloud      REAL,
+    PRIMARY KEY (location, valid_time, issue_time, source)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS predictions (
+    location   TEXT    NOT NULL,
+    kind       TEXT    NOT NULL,
+    target     TEXT    NOT NULL DEFAULT '',
+    issue_time INTEGER NOT NULL,
+    valid_time INTEGER NOT NULL,
+    value      REAL,
+    label      TEXT,
+    PRIMARY KEY (location, kind, valid_time, target, issue_time)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value REAL
+);
+"""
+
+FORECAST_COLUMNS = ["temp", "humidity", "rain", "wind", "cloud"]
+EPOCH = pd.Timestamp(0, tz="UTC")
+
+
+def location_id(lat, lon):
+    """Stable key for a field location (MET/Open-Meteo resolve far coarser than 4 dp)."""
+    return f"{lat:.4f},{lon:.4f}"
+
+
+def to_epoch(values):
+    """Timestamps (str/datetime/pandas) -> int epoch seconds, naive values taken as UTC."""
+    ts = pd.to_datetime(pd.Series(values), utc=True)
+    return ((ts - EPOCH) // pd.Timedelta(seconds=1)).to_numpy()
+
+
+class HistoryStore:
+    """Append-only SQLite history of forecasts pulled and predictions made.
+
+    Both tables are clustered on (location, ..., valid_time), so a range
+    query for one field over a season is a single index range scan. Writes
+    are queued to one background writer thread so request handlers never
+    wait on disk; ``flush()`` blocks until the queue is drained, and failed
+    writes are printed and counted in ``write_errors``. Compaction runs once
+    every COMPACT_EVERY seconds per database, whichever process gets there
+    first; the time of the last one is kept in the ``meta`` table.
+    """
+
+    def __init__(self, path=HISTORY_DB, retention_days=RETENTION_DAYS, thin_after_days=THIN_AFTER_DAYS):
+        self.path = path
+        self.retention_days = retention_days
+        self.thin_after_days = thin_after_days
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-writer")
+        self.write_errors = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+            # Shared by every process on the database; a new database counts as just compacted
+            conn.execute("INSERT OR IGNORE INTO meta VALUES ('last_compacted', ?)", (time.time(),))
+        self._last_compacted = self._stored_last_compacted()
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # ---------------------- WRITE ----------------------
+    def record_forecast(self, location, source, issue_time, valid_times, **columns):
+        """Queue one forecast pull: ``valid_times`` plus any of temp/humidity/rain/wind/cloud arrays."""
+        issue = int(issue_time)
+        valid = to_epoch(valid_times)
+        n = len(valid)
+        cols = [list(columns.get(c, [None] * n)) for c in FORECAST_COLUMNS]
+        rows = [(location, source, issue, int(v), *(col[i] for col in cols)) for i, v in enumerate(valid)]
+        return self._submit(self._insert, "INSERT OR REPLACE INTO forecasts VALUES (?,?,?,?,?,?,?,?,?)", rows)
+
+    def record_predictions(self, location, kind, issue_time, valid_times, values=None, labels=None, targets=None):
+        """Queue predictions of one ``kind`` (risk, yield, spray, ...) for a location."""
+        issue = int(issue_time)
+        valid = to_epoch(valid_times)
+        n = len(valid)
+        values = [None] * n if values is None else [None if v is None else float(v) for v in values]
+        labels = [None] * n if labels is None else [None if l is None else str(l) for l in labels]
+        targets = [""] * n if targets is None else [str(t) for t in targets]
+        rows = [(location, kind, targets[i], issue, int(valid[i]), values[i], labels[i]) for i in range(n)]
+        return self._submit(self._insert, "INSERT OR REPLACE INTO predictions VALUES (?,?,?,?,?,?,?)", rows)
+
+    def record_prediction_rows(self, kind, issue_time, locations, valid_times, values=None, labels=None):
+        """Queue predictions of one ``kind`` for many locations at once; entry ``i`` is one row."""
+        issue = int(issue_time)
+        valid = to_epoch(valid_times)
+        n = len(valid)
+        values = [None] * n if values is None else [None if v is None else float(v) for v in values]
+        labels = [None] * n if labels is None else [None if l is None else str(l) for l in labels]
+        rows = [(locations[i], kind, "", issue, int(valid[i]), values[i], labels[i]) for i in range(n)]
+        return self._submit(self._insert, "INSERT OR REPLACE INTO predictions VALUES (?,?,?,?,?,?,?)", rows)
+
+    def _submit(self, fn, *args):
+        # Callers rarely wait on the future, so report a failed write here instead of dropping it
+        future = self._writer.submit(fn, *args)
+        future.add_done_callback(self._report_error)
+        return future
+
+    def _report_error(self, future):
+        error = future.exception()
+        if error is not None:
+            self.write_errors += 1
+            print("Error writing history:", error)
+
+    def _insert(self, sql, rows):
+        conn = self._conn()
+        with conn:
+            conn.executemany(sql, rows)
+        now = time.time()
+        if now - self._last_compacted > COMPACT_EVERY:
+            if self._claim_compaction(now):
+                self.compact(now)
+            else:
+                self._last_compacted = self._stored_last_compacted()
+
+    def _stored_last_compacted(self):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = 'last_compacted'").fetchone()
+        return row[0] if row else 0.0
+
+    def _claim_compaction(self, now):
+        """Take today's compaction for this process, unless another process took it already."""
+        conn = self._conn()
+        with conn:
+            cur = conn.execute("UPDATE meta SET value = ? WHERE key = 'last_compacted' AND value < ?",
+                               (now, now - COMPACT_EVERY))
+        return cur.rowcount == 1
+
+    def flush(self):
+        self._writer.submit(lambda: None).result()
+
+    # ---------------------- READ ----------------------
+    def forecast_history(self, location, start=None, end=None, source=None):
+        sql = "SELECT * FROM forecasts WHERE location = ? AND valid_time BETWEEN ? AND ?"
+        params = [location, *self._range(start, end)]
+        if source is not None:
+            sql += " AND source = ?"
+            params.append(source)
+        return self._query(sql + " ORDER BY valid_time, issue_time", params)
+
+    def prediction_history(self, location, kind=None, start=None, end=None, target=None):
+        sql = "SELECT * FROM predictions WHERE location = ?"
+        params = [location]
+        if kind is not None:
+            sql += " AND kind = ?"
+            params.append(kind)
+        sql += " AND valid_time BETWEEN ? AND ?"
+        params += self._range(start, end)
+        if target is not None:
+            sql += " AND target = ?"
+            params.append(target)
+        return self._query(sql + " ORDER BY valid_time, issue_time", params)
+
+    @staticmethod
+    def _range(start, end):
+        lo = 0 if start is None else int(to_epoch([start])[0])
+        hi = 2**62 if end is None else int(to_epoch([end])[0])
+        return [lo, hi]
+
+    def _query(self, sql, params):
+        cur = self._conn().execute(sql, params)
+        df = pd.DataFrame(cur.fetchall(), columns=[d[0] for d in cur.description])
+        for col in ("issue_time", "valid_time"):
+            df[col] = pd.to_datetime(df[col], unit="s", utc=True)
+        return df
+
+    # ---------------------- RETENTION ----------------------
+    def compact(self, now=None):
+        """Drop rows past retention, thin old forecasts to their final issue, reclaim space."""
+        now = int(time.time() if now is None else now)
+        cutoff = now - self.retention_days * 86400
+        thin_cutoff = now - self.thin_after_days * 86400
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM forecasts WHERE valid_time < ?", (cutoff,))
+            conn.execute("DELETE FROM predictions WHERE valid_time < ?", (cutoff,))
+            conn.execute(
+                """DELETE FROM forecasts WHERE valid_time < ? AND issue_time < (
+                       SELECT MAX(f2.issue_time) FROM forecasts f2
+                       WHERE f2.location = forecasts.location AND f2.source = forecasts.source
+                         AND f2.valid_time = forecasts.valid_time)""",
+                (thin_cutoff,),
+            )
+            conn.execute(
+                """DELETE FROM predictions WHERE valid_time < ? AND issue_time < (
+                       SELECT MAX(p2.issue_time) FROM predictions p2
+                       WHERE p2.location = predictions.location AND p2.kind = predictions.kind
+                         AND p2.target = predictions.target AND p2.valid_time = predictions.valid_time)""",
+                (thin_cutoff,),
+            )
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_compacted', ?)", (now,))
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("VACUUM")
+        self._last_compacted = now
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """Process-wide store, opened on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = HistoryStore()
+        return _store
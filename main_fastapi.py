@@ -1,78 +1,155 @@
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import joblib
-import pandas as pd
-from utils import fetch_weather_data, get_hourly_forecast, recommend_fertilizer, predict_stress_level
+from contextlib import asynccontextmanager
+from batching import model_batcher
+from bulk import BulkRequestError, bulk_crop, bulk_fertilizer, bulk_spray, bulk_stress, bulk_yield, parse_request
+from feature_schema import UnknownCategoryError
+from model_registry import registry
+from prediction_cache import prediction_cache
+from sensitivity import sensitivity_request
+from utils import FERTILIZER_SCHEMA, STRESS_SCHEMA, fetch_weather_data_async, record_prediction, stress_explanation, weather_client
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load every model before serving, off the event loop; later reloads happen in worker threads
+    await run_in_threadpool(registry.preload)
+    yield
+    await weather_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-yield_model = joblib.load("model/yield_model.pkl")
-time_model = joblib.load("model/best_window_model.pkl")
-fert_model = joblib.load("model/fert_model.pkl")
-stress_model = joblib.load("model/stress_model.pkl")
-crop_model = joblib.load("model/crop_model.pkl")
+# Models load on first use and hot-reload when the files change
+registry.register("yield", "model/yield_model.pkl")
+registry.register("spray", "model/best_window_model.pkl")
+registry.register("fert", "model/fert_model.pkl")
+registry.register("stress", "model/stress_model.pkl")
+registry.register("fertilizer", "model/fertilizer_model.pkl")
+registry.register("crop", "model/crop_model.pkl")
+
+# Concurrent one-row predictions are queued for a few ms and predicted together
+yield_batcher = model_batcher("yield")
+fert_batcher = model_batcher("fert", schema=FERTILIZER_SCHEMA)
+stress_batcher = model_batcher("stress", schema=STRESS_SCHEMA)
 
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request):
+async def index(request: Request):
     return templates.TemplateResponse("index.html", {"request": request})
 
 @app.get("/get_agri_data")
-def get_agri_data(lat: float, lon: float):
-    weather = fetch_weather_data(lat, lon)
+async def get_agri_data(lat: float, lon: float):
+    weather = await fetch_weather_data_async(lat, lon)
     if not weather:
         return JSONResponse({'error': 'Weather data unavailable'}, status_code=500)
     recommendations = "Use the dashboard features for yield, fertilizer, and stress prediction."
     return {"weather": weather, "recommendations": recommendations}
 
 @app.get("/predict_yield")
-def predict_yield(lat: float, lon: float, ozone: float, soil: float):
-    weather = fetch_weather_data(lat, lon)
+async def predict_yield(lat: float, lon: float, ozone: float, soil: float):
+    weather = await fetch_weather_data_async(lat, lon)
     if not weather:
         return JSONResponse({'result': None}, status_code=400)
     temp = weather['temp']
     rain = weather['rain']
-    features = pd.DataFrame([[ozone, temp, rain, soil]], columns=["ozone", "temp", "rain", "soil"])
-    prediction = yield_model.predict(features)[0]
+    prediction = await yield_batcher.predict_async({"ozone": ozone, "temp": temp, "rain": rain, "soil": soil})
+    await run_in_threadpool(record_prediction, lat, lon, "yield", values=[prediction])
     return {"result": f"Predicted Potato Yield: {prediction:.2f} tonnes/hectare"}
 
 @app.get("/recommend_fertilizer")
-def recommend_fertilizer_api(lat: float, lon: float, ozone: float, soil: float, ph: float, stage: str):
-    weather = fetch_weather_data(lat, lon)
+async def recommend_fertilizer_api(lat: float, lon: float, ozone: float, soil: float, ph: float, stage: str):
+    weather = await fetch_weather_data_async(lat, lon)
     if not weather:
         return JSONResponse({'result': None}, status_code=400)
     temp = weather['temp']
     rain = weather['rain']
-    input_df = pd.DataFrame([{
+    inputs = {
         "ozone": ozone,
         "temp": temp,
         "rain": rain,
         "soil": soil,
         "ph": ph,
         "stage": stage
-    }])
-    result = recommend_fertilizer(input_df, fert_model)
+    }
+    try:
+        result = await fert_batcher.predict_async(inputs)
+    except UnknownCategoryError as e:
+        return JSONResponse({'result': None, 'error': str(e)}, status_code=422)
+    await run_in_threadpool(record_prediction, lat, lon, "fertilizer", labels=[result])
     return {"result": f"Recommended Fertilizer: {result}"}
 
 @app.get("/predict_stress")
-def predict_stress(lat: float, lon: float, ozone: float, temp: float, humidity: float, color: str, symptom: str):
-    input_df = pd.DataFrame([[ozone, temp, humidity, color, symptom]],
-                            columns=["ozone", "temp", "humidity", "color", "symptom"])
-    level, explanation = predict_stress_level(stress_model, input_df)
+async def predict_stress(lat: float, lon: float, ozone: float, temp: float, humidity: float, color: str, symptom: str):
+    inputs = {"ozone": ozone, "temp": temp, "humidity": humidity, "color": color, "symptom": symptom}
+    level = await stress_batcher.predict_async(inputs)
+    explanation = stress_explanation(level)
+    await run_in_threadpool(record_prediction, lat, lon, "stress", labels=[level])
     return {"result": f"Stress Level: {level}", "explanation": explanation}
 
+def predict_crop(features):
+    # registry.get may load or reload the model from disk, so it runs in the threadpool too
+    crop_model = registry.get("crop")
+    return crop_model.predict(features)[0], crop_model.classes_
+
 @app.get("/recommend_crop")
-def recommend_crop(N: float, P: float, K: float, temperature: float, humidity: float, ph: float, rainfall: float, ozone: float):
+async def recommend_crop(N: float, P: float, K: float, temperature: float, humidity: float, ph: float, rainfall: float, ozone: float):
     features = [[N, P, K, temperature, humidity, ph, rainfall, ozone]]
     try:
-        pred = crop_model.predict(features)[0]
-        known_crops = set(str(c) for c in crop_model.classes_)
+        pred, classes = await run_in_threadpool(predict_crop, features)
+        known_crops = set(str(c) for c in classes)
         if str(pred).strip().lower() in (c.strip().lower() for c in known_crops):
             return {"recommended_crop": pred}
         else:
             return {"recommended_crop": None, "message": "No preferred crop available for the given conditions."}
     except Exception as e:
         return {"recommended_crop": None, "message": f"Prediction error: {e}"}
+
+# --- Bulk endpoints: POST {"rows": [...], "fields": {...}}, see bulk.py ---
+async def _bulk(request, score):
+    try:
+        rows, fields = parse_request(await request.json())
+    except ValueError as e:
+        status = e.status if isinstance(e, BulkRequestError) else 400
+        return JSONResponse({'error': str(e)}, status_code=status)
+    # Already plain JSON types; skips jsonable_encoder walking every row
+    return JSONResponse(await run_in_threadpool(score, rows, fields))
+
+@app.post("/predict_yield/batch")
+async def predict_yield_batch(request: Request):
+    return await _bulk(request, bulk_yield)
+
+@app.post("/recommend_fertilizer/batch")
+async def recommend_fertilizer_batch(request: Request):
+    return await _bulk(request, bulk_fertilizer)
+
+@app.post("/predict_stress/batch")
+async def predict_stress_batch(request: Request):
+    return await _bulk(request, bulk_stress)
+
+@app.post("/recommend_crop/batch")
+async def recommend_crop_batch(request: Request):
+    if not registry.exists("crop"):
+        return JSONResponse({'error': 'Crop recommendation model not found'}, status_code=503)
+    return await _bulk(request, bulk_crop)
+
+@app.post("/spray_window/batch")
+async def spray_window_batch(request: Request):
+    return await _bulk(request, bulk_spray)
+
+@app.get("/prediction_cache/stats")
+async def prediction_cache_stats():
+    return prediction_cache.stats()
+
+@app.post("/sensitivity")
+async def sensitivity_api(request: Request):
+    """PD/ICE curves for a model: see sensitivity.sensitivity_request for the body."""
+    try:
+        body = await request.json()
+        return await run_in_threadpool(sensitivity_request, body)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
@@ -0,0 +1,252 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import joblib
+
+from flat_forest import FlatForest, is_flattenable
+
+# ---------------------- CONFIG ----------------------
+MODEL_CACHE_DIR = os.environ.get(
+    "MODEL_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".model_cache"),
+)
+# How often (seconds) a model file is stat-ed for changes; 0 checks on every get
+RELOAD_CHECK_INTERVAL = float(os.environ.get("MODEL_RELOAD_CHECK_INTERVAL", 2.0))
+# Serve RandomForests through flat_forest.FlatForest instead of sklearn's predict
+COMPILE_FORESTS = os.environ.get("MODEL_COMPILE_FORESTS", "1") == "1"
+# -----------------------------------------------------
+
+
+def file_version(path):
+    """Version string for a model file: changes whenever it is rewritten or replaced."""
+    st = os.stat(path)
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+def load_mmapped(path, version, cache_dir=MODEL_CACHE_DIR):
+    """joblib.load with ``mmap_mode='r'`` from an uncompressed copy of ``path``.
+
+    The copy is written once per file version (atomically, so concurrent
+    workers can race on it safely). Every process that loads it maps the
+    same pages, so plain NumPy arrays inside the model are shared through
+    the page cache instead of being copied into each worker. sklearn's Tree
+    copies its node arrays while unpickling, so forests still get a private
+    copy per process; ``ModelRegistry.preload`` before forking shares those
+    copy-on-write instead. The copy also decouples readers from the original
+    file, which can then be overwritten in place without corrupting a model
+    that is still serving.
+    """
+    prefix = _cache_prefix(path)
+    cached = os.path.join(cache_dir, f"{prefix}{version}.joblib")
+    if not os.path.exists(cached):
+        model = joblib.load(path)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = f"{cached}.{os.getpid()}.{threading.get_ident()}.tmp"
+            joblib.dump(model, tmp)
+            os.replace(tmp, cached)
+        except OSError as e:
+            print(f"Could not write memory-mapped copy of {path}:", e)
+            return model
+        _remove_old_versions(cache_dir, prefix, version)
+    return joblib.load(cached, mmap_mode="r")
+
+
+def load_model(path, version, cache_dir=MODEL_CACHE_DIR):
+    """Default loader: forests as memory-mapped FlatForest arrays, anything else via load_mmapped.
+
+    Unlike unpickled sklearn trees, the FlatForest node arrays stay mapped,
+    so every worker really shares one copy, and a worker starting up after
+    the first compile skips unpickling the forest altogether.
+    """
+    compiled = os.path.join(cache_dir, f"{_cache_prefix(path)}{version}.flat")
+    if COMPILE_FORESTS and os.path.isdir(compiled):
+        return FlatForest.load(compiled)
+    model = load_mmapped(path, version, cache_dir)
+    if not COMPILE_FORESTS or not is_flattenable(model):
+        return model
+    flat = FlatForest.from_sklearn(model)
+    try:
+        flat.save(compiled)
+    except OSError as e:
+        print(f"Could not write compiled copy of {path}:", e)
+        return flat
+    return FlatForest.load(compiled)
+
+
+def _cache_prefix(path):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return f"{stem}-{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]}-"
+
+
+def _remove_old_versions(cache_dir, prefix, version):
+    for old in os.listdir(cache_dir):
+        if not old.startswith(prefix) or old.startswith(prefix + version) or old.endswith(".tmp"):
+            continue
+        target = os.path.join(cache_dir, old)
+        try:
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            else:
+                os.remove(target)
+        except OSError:
+            pass
+
+
+class ModelEntry:
+    __slots__ = ("name", "path", "loader", "loaded", "checked_at", "lock")
+
+    def __init__(self, name, path, loader):
+        self.name = name
+        self.path = path
+        self.loader = loader
+        self.loaded = None          # (model, version), replaced as one tuple on reload
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    """Lazily loaded, hot-reloadable models shared by everything in the process.
+
+    ``register`` only records where a model lives; the file is loaded on the
+    first ``get``. After that the file is stat-ed at most every
+    ``check_interval`` seconds, and when its version changes the new model is
+    loaded beside the old one and swapped in with a single assignment, so
+    requests in flight keep the model they started with. A reload that fails
+    (e.g. a half-copied file) keeps the old model serving. Listeners added
+    with ``add_listener`` are called as ``fn(name, old_version, new_version)``
+    after every swap.
+    """
+
+    def __init__(self, check_interval=RELOAD_CHECK_INTERVAL, loader=load_model):
+        self.check_interval = check_interval
+        self.default_loader = loader
+        self._entries = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.reloads = 0
+        self.reload_failures = 0
+
+    def register(self, name, path, loader=None):
+        """Declare a model; re-registering the same name and path is a no-op."""
+        path = os.path.abspath(path)
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.path != path:
+                self._entries[name] = ModelEntry(name, path, loader or self.default_loader)
+        return name
+
+    def exists(self, name):
+        return os.path.exists(self._entry(name).path)
+
+    def path(self, name):
+        return self._entry(name).path
+
+    def get(self, name):
+        return self.get_versioned(name)[0]
+
+    def version(self, name):
+        return self.get_versioned(name)[1]
+
+    def get_versioned(self, name):
+        """``(model, version)`` as one consistent pair."""
+        entry = self._entry(name)
+        loaded = entry.loaded
+        if loaded is None:
+            with entry.lock:
+                if entry.loaded is None:
+                    version = file_version(entry.path)
+                    entry.loaded = (entry.loader(entry.path, version), version)
+                    entry.checked_at = time.monotonic()
+                    self.loads += 1
+                return entry.loaded
+        now = time.monotonic()
+        if now - entry.checked_at >= self.check_interval and entry.lock.acquire(blocking=False):
+            # Only one thread checks; the others keep serving the current model
+            try:
+                entry.checked_at = now
+                self._maybe_reload(entry)
+            finally:
+                entry.lock.release()
+        return entry.loaded
+
+    def current(self, name):
+        """``(model, version)`` if it is loaded and not due for a reload check, else None.
+
+        Never touches the disk, so async code can call it on the event loop
+        and fall back to ``get_versioned`` in a worker thread on None.
+        """
+        entry = self._entry(name)
+        loaded = entry.loaded
+        if loaded is None or time.monotonic() - entry.checked_at >= self.check_interval:
+            return None
+        return loaded
+
+    def preload(self, names=None):
+        """Load models now, e.g. in a pre-fork master so workers inherit the pages copy-on-write."""
+        for name in names or list(self._entries):
+            try:
+                self.get(name)
+            except OSError as e:
+                print(f"Could not preload model '{name}':", e)
+
+    def reload(self, name=None):
+        """Check one (or every loaded) model for a new file version right now."""
+        names = [name] if name is not None else [n for n, e in list(self._entries.items()) if e.loaded]
+        for n in names:
+            entry = self._entry(n)
+            with entry.lock:
+                entry.checked_at = time.monotonic()
+                self._maybe_reload(entry)
+
+    def _maybe_reload(self, entry):
+        try:
+            version = file_version(entry.path)
+        except OSError as e:
+            print(f"Model file for '{entry.name}' unavailable, keeping loaded version:", e)
+            return
+        old_version = entry.loaded[1] if entry.loaded else None
+        if version == old_version:
+            return
+        try:
+            model = entry.loader(entry.path, version)
+        except Exception as e:
+            self.reload_failures += 1
+            print(f"Error reloading model '{entry.name}', keeping version {old_version}:", e)
+            return
+        entry.loaded = (model, version)
+        self.reloads += 1
+        for listener in list(self._listeners):
+            try:
+                listener(entry.name, old_version, version)
+            except Exception as e:
+                print("Error in model reload listener:", e)
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+        return fn
+
+    def _entry(self, name):
+        try:
+            return self._entries[name]
+        except KeyError:
+            raise KeyError(f"Model '{name}' is not registered") from None
+
+    def stats(self):
+        return {
+            "models": {
+                name: {"path": e.path, "version": e.loaded[1] if e.loaded else None, "loaded": e.loaded is not None}
+                for name, e in list(self._entries.items())
+            },
+            "loads": self.loads,
+            "reloads": self.reloads,
+            "reload_failures": self.reload_failures,
+        }
+
+
+# Process-wide registry used by the apps
+registry = ModelRegistry()
@@ -0,0 +1,85 @@
+"""LRU cache of single-row predictions, keyed by model version and quantized inputs.
+
+The dashboards ask for the same inputs over and over (auto_update.js sends
+the same ozone, soil, pH and stage from every open browser every minute).
+Numeric inputs are rounded to ``PREDICTION_CACHE_DECIMALS`` places before
+they are encoded and predicted, so nearby requests share one entry and a
+cached answer is exactly what the model gives for the rounded inputs. A
+model the registry reloads drops its entries; the version in the key keeps
+a stale answer from being served in between.
+"""
+import os
+from numbers import Real
+
+import numpy as np
+
+from model_registry import registry
+from resilience import TTLCache
+
+# ---------------------- CONFIG ----------------------
+PREDICTION_CACHE_ENABLED = os.environ.get("PREDICTION_CACHE_ENABLED", "1") == "1"
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", 4096))     # entries per model
+PREDICTION_CACHE_DECIMALS = int(os.environ.get("PREDICTION_CACHE_DECIMALS", 3))
+# -----------------------------------------------------
+
+
+class PredictionCache:
+    """One LRU per model name; entries never expire, they are evicted or invalidated."""
+
+    def __init__(self, maxsize=PREDICTION_CACHE_SIZE, decimals=PREDICTION_CACHE_DECIMALS, models=registry):
+        self.maxsize = maxsize
+        self.decimals = decimals
+        self._caches = {}
+        self.invalidations = 0
+        if models is not None:
+            models.add_listener(self._on_reload)
+
+    def _cache(self, name):
+        cache = self._caches.get(name)
+        if cache is None:
+            cache = self._caches.setdefault(name, TTLCache(maxsize=self.maxsize, ttl=float("inf")))
+        return cache
+
+    def quantize(self, inputs):
+        """``inputs`` with every number rounded; labels and missing values pass through."""
+        return {k: round(float(v), self.decimals) if isinstance(v, Real) and not isinstance(v, bool) else v
+                for k, v in inputs.items()}
+
+    @staticmethod
+    def key(version, row):
+        # + 0.0 folds -0.0 into 0.0 so both hit the same entry
+        return version, (np.asarray(row, dtype=np.float32) + np.float32(0.0)).tobytes()
+
+    def get(self, name, key):
+        return self._cache(name).get(key)
+
+    def set(self, name, key, value):
+        self._cache(name).set(key, value)
+
+    def invalidate(self, name=None):
+        for n in [name] if name is not None else list(self._caches):
+            cache = self._caches.get(n)
+            if cache is not None:
+                cache.clear()
+                self.invalidations += 1
+
+    def _on_reload(self, name, old_version, new_version):
+        self.invalidate(name)
+
+    def stats(self):
+        models = {name: cache.stats() for name, cache in list(self._caches.items())}
+        hits = sum(s["hits"] for s in models.values())
+        total = hits + sum(s["misses"] for s in models.values())
+        return {
+            "enabled": PREDICTION_CACHE_ENABLED,
+            "decimals": self.decimals,
+            "hits": hits,
+            "misses": total - hits,
+            "hit_rate": hits / total if total else 0.0,
+            "invalidations": self.invalidations,
+            "models": models,
+        }
+
+
+# Process-wide cache shared by every model_batcher
+prediction_cache = PredictionCache()
@@ -0,0 +1,356 @@
+"""Upstream resilience helpers shared by the root apps (utils.py) and the MET app in actual/.
+
+An expiring LRU cache, a circuit breaker, an on-disk store of the last good
+payload, and single-flight call coalescing. Standard library only, with no
+import-time side effects, so importing it does not pull in utils.py's
+clients, executors or models.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class TTLCache:
+    """Thread-safe in-process cache with per-entry expiry and LRU eviction.
+
+    With ``stale_ttl`` set, expired entries are kept that much longer so
+    ``lookup`` can still serve them (flagged as not fresh) while a refresh
+    is under way.
+    """
+
+    def __init__(self, maxsize=2048, ttl=600, stale_ttl=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def _entry(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            item = self._entry(key, now)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[2]
+            self.misses += 1
+            return None
+
+    def lookup(self, key):
+        """Return ``(value, fresh)``; stale values come back with ``fresh=False``."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._entry(key, now)
+            if item is None:
+                self.misses += 1
+                return None, False
+            self._data.move_to_end(key)
+            if item[0] > now:
+                self.hits += 1
+                return item[2], True
+            self.stale_hits += 1
+            return item[2], False
+
+    def peek(self, key, stale=False):
+        """Value without touching LRU order or the hit/miss counters (fresh only unless ``stale``)."""
+        with self._lock:
+            now = time.monotonic()
+            item = self._entry(key, now)
+            if item is None or (item[0] <= now and not stale):
+                return None
+            return item[2]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            fresh_until = time.monotonic() + (self.ttl if ttl is None else ttl)
+            self._data[key] = (fresh_until, fresh_until + self.stale_ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.stale_hits + self.misses
+            return {
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hit_rate": (self.hits + self.stale_hits) / total if total else 0.0,
+            }
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _response_attr(error, name):
+    # MetAPIError carries status_code/headers itself; requests and httpx errors carry a response
+    value = getattr(error, name, None)
+    if value is None:
+        value = getattr(getattr(error, "response", None), name, None)
+    return value
+
+
+def is_upstream_failure(error):
+    """True for errors that say the upstream is unhealthy or throttling: 5xx, 429, timeouts, transport errors.
+
+    Any other 4xx answer (bad coordinates, bad parameters) is the caller's
+    fault and says the upstream is up, so it must not count towards opening
+    the breaker. A 429 (how MET throttles) means stop calling, so it does.
+    """
+    status = _response_attr(error, "status_code")
+    return status is None or status >= 500 or status == 429
+
+
+def retry_after_seconds(error):
+    """Seconds the upstream asked callers to wait (its Retry-After header), or None."""
+    headers = _response_attr(error, "headers")
+    value = headers.get("Retry-After") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Stop calling a failing upstream for ``reset_timeout`` seconds after repeated errors.
+
+    After the cool-down a single trial call is let through (half-open); its
+    outcome closes the breaker again or re-opens it for another cool-down.
+    Only upstream failures count (see ``is_upstream_failure``); other 4xx
+    errors are re-raised without tripping it. A failure carrying Retry-After
+    opens the breaker at once, for exactly that long.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._open_for = reset_timeout
+        self._trial_running = False
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self._open_for:
+                return "half-open"
+            return "open"
+
+    def retry_in(self):
+        """Seconds until the next trial call is allowed (0 when closed or half-open)."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self._open_for - time.monotonic())
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self._open_for and not self._trial_running:
+                self._trial_running = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self, retry_after=None):
+        with self._lock:
+            self._failures += 1
+            if retry_after is not None:
+                # The upstream said when to come back; hammering it sooner only prolongs the throttling
+                self._opened_at = time.monotonic()
+                self._open_for = retry_after
+            elif self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._open_for = self.reset_timeout
+            self._trial_running = False
+
+    def call(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Weather upstream unavailable (circuit open)", self.retry_in())
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.record_failure(retry_after_seconds(e))
+            else:
+                # The upstream answered; only the request was bad
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError("Weather upstream unavailable (circuit open)", self.retry_in())
+        try:
+            result = await fn(*args, **kwargs)
+        except Exception as e:
+            if is_upstream_failure(e):
+                self.record_failure(retry_after_seconds(e))
+            else:
+                # The upstream answered; only the request was bad
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        return {"circuit": self.state, "rejected": self.rejected}
+
+
+class LastGoodStore:
+    """Last successful upstream payload per grid cell, persisted as JSON files.
+
+    Lets a restarted server with no connectivity keep answering from the
+    most recent forecast it saw.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, cell):
+        return os.path.join(self.directory, f"{cell[0]}_{cell[1]}.json")
+
+    def save(self, cell, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(cell)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print("Error saving last good forecast:", e)
+
+    def load(self, cell):
+        try:
+            with open(self._path(cell), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+class SingleFlight:
+    """Let one call per key run at a time; concurrent callers share its outcome.
+
+    Followers may be threads (``do``) or asyncio tasks (``do_async``) and can
+    wait on a leader of either kind, since both sides meet on a
+    concurrent.futures.Future. The key is freed however the leader ends; if
+    it is cancelled, waiting followers run the call again themselves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            future = self._calls[key] = Future()
+            self.leaders += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        """Free the key, then hand the leader's result or error to the followers."""
+        with self._lock:
+            self._calls.pop(key, None)
+        if error is None:
+            future.set_result(result)
+        elif isinstance(error, Exception):
+            future.set_exception(error)
+        else:
+            # Leader cancelled or interrupted (client gone, shutdown): followers see a cancellation
+            future.cancel()
+
+    def do(self, key, fn, *args):
+        future, leader = self._join(key)
+        while not leader:
+            try:
+                return future.result()
+            except CancelledError:
+                # The leader was cancelled; run the call again (or follow whoever does)
+                future, leader = self._join(key)
+        result = error = None
+        try:
+            result = fn(*args)
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(key, future, result, error)
+
+    async def do_async(self, key, fn, *args):
+        future, leader = self._join(key)
+        while not leader:
+            try:
+                # Shielded so a follower's own cancellation does not cancel the shared future
+                return await asyncio.shield(asyncio.wrap_future(future))
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                future, leader = self._join(key)
+        result = error = None
+        try:
+            result = await fn(*args)
+            return result
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._finish(key, future, result, error)
+
+    def in_flight(self, key):
+        with self._lock:
+            return key in self._calls
+
+    def stats(self):
+        with self._lock:
+            return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
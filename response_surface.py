@@ -0,0 +1,315 @@
+"""Precomputed response surfaces for the low-dimensional regressors (the yield model).
+
+The yield forest only sees ozone, temp, rain and soil, so its whole response
+fits in a dense grid of predictions: built once per model version, stored as
+a memory-mapped .npy and read back with multilinear interpolation. A query
+then costs a few NumPy operations instead of a walk down 100 trees. The
+error against the forest is measured on random points when the grid is built
+and kept with it.
+
+    python response_surface.py        # build the yield surface, report its error and speed
+"""
+import json
+import os
+import threading
+from bisect import bisect_right
+
+import numpy as np
+import pandas as pd
+
+from flat_forest import FlatForest, is_flattenable, split_ranges
+from model_registry import MODEL_CACHE_DIR, _cache_prefix, registry
+
+# ---------------------- CONFIG ----------------------
+# Approximate mode for yield queries (the app can still toggle it per session)
+YIELD_APPROXIMATE = os.environ.get("YIELD_APPROXIMATE", "0") == "1"
+# Grid points per input; the grid holds SURFACE_POINTS ** n_features float32 values
+SURFACE_POINTS = int(os.environ.get("SURFACE_POINTS", 48))
+# Random points the surface is checked against the exact model on
+SURFACE_ERROR_SAMPLES = 100_000
+# -----------------------------------------------------
+
+
+def _float32_span(low, high):
+    """Float32 values just outside [low, high]: the forest compares float32 inputs, so
+    clamping onto these keeps every split decision of an input beyond them."""
+    # Compared as Python floats: NumPy would compare a float32 with a float in float32
+    lo = np.float32(low)
+    if float(lo) > low:
+        lo = np.nextafter(lo, np.float32(-np.inf))
+    hi = np.float32(high)
+    if float(hi) <= high:
+        hi = np.nextafter(hi, np.float32(np.inf))
+    return float(lo), float(hi)
+
+
+def _forest_grid(flat, axes):
+    """The forest's prediction at every grid point, exactly, without predicting each point.
+
+    Each tree partitions input space into boxes, one per leaf; on a product
+    grid every box is a block of consecutive indices per axis, so the tree
+    contributes its leaf value to one array slice per leaf.
+    """
+    grid = np.zeros(tuple(len(a) for a in axes), dtype=np.float64)
+    # Inputs are compared as float32, like FlatForest and sklearn do
+    axes32 = [a.astype(np.float32).astype(np.float64) for a in axes]
+    full = tuple(slice(0, len(a)) for a in axes)
+    for root in flat.roots:
+        stack = [(int(root), full)]
+        while stack:
+            node, box = stack.pop()
+            right, left = flat.children[2 * node], flat.children[2 * node + 1]
+            if right == node:
+                grid[box] += flat.value[node, 0]
+                continue
+            j = flat.feature[node]
+            cut = int(np.searchsorted(axes32[j], flat.threshold[node], side="right"))
+            lo, hi = box[j].start, box[j].stop
+            if lo < min(cut, hi):
+                stack.append((int(left), box[:j] + (slice(lo, min(cut, hi)),) + box[j + 1:]))
+            if max(cut, lo) < hi:
+                stack.append((int(right), box[:j] + (slice(max(cut, lo), hi),) + box[j + 1:]))
+    return grid / len(flat.roots)
+
+
+class ResponseSurface:
+    """A regressor tabulated on a product grid and read back by multilinear interpolation.
+
+    ``axes[j]`` holds the grid coordinates of feature ``j``. Past the last
+    split on a feature a forest no longer changes, so where an axis reaches
+    that far (``clamp_low`` / ``clamp_high``) inputs beyond it are clamped
+    onto the grid at no extra error. Any other row outside the grid, or with
+    a missing value, is predicted exactly by ``model``.
+    """
+
+    def __init__(self, axes, grid, feature_names, clamp_low, clamp_high, errors=None, model=None):
+        self.axes = [np.asarray(a, dtype=np.float64) for a in axes]
+        self.grid = grid
+        self.feature_names = list(feature_names)
+        self.clamp_low = np.asarray(clamp_low, dtype=bool)
+        self.clamp_high = np.asarray(clamp_high, dtype=bool)
+        self.errors = dict(errors or {})
+        self.model = model
+        # Plain ndarray view: indexing a np.memmap goes through its Python-level __getitem__
+        self._flat_grid = np.asarray(grid).reshape(-1)
+        self._lo = np.array([a[0] for a in self.axes])
+        self._hi = np.array([a[-1] for a in self.axes])
+        self._clip_lo = np.where(self.clamp_low, self._lo, -np.inf)
+        self._clip_hi = np.where(self.clamp_high, self._hi, np.inf)
+        d = len(self.axes)
+        self._strides = [s // grid.itemsize for s in grid.strides]
+        # Offsets of the 2 ** d corners of a cell from its lowest corner
+        self._corner_bits = (np.arange(2 ** d)[:, None] >> np.arange(d)[::-1]) & 1
+        self._corner_offsets = self._corner_bits @ np.array(self._strides)
+        self._axis_lists = [a.tolist() for a in self.axes]
+        self._corner_bit_lists = self._corner_bits.tolist()
+
+    @property
+    def feature_names_in_(self):
+        # Lets compile_schema / the sensitivity engine treat the surface like the model it tabulates
+        return np.asarray(self.feature_names, dtype=object)
+
+    @property
+    def max_error(self):
+        return self.errors.get("max")
+
+    @classmethod
+    def build(cls, model, points=SURFACE_POINTS, bounds=None):
+        """Tabulate ``model`` on ``points`` evenly spaced values per feature.
+
+        ``bounds`` maps feature name -> (low, high); by default each axis spans
+        the forest's split range, so every input can be clamped onto the grid.
+        """
+        flat = model
+        if not isinstance(flat, FlatForest):
+            flat = FlatForest.from_sklearn(model) if is_flattenable(model) else None
+        if flat is None or flat.is_classifier:
+            raise TypeError(f"Cannot tabulate {type(model).__name__}; only forest regressors are supported")
+        names = [str(f) for f in flat.feature_names_in_]
+        splits = split_ranges(flat)
+        axes, clamp_low, clamp_high = [], [], []
+        for name, split in zip(names, splits):
+            if split is None:
+                # Never split on: the forest ignores it, a single cell is enough
+                axes.append(np.array([0.0, 1.0]))
+                clamp_low.append(True)
+                clamp_high.append(True)
+                continue
+            lo, hi = (bounds or {}).get(name, _float32_span(*split))
+            axes.append(np.linspace(lo, hi, points))
+            clamp_low.append(lo <= split[0])
+            clamp_high.append(hi > split[1])
+        grid = _forest_grid(flat, axes).astype(np.float32)
+        return cls(axes, grid, names, clamp_low, clamp_high, model=model)
+
+    # ---------------------- INFERENCE ----------------------
+    def _as_array(self, X):
+        if isinstance(X, pd.DataFrame):
+            return np.column_stack([X[name].to_numpy(dtype=np.float64) for name in self.feature_names])
+        X = np.asarray(X, dtype=np.float64)
+        return X.reshape(1, -1) if X.ndim == 1 else X
+
+    def interpolate(self, X):
+        """Multilinear interpolation for rows already on the grid; no fallback."""
+        n, d = X.shape
+        base = np.zeros(n, dtype=np.intp)
+        frac = np.empty((n, d))
+        for j, axis in enumerate(self.axes):
+            i = np.clip(np.searchsorted(axis, X[:, j], side="right") - 1, 0, len(axis) - 2)
+            frac[:, j] = (X[:, j] - axis[i]) / (axis[i + 1] - axis[i])
+            base += i * self._strides[j]
+        # (n, corners, d) weights: frac where the corner's bit is 1, 1 - frac where it is 0
+        weights = np.where(self._corner_bits, frac[:, None, :], 1.0 - frac[:, None, :]).prod(axis=2)
+        values = self._flat_grid[base[:, None] + self._corner_offsets]
+        return (weights * values).sum(axis=1)
+
+    def predict(self, X):
+        """Rows as a DataFrame or an array in ``feature_names`` order -> predictions."""
+        X = np.clip(self._as_array(X), self._clip_lo, self._clip_hi)
+        inside = ((X >= self._lo) & (X <= self._hi)).all(axis=1)   # False for NaN too
+        if inside.all():
+            return self.interpolate(X)
+        out = np.empty(len(X))
+        out[inside] = self.interpolate(X[inside])
+        out[~inside] = self._exact(X[~inside])
+        return out
+
+    def predict_one(self, inputs):
+        """One input mapping -> float, in plain Python: the per-request path."""
+        x = [float(inputs[name]) for name in self.feature_names]
+        base = 0
+        fracs = []
+        for j, (axis, v) in enumerate(zip(self._axis_lists, x)):
+            lo, hi = axis[0], axis[-1]
+            if v < lo and self.clamp_low[j]:
+                v = lo
+            elif v > hi and self.clamp_high[j]:
+                v = hi
+            x[j] = v
+            if not lo <= v <= hi:   # also catches NaN
+                return float(self._exact(np.array([x]))[0])
+            i = min(max(bisect_right(axis, v) - 1, 0), len(axis) - 2)
+            fracs.append((v - axis[i]) / (axis[i + 1] - axis[i]))
+            base += i * self._strides[j]
+        total = 0.0
+        for bits, value in zip(self._corner_bit_lists, self._flat_grid[base + self._corner_offsets].tolist()):
+            weight = 1.0
+            for frac, bit in zip(fracs, bits):
+                weight *= frac if bit else 1.0 - frac
+            total += weight * value
+        return total
+
+    def _exact(self, X):
+        if self.model is None:
+            raise ValueError("Rows outside the grid and no exact model to fall back on")
+        return self.model.predict(pd.DataFrame(X, columns=self.feature_names))
+
+    def measure_error(self, model=None, samples=SURFACE_ERROR_SAMPLES, seed=0):
+        """Max / mean / p99 absolute difference from ``model`` on random points inside the grid."""
+        model = model or self.model
+        rng = np.random.default_rng(seed)
+        X = np.column_stack([rng.uniform(a[0], a[-1], samples) for a in self.axes])
+        exact = model.predict(pd.DataFrame(X, columns=self.feature_names))
+        diff = np.abs(self.interpolate(X) - exact)
+        self.errors = {"max": float(diff.max()), "mean": float(diff.mean()),
+                       "p99": float(np.percentile(diff, 99)), "samples": samples}
+        return self.errors
+
+    # ---------------------- STORAGE ----------------------
+    def save(self, directory):
+        """grid.npy plus meta.json, written to a temp dir and renamed into place (like FlatForest.save)."""
+        tmp = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp, exist_ok=True)
+        np.save(os.path.join(tmp, "grid.npy"), self.grid)
+        meta = {
+            "axes": [a.tolist() for a in self.axes],
+            "feature_names": self.feature_names,
+            "clamp_low": self.clamp_low.tolist(),
+            "clamp_high": self.clamp_high.tolist(),
+            "errors": self.errors,
+        }
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            for name in os.listdir(tmp):
+                os.remove(os.path.join(tmp, name))
+            os.rmdir(tmp)
+
+    @classmethod
+    def load(cls, directory, model=None, mmap_mode="r"):
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            meta = json.load(f)
+        grid = np.load(os.path.join(directory, "grid.npy"), mmap_mode=mmap_mode)
+        return cls(grid=grid, model=model, **meta)
+
+
+_surfaces = {}
+_surfaces_lock = threading.Lock()
+
+
+def surface_for(name, points=SURFACE_POINTS, cache_dir=MODEL_CACHE_DIR):
+    """The ResponseSurface of registry model ``name`` at its current version.
+
+    Built and error-checked once per model file version and kept on disk
+    beside the registry's other cached copies, so later processes only map
+    the grid. A hot-reloaded model gets a new surface on its next use.
+    """
+    model, version = registry.get_versioned(name)
+    key = (name, version, points)
+    surface = _surfaces.get(key)
+    if surface is not None:
+        return surface
+    with _surfaces_lock:
+        surface = _surfaces.get(key)
+        if surface is None:
+            directory = os.path.join(cache_dir, f"{_cache_prefix(registry.path(name))}{version}.surface{points}")
+            if os.path.isdir(directory):
+                surface = ResponseSurface.load(directory, model=model)
+            else:
+                surface = ResponseSurface.build(model, points)
+                surface.measure_error()
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    surface.save(directory)
+                    surface = ResponseSurface.load(directory, model=model)
+                except OSError as e:
+                    print(f"Could not write response surface for '{name}':", e)
+            for old in [k for k in _surfaces if k[0] == name]:
+                del _surfaces[old]
+            _surfaces[key] = surface
+        return surface
+
+
+# ---------------------- BENCHMARK ----------------------
+def _benchmark(points=SURFACE_POINTS, repeat=2000):
+    import time
+    import timeit
+    import warnings
+
+    warnings.filterwarnings("ignore")
+    here = os.path.dirname(os.path.abspath(__file__))
+    registry.register("yield", os.path.join(here, "model", "yield_model.pkl"))
+    start = time.perf_counter()
+    surface = surface_for("yield", points)
+    built = time.perf_counter() - start
+    model = registry.get("yield")
+    errors = surface.errors
+    print(f"{points}^{len(surface.axes)} grid ({surface.grid.nbytes / 1e6:.1f} MB) ready in {built:.2f} s | "
+          f"error vs forest on {errors['samples']} points: max {errors['max']:.3f} mean {errors['mean']:.3f} "
+          f"p99 {errors['p99']:.3f} t/ha")
+    one = pd.DataFrame([[60, 22, 0.4, 0.25]], columns=surface.feature_names)
+    sweep = pd.DataFrame({"ozone": np.linspace(30, 100, 50), "temp": 22.0, "rain": 0.4, "soil": 0.25})
+    inputs = one.iloc[0].to_dict()
+    cases = (("1 row (predict_one)", one, lambda: surface.predict_one(inputs)),
+             ("1 row DataFrame", one, lambda: surface.predict(one)),
+             ("50-row ozone sweep", sweep, lambda: surface.predict(sweep)))
+    for label, X, approximate in cases:
+        exact = timeit.timeit(lambda: model.predict(X), number=repeat // 10) / (repeat // 10)
+        approx = timeit.timeit(approximate, number=repeat) / repeat
+        print(f"{label:<20} exact {exact * 1e6:8.1f} us | surface {approx * 1e6:7.1f} us")
+
+
+if __name__ == "__main__":
+    _benchmark()
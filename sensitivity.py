@@ -0,0 +1,264 @@
+"""What-if and sensitivity curves for any of the dashboard models.
+
+For a set of instances (the inputs a farmer entered, under today's weather
+and each forecast day) the engine varies one feature at a time, or two at
+once, and returns individual conditional expectation (ICE) curves, one per
+instance, plus their mean, the partial dependence (PD). Every sweep
+requested is stacked into one matrix and predicted in a single call, so a
+full 5-feature sweep costs about one batched predict.
+
+    python sensitivity.py        # time a full sweep against one predict per curve
+"""
+import json
+import os
+import weakref
+
+import numpy as np
+
+from feature_schema import compile_schema
+from flat_forest import FlatForest, is_flattenable, split_ranges
+from model_registry import registry
+from response_surface import ResponseSurface
+from utils import FERTILIZER_SCHEMA, STRESS_SCHEMA, TTLCache, get_forecast_bundle
+
+# ---------------------- CONFIG ----------------------
+SENSITIVITY_POINTS = 25       # values per one-way sweep
+PAIR_POINTS = 15              # values per axis of a two-way grid
+# Registry models the engine may be asked about, with their FeatureSchema options
+SENSITIVITY_MODELS = {
+    "yield": {},
+    "fert": FERTILIZER_SCHEMA,
+    "fertilizer": FERTILIZER_SCHEMA,
+    "stress": STRESS_SCHEMA,
+}
+SENSITIVITY_CACHE_TTL = 600
+# Request limits for the /sensitivity endpoints
+MAX_POINTS = 100
+MAX_SWEEPS = 10
+# -----------------------------------------------------
+
+_cache = TTLCache(maxsize=256, ttl=SENSITIVITY_CACHE_TTL)
+_ranges = weakref.WeakKeyDictionary()
+
+
+def feature_ranges(model):
+    """{feature: (low, high)} over which a forest's output actually changes."""
+    ranges = _ranges.get(model)
+    if ranges is None:
+        ranges = {}
+        if isinstance(model, ResponseSurface):
+            ranges = {name: (axis[0], axis[-1]) for name, axis in zip(model.feature_names, model.axes)}
+        elif isinstance(model, FlatForest) or is_flattenable(model):
+            names = [str(f) for f in model.feature_names_in_]
+            ranges = {name: r for name, r in zip(names, split_ranges(model)) if r is not None}
+        _ranges[model] = ranges
+    return ranges
+
+
+def forecast_instances(lat, lon, inputs, days=7):
+    """``inputs`` under the current weather, then under each forecast day's weather.
+
+    Weather fields the inputs already give (e.g. the dashboard's current
+    temp) are kept for the first instance and replaced for the forecast days.
+    """
+    instances = [dict(inputs)]
+    try:
+        daily = get_forecast_bundle(lat, lon).daily()
+    except Exception as e:
+        print("Error fetching forecast for sensitivity:", e)
+        return instances
+    for day in daily.head(days).to_dict("records"):
+        instances.append({**inputs, "temp": day["temp"], "rain": day["rain"], "humidity": day["humidity"],
+                          "wind": day["wind"]})
+    return instances
+
+
+class SensitivityError(ValueError):
+    pass
+
+
+def _sweep_values(compiled, ranges, instances_X, feature, points):
+    """Grid of values for ``feature``: its categories, or its split range widened to cover the instances."""
+    if feature in compiled.categories:
+        return np.array(sorted(compiled.categories[feature]), dtype=object)
+    if feature not in compiled.numeric:
+        raise SensitivityError(f"Model has no input '{feature}'")
+    current = instances_X[:, compiled.numeric[feature]]
+    lo, hi = ranges.get(feature, (float(current.min()), float(current.max())))
+    lo, hi = min(lo, float(current.min())), max(hi, float(current.max()))
+    if lo == hi:
+        lo, hi = lo - 1.0, hi + 1.0
+    return np.linspace(lo, hi, points)
+
+
+def _assign(compiled, block, feature, values, axis):
+    """Set ``feature`` to ``values`` along ``axis`` of a (..., n_features) block."""
+    shape = [1] * (block.ndim - 1)
+    shape[axis] = len(values)
+    if feature in compiled.numeric:
+        block[..., compiled.numeric[feature]] = np.asarray(values, dtype=np.float32).reshape(shape)
+        return
+    columns = compiled.categories[feature]
+    for column in columns.values():
+        block[..., column] = 0.0
+    for k, value in enumerate(values):
+        index = [slice(None)] * (block.ndim - 1)
+        index[axis] = k
+        block[tuple(index) + (columns[value],)] = 1.0
+
+
+def sensitivity(model, instances, features=(), pairs=(), schema=None, points=SENSITIVITY_POINTS,
+                pair_points=PAIR_POINTS, target=None, ice=True):
+    """PD/ICE curves for ``features`` and PD grids for ``pairs``, from one predict call.
+
+    For a classifier the curves are the probability of ``target`` (by
+    default the class predicted most often for the instances themselves).
+    """
+    compiled = compile_schema(model, **(schema or {}))
+    base = compiled.transform(list(instances))
+    n = len(base)
+    ranges = feature_ranges(model)
+
+    blocks, plan = [base], []
+    for feature in features:
+        values = _sweep_values(compiled, ranges, base, feature, points)
+        block = np.repeat(base[None], len(values), axis=0)            # (k, n, F)
+        _assign(compiled, block, feature, values, axis=0)
+        blocks.append(block.reshape(-1, base.shape[1]))
+        plan.append(("feature", feature, values))
+    for first, second in pairs:
+        x = _sweep_values(compiled, ranges, base, first, pair_points)
+        y = _sweep_values(compiled, ranges, base, second, pair_points)
+        block = np.repeat(np.repeat(base[None, None], len(x), axis=0), len(y), axis=1)   # (kx, ky, n, F)
+        _assign(compiled, block, first, x, axis=0)
+        _assign(compiled, block, second, y, axis=1)
+        blocks.append(block.reshape(-1, base.shape[1]))
+        plan.append(("pair", (first, second), (x, y)))
+
+    X = np.vstack(blocks)
+    classes = getattr(model, "classes_", None)
+    if classes is not None:
+        proba = model.predict_proba(compiled.model_input(model, X))
+        if target is None:
+            target = classes[np.bincount(proba[:n].argmax(axis=1), minlength=len(classes)).argmax()]
+        matches = [i for i, c in enumerate(classes) if str(c) == str(target)]
+        if not matches:
+            raise SensitivityError(f"Unknown target class '{target}'")
+        out = proba[:, matches[0]]
+    else:
+        out = np.asarray(model.predict(compiled.model_input(model, X)), dtype=np.float64)
+
+    result = {"target": None if target is None else str(target), "instances": n, "rows_predicted": len(X),
+              "base": out[:n].tolist(), "features": {}, "pairs": []}
+    start = n
+    for kind, name, values in plan:
+        if kind == "feature":
+            curves = out[start:start + len(values) * n].reshape(len(values), n).T      # (n, k)
+            start += len(values) * n
+            entry = {"values": values.tolist(), "pd": curves.mean(axis=0).tolist()}
+            if ice:
+                entry["ice"] = curves.tolist()
+            result["features"][name] = entry
+        else:
+            x, y = values
+            grid = out[start:start + len(x) * len(y) * n].reshape(len(x), len(y), n)
+            start += len(x) * len(y) * n
+            result["pairs"].append({"features": list(name), "x": x.tolist(), "y": y.tolist(),
+                                    "pd": grid.mean(axis=2).tolist()})
+    return result
+
+
+def sensitivity_for(name, instances, model=None, **spec):
+    """``sensitivity`` for registry model ``name``, cached per (model version, instances, request).
+
+    The instances carry the location's forecast, so a refreshed forecast or
+    a reloaded model file both miss the cache. ``model`` overrides the
+    model object (e.g. the yield ResponseSurface) while keeping the
+    registry's version in the key.
+    """
+    if name not in SENSITIVITY_MODELS:
+        raise SensitivityError(f"No sensitivity analysis for model '{name}'")
+    try:
+        registered, version = registry.get_versioned(name)
+    except KeyError:
+        raise SensitivityError(f"Model '{name}' is not available here") from None
+    model = registered if model is None else model
+    key = (name, version, type(model).__name__,
+           json.dumps({"instances": instances, **spec}, sort_keys=True, default=str))
+    result = _cache.get(key)
+    if result is None:
+        result = sensitivity(model, instances, schema=SENSITIVITY_MODELS[name], **spec)
+        result.update(model=name, version=version)
+        _cache.set(key, result)
+    return result
+
+
+def sensitivity_request(body):
+    """The /sensitivity endpoints: JSON body -> ``sensitivity_for`` result.
+
+    ``{"model": "yield", "inputs": {...}, "features": [...], "pairs": [[a, b]]}``
+    plus optional ``lat``/``lon`` (instances for each forecast day), ``points``,
+    ``pair_points``, ``target`` and ``ice``.
+    """
+    if not isinstance(body, dict) or not isinstance(body.get("inputs"), dict):
+        raise SensitivityError("Body needs an 'inputs' object")
+    features = body.get("features") or []
+    pairs = body.get("pairs") or []
+    if not isinstance(features, list) or not isinstance(pairs, list):
+        raise SensitivityError("'features' and 'pairs' must be lists")
+    if any(not isinstance(p, list) or len(p) != 2 for p in pairs):
+        raise SensitivityError("Each pair must name two features")
+    pairs = [tuple(p) for p in pairs]
+    # Names reach set/dict lookups in the schema, so anything but a string is a bad request, not a 500
+    if not all(isinstance(name, str) for name in features + [n for p in pairs for n in p]):
+        raise SensitivityError("Features must be given by input name")
+    if len(features) + len(pairs) > MAX_SWEEPS:
+        raise SensitivityError(f"At most {MAX_SWEEPS} features and pairs per request")
+    try:
+        points = min(int(body.get("points", SENSITIVITY_POINTS)), MAX_POINTS)
+        pair_points = min(int(body.get("pair_points", PAIR_POINTS)), MAX_POINTS)
+        if body.get("lat") is not None and body.get("lon") is not None:
+            instances = forecast_instances(float(body["lat"]), float(body["lon"]), body["inputs"])
+        else:
+            instances = [body["inputs"]]
+    except (TypeError, ValueError):
+        raise SensitivityError("Invalid number in request") from None
+    return sensitivity_for(body.get("model", "yield"), instances, features=features, pairs=pairs, points=points,
+                           pair_points=pair_points, target=body.get("target"), ice=bool(body.get("ice", True)))
+
+
+# ---------------------- BENCHMARK ----------------------
+def _benchmark(repeat=20):
+    import timeit
+    import warnings
+
+    import pandas as pd
+
+    warnings.filterwarnings("ignore")
+    here = os.path.dirname(os.path.abspath(__file__))
+    registry.register("fertilizer", os.path.join(here, "model", "fertilizer_model.pkl"))
+    model = registry.get("fertilizer")
+    rng = np.random.default_rng(0)
+    instances = [{"ozone": 60.0, "temp": t, "rain": r, "soil": 0.25, "ph": 5.8, "stage": "Tuberization"}
+                 for t, r in zip(rng.uniform(18, 32, 8), rng.uniform(0, 20, 8))]
+    features = ["ozone", "temp", "rain", "soil", "ph"]
+    compiled = compile_schema(model, **FERTILIZER_SCHEMA)
+
+    def one_call_per_curve():
+        # How the ozone chart was drawn: a frame of sweep values per feature and instance
+        for feature in features:
+            for row in instances:
+                frame = pd.DataFrame({**row, feature: np.linspace(0, 1, SENSITIVITY_POINTS)})
+                model.predict_proba(compiled.model_input(model, compiled.transform(frame)))
+
+    batched = timeit.timeit(lambda: sensitivity(model, instances, features, schema=FERTILIZER_SCHEMA),
+                            number=repeat) / repeat
+    per_curve = timeit.timeit(one_call_per_curve, number=1)
+    result = sensitivity(model, instances, features, pairs=[("ozone", "ph")], schema=FERTILIZER_SCHEMA)
+    print(f"5-feature sweep, {len(instances)} instances x {SENSITIVITY_POINTS} points: one batched call "
+          f"{batched * 1e3:.1f} ms vs {per_curve * 1e3:.0f} ms with one predict per curve")
+    print(f"with an ozone x ph grid: {result['rows_predicted']} rows in one call, target '{result['target']}'")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,260 @@
+"""Farm-wide spray schedule: which sprayer sprays which field when.
+
+Per-field best windows (spray_windows.py) ignore that a few sprayers cover
+every field, so neighbouring fields all want the same morning. Here every
+(field, window start) pair is a candidate job worth its window confidence.
+A sprayer does one job at a time and needs the driving time between two
+fields plus ``min_gap_hours`` (refill, rinse) between jobs, and each field
+is sprayed at most once. The schedule is built greedily from the best
+candidates down, then every job is taken out and put back at the best
+slot still free, until a pass changes nothing.
+
+    python spray_schedule.py        # 200 fields x 168 hours with 3 sprayers
+"""
+import bisect
+
+import numpy as np
+import pandas as pd
+
+from model_registry import registry
+from spray_windows import SPRAY_WINDOW_HOURS, feasible_starts, window_label, window_means
+from utils import fetch_forecast_bundles
+
+# ---------------------- CONFIG ----------------------
+SPRAYERS = 2
+TRAVEL_KMH = 30.0               # road speed of a sprayer between fields
+MIN_GAP_HOURS = 0.5             # idle time between two jobs of one sprayer, on top of travel
+MIN_CONFIDENCE = 0.1            # windows below this are never scheduled
+SPRAY_FEATURES = ["hour", "temp", "humidity", "wind", "ozone", "rain"]
+MAX_FIELDS = 1000
+MAX_PASSES = 5
+# -----------------------------------------------------
+
+
+def distance_km(locations):
+    """Great-circle distances between every pair of (lat, lon) points, as an (n, n) matrix."""
+    lat, lon = np.radians(np.asarray(locations, dtype=np.float64).reshape(-1, 2)).T
+    h = np.sin((lat[:, None] - lat) / 2) ** 2 + np.cos(lat[:, None]) * np.cos(lat) * np.sin((lon[:, None] - lon) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+class Sprayer:
+    """One sprayer's jobs as parallel lists sorted by start hour."""
+
+    def __init__(self):
+        self.starts, self.ends, self.fields = [], [], []
+
+    def slot(self, start, end, field, changeover):
+        """Insert position for the job, or None if it clashes with a neighbouring job."""
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0 and self.ends[i - 1] + changeover(self.fields[i - 1], field) > start:
+            return None
+        if i < len(self.starts) and end + changeover(field, self.fields[i]) > self.starts[i]:
+            return None
+        return i
+
+    def add(self, i, start, end, field):
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.fields.insert(i, field)
+
+    def remove(self, field):
+        i = self.fields.index(field)
+        del self.starts[i], self.ends[i], self.fields[i]
+
+
+def schedule(scores, starts, locations, sprayers=SPRAYERS, width=SPRAY_WINDOW_HOURS, travel_kmh=TRAVEL_KMH,
+             min_gap_hours=MIN_GAP_HOURS, min_confidence=MIN_CONFIDENCE):
+    """Conflict-free jobs maximising total confidence (greedy plus re-insertion passes).
+
+    ``scores[f]`` holds field f's window confidences (-inf where a
+    constraint rules the window out), ``starts[f]`` the absolute start hour
+    of each window and ``locations[f]`` its (lat, lon). Returns
+    ``{field: (sprayer, window index)}``.
+    """
+    n = len(scores)
+    # Hours a sprayer needs between finishing at field a and starting at field b; plain lists index fastest
+    travel = (distance_km(locations) / travel_kmh + min_gap_hours).tolist()
+
+    def changeover(a, b):
+        return travel[a][b]
+
+    # Candidates from the best down; each field's windows in its own ranked order for re-insertion
+    ranked = [np.argsort(-s, kind="stable") for s in scores]
+    ranked = [r[s[r] >= min_confidence] for r, s in zip(ranked, scores)]
+    field_of = np.concatenate([np.full(len(r), f) for f, r in enumerate(ranked)]) if n else np.empty(0, int)
+    window_of = np.concatenate(ranked) if n else np.empty(0, int)
+    value = np.concatenate([s[r] for s, r in zip(scores, ranked)]) if n else np.empty(0)
+    order = np.argsort(-value, kind="stable")
+
+    machines = [Sprayer() for _ in range(sprayers)]
+    assigned = {}
+
+    def place(f, k):
+        start = float(starts[f][k])
+        for m, machine in enumerate(machines):
+            i = machine.slot(start, start + width, f, changeover)
+            if i is not None:
+                machine.add(i, start, start + width, f)
+                assigned[f] = (m, int(k))
+                return True
+        return False
+
+    for j in order:
+        f = int(field_of[j])
+        if f not in assigned:
+            place(f, window_of[j])
+        if len(assigned) == n:
+            break
+
+    # Re-insertion: free a field's job and put it at its best slot that is free now
+    for _ in range(MAX_PASSES):
+        improved = False
+        by_value = sorted(range(n), key=lambda f: scores[f][assigned[f][1]] if f in assigned else -np.inf)
+        for f in by_value:
+            current = assigned.pop(f, None)
+            if current is not None:
+                machines[current[0]].remove(f)
+            for k in ranked[f]:
+                if current is not None and scores[f][k] <= scores[f][current[1]]:
+                    break
+                if place(f, k):
+                    improved = True
+                    break
+            if f not in assigned and current is not None:
+                m, k = current
+                start = float(starts[f][k])
+                machines[m].add(machines[m].slot(start, start + width, f, changeover), start, start + width, f)
+                assigned[f] = current
+        if not improved:
+            break
+    return assigned
+
+
+def farm_schedule(fields, sprayers=SPRAYERS, width=SPRAY_WINDOW_HOURS, travel_kmh=TRAVEL_KMH,
+                  min_gap_hours=MIN_GAP_HOURS, min_confidence=MIN_CONFIDENCE, daylight=True, rain_free_hours=None,
+                  model_name="spray"):
+    """Schedule for ``fields`` ({name: {"lat", "lon"}}) from one predict_proba over every field's forecast."""
+    if len(fields) > MAX_FIELDS:
+        raise ValueError(f"At most {MAX_FIELDS} fields per schedule")
+    if sprayers < 1 or width < 1 or travel_kmh <= 0:
+        raise ValueError("sprayers and hours must be at least 1 and travel_kmh positive")
+    names, frames, locations = [], [], []
+    bundles = fetch_forecast_bundles(fields)
+    for name, bundle in bundles.items():
+        try:
+            frame = bundle.hourly() if bundle is not None else None
+        except Exception as e:
+            print("Error reading hourly forecast:", e)
+            frame = None
+        if frame is not None and len(frame) >= width:
+            names.append(name)
+            frames.append(frame)
+            locations.append((float(fields[name]["lat"]), float(fields[name]["lon"])))
+
+    scores, starts, times = [], [], []
+    if frames:
+        probability = registry.get(model_name).predict_proba(
+            pd.concat([f[SPRAY_FEATURES] for f in frames], ignore_index=True))[:, 1]
+        # Absolute hours since the earliest forecast hour, so fields in different time zones line up
+        utc_s = [f["time"].array.as_unit("s").asi8 for f in frames]
+        origin = min(t[0] for t in utc_s)
+        offset = 0
+        for frame, t in zip(frames, utc_s):
+            means = window_means(probability[offset:offset + len(frame)], width)
+            offset += len(frame)
+            mask = feasible_starts(frame, width, daylight, rain_free_hours)
+            scores.append(np.where(mask, means, -np.inf))
+            starts.append((t[:len(means)] - origin) / 3600.0)
+            times.append(frame["time"].array)
+
+    assigned = schedule(scores, starts, locations, sprayers, width, travel_kmh, min_gap_hours, min_confidence)
+    jobs = []
+    for f, (m, k) in assigned.items():
+        jobs.append({"field": names[f], "sprayer": m + 1, "start": times[f][k].isoformat(),
+                     "end": (times[f][k] + pd.Timedelta(hours=width)).isoformat(),
+                     "window": window_label(frames[f]["hour"].to_numpy(), k, width),
+                     "confidence": float(scores[f][k])})
+    jobs.sort(key=lambda j: (j["sprayer"], j["start"]))
+    best = [float(s.max()) for s in scores if len(s) and s.max() >= min_confidence]
+    total = sum(j["confidence"] for j in jobs)
+    return {
+        "fields": len(fields),
+        "sprayers": sprayers,
+        "scheduled": len(jobs),
+        "unscheduled": sorted(set(fields) - {j["field"] for j in jobs}),
+        "total_confidence": total,
+        # Every field at its own best window, ignoring the sprayers: no schedule can beat this
+        "upper_bound": sum(best),
+        "jobs": jobs,
+    }
+
+
+def schedule_request(body, saved_fields):
+    """The /spray_schedule endpoints: JSON body -> ``farm_schedule`` result.
+
+    ``{"fields": {name: {"lat", "lon"}}}`` (default: every saved field) plus
+    optional ``sprayers``, ``hours``, ``travel_kmh``, ``min_gap_hours``,
+    ``min_confidence``, ``daylight`` and ``rain_free_hours``.
+    """
+    body = body or {}
+    if not isinstance(body, dict):
+        raise ValueError("Body must be a JSON object")
+    fields = body.get("fields") or saved_fields()
+    if not isinstance(fields, dict) or not fields:
+        raise ValueError("No fields to schedule")
+    try:
+        fields = {str(name): {"lat": float(f["lat"]), "lon": float(f["lon"])} for name, f in fields.items()}
+        rain_free_hours = body.get("rain_free_hours")
+        return farm_schedule(
+            fields, sprayers=int(body.get("sprayers", SPRAYERS)), width=int(body.get("hours", SPRAY_WINDOW_HOURS)),
+            travel_kmh=float(body.get("travel_kmh", TRAVEL_KMH)),
+            min_gap_hours=float(body.get("min_gap_hours", MIN_GAP_HOURS)),
+            min_confidence=float(body.get("min_confidence", MIN_CONFIDENCE)),
+            daylight=bool(body.get("daylight", True)),
+            rain_free_hours=None if rain_free_hours is None else int(rain_free_hours),
+        )
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid request: {e}") from None
+
+
+# ---------------------- BENCHMARK ----------------------
+def _check(assigned, scores, starts, locations, width, travel_kmh, min_gap_hours):
+    km = distance_km(locations)
+    jobs = {}
+    for f, (m, k) in assigned.items():
+        assert np.isfinite(scores[f][k])
+        jobs.setdefault(m, []).append((starts[f][k], f))
+    for m, items in jobs.items():
+        items.sort()
+        for (s1, f1), (s2, f2) in zip(items, items[1:]):
+            assert s1 + width + km[f1, f2] / travel_kmh + min_gap_hours <= s2 + 1e-9
+
+
+def _benchmark(n_fields=200, hours=168, sprayers=3):
+    import time
+
+    rng = np.random.default_rng(0)
+    hour = np.arange(hours) % 24
+    daylight = (hour >= 6) & (hour <= 16)
+    locations = [(12.9 + rng.uniform(-0.2, 0.2), 77.6 + rng.uniform(-0.2, 0.2)) for _ in range(n_fields)]
+    scores, starts = [], []
+    for _ in range(n_fields):
+        # Smooth daily cycle plus noise, so nearby fields want the same hours
+        p = np.clip(0.5 + 0.35 * np.sin((hour - 4) / 24 * 2 * np.pi) + rng.normal(0, 0.15, hours), 0, 1)
+        means = window_means(p)
+        scores.append(np.where(daylight[:len(means)], means, -np.inf))
+        starts.append(np.arange(len(means), dtype=float))
+
+    start = time.perf_counter()
+    assigned = schedule(scores, starts, locations, sprayers)
+    elapsed = time.perf_counter() - start
+    _check(assigned, scores, starts, locations, SPRAY_WINDOW_HOURS, TRAVEL_KMH, MIN_GAP_HOURS)
+    total = sum(scores[f][k] for f, (_, k) in assigned.items())
+    bound = sum(s.max() for s in scores)
+    print(f"{n_fields} fields x {hours} hours, {sprayers} sprayers: {len(assigned)} scheduled in {elapsed:.2f} s, "
+          f"total confidence {total:.1f} of at most {bound:.1f} ({total / bound:.1%}), no conflicts")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -1,75 +1,388 @@
 import requests
+import httpx
 import pandas as pd
 import numpy as np
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import joblib
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from history_store import get_history_store, location_id
+from feature_schema import compile_schema
+from resilience import CircuitBreaker, CircuitOpenError, LastGoodStore, SingleFlight, TTLCache, is_upstream_failure
+
+# Override to point every app at a stand-in server (see weather_standin.py)
+OPEN_METEO_URL = os.environ.get("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+
+# Open-Meteo's best-match models resolve at roughly 0.1° (~11 km), so points
+# inside the same cell get the same forecast and can share a cache entry.
+FORECAST_GRID_DEG = 0.1
+
+# (connect, read) timeouts in seconds for upstream weather calls
+HTTP_TIMEOUT = (3.05, 10)
+
+# Append every forecast pulled and prediction made to history_store
+HISTORY_ENABLED = os.environ.get("HISTORY_ENABLED", "1") == "1"
+
+# Last good forecast per grid cell, for answering while offline
+LAST_GOOD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".weather_cache")
+
+
+def grid_key(lat, lon, resolution=FORECAST_GRID_DEG):
+    """Snap a coordinate to the centre of its forecast grid cell."""
+    return (round(round(lat / resolution) * resolution, 4),
+            round(round(lon / resolution) * resolution, 4))
+
+
+class WeatherClient:
+    """Shared Open-Meteo client: pooled keep-alive session, timeouts and a grid-cell cache."""
+
+    def __init__(self, base_url=OPEN_METEO_URL, timeout=HTTP_TIMEOUT, cache_ttl=600,
+                 cache_size=2048, resolution=FORECAST_GRID_DEG, pool_size=20,
+                 stale_ttl=6 * 3600, last_good_dir=LAST_GOOD_DIR):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.resolution = resolution
+        self.pool_size = pool_size
+        self._async_session = None
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl, stale_ttl=stale_ttl)
+        self.flight = SingleFlight()
+        self.breaker = CircuitBreaker()
+        self.last_good = LastGoodStore(last_good_dir)
+        self.offline_served = 0
+        self.session = requests.Session()
+        retry = Retry(total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504),
+                      allowed_methods=("GET",))
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def fetch(self, lat, lon, **params):
+        """Fetch the grid cell containing (lat, lon) from upstream, bypassing the cache."""
+        cell = grid_key(lat, lon, self.resolution)
+        query = {"latitude": cell[0], "longitude": cell[1], **params}
+        return self.breaker.call(self._get, query)
+
+    def _get(self, query):
+        res = self.session.get(self.base_url, params=query, timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
+
+    def fetch_many(self, cells, **params):
+        """Fetch several grid cells in one multi-location request; returns one payload per cell."""
+        query = {
+            "latitude": ",".join(str(lat) for lat, _ in cells),
+            "longitude": ",".join(str(lon) for _, lon in cells),
+            **params,
+        }
+        data = self.breaker.call(self._get, query)
+        # Open-Meteo only returns a list when more than one location is requested
+        return data if isinstance(data, list) else [data]
+
+    async def afetch(self, lat, lon, **params):
+        """Async twin of fetch() for the FastAPI apps; shares the same cache keys."""
+        cell = grid_key(lat, lon, self.resolution)
+        query = {"latitude": cell[0], "longitude": cell[1], **params}
+        if self._async_session is None or self._async_session.is_closed:
+            self._async_session = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout[1], connect=self.timeout[0]),
+                limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            )
+        return await self.breaker.call_async(self._aget, query)
+
+    async def _aget(self, query):
+        res = await self._async_session.get(self.base_url, params=query)
+        res.raise_for_status()
+        return await asyncio.to_thread(res.json)
+
+    async def aclose(self):
+        if self._async_session is not None:
+            await self._async_session.aclose()
+            self._async_session = None
+
+    def stats(self):
+        return {**self.cache.stats(), **self.flight.stats(), **self.breaker.stats(),
+                "offline_served": self.offline_served}
+
+
+class ForecastBundle:
+    """One Open-Meteo response holding the current, hourly and daily blocks for a grid cell.
+
+    The hourly and daily frames are built once on first use; the public
+    helpers below hand out copies so callers can add columns freely.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._hourly = None
+        self._daily = None
+
+    def current(self):
+        if 'current_weather' not in self.data:
+            return None
+        hourly = self.data['hourly']
+        return {
+            "temp": self.data['current_weather']['temperature'],
+            "humidity": hourly['relative_humidity_2m'][0],
+            "rain": hourly['precipitation'][0],
+            "wind": self.data['current_weather']['windspeed']
+        }
+
+    def hourly(self):
+        if self._hourly is None:
+            hourly = self.data.get("hourly", {})
+            # Open-Meteo returns local wall-clock times plus the offset from UTC
+            offset = timezone(timedelta(seconds=self.data.get("utc_offset_seconds", 0)))
+            times = pd.to_datetime(hourly["time"])
+            df = pd.DataFrame({
+                "time": times.tz_localize(offset),
+                "hour": times.hour,
+                "temp": hourly["temperature_2m"],
+                "humidity": hourly["relative_humidity_2m"],
+                "rain": hourly["precipitation"],
+                "wind": hourly["windspeed_10m"]
+            })
+            # Assume constant ozone value (to be updated from app.py input)
+            df["ozone"] = 60  # Placeholder
+            self._hourly = df
+        return self._hourly
+
+    def daily(self):
+        if self._daily is None:
+            daily = self.data.get("daily", {})
+            if not daily:
+                self._daily = pd.DataFrame()
+            else:
+                self._daily = pd.DataFrame({
+                    "day": pd.to_datetime(daily["time"]).strftime("%a"),
+                    "temp": daily["temperature_2m_max"],
+                    "rain": daily["precipitation_sum"],
+                    "wind": daily["windspeed_10m_max"],
+                    "humidity": daily["relative_humidity_2m_max"]
+                })
+        return self._daily
+
+
+# Superset of the variables every forecast helper needs, fetched in one call
+FORECAST_PARAMS = {
+    "current_weather": "true",
+    "hourly": "temperature_2m,relative_humidity_2m,precipitation,windspeed_10m",
+    "daily": "temperature_2m_max,temperature_2m_min,precipitation_sum,windspeed_10m_max,relative_humidity_2m_max",
+    "timezone": "auto",
+}
+
+
+weather_client = WeatherClient()
+
+
+def get_forecast_bundle(lat, lon):
+    """Fetch (or reuse) the combined forecast for the grid cell containing (lat, lon).
+
+    Stale cached bundles are served immediately while a background refresh
+    runs; if upstream is down the last good forecast saved on disk is used.
+    """
+    key = (grid_key(lat, lon, weather_client.resolution), "bundle")
+    bundle = _cached_bundle(key, lat, lon)
+    if bundle is None:
+        bundle = weather_client.flight.do(key, _load_bundle, key, lat, lon)
+    return bundle
+
+# Background refreshes for stale cache entries and last-good writes
+_background = ThreadPoolExecutor(max_workers=4, thread_name_prefix="weather-refresh")
+
+def _cached_bundle(key, lat, lon):
+    bundle, fresh = weather_client.cache.lookup(key)
+    if bundle is not None and not fresh and not weather_client.flight.in_flight(key):
+        _background.submit(_refresh_bundle, key, lat, lon)
+    return bundle
+
+def _refresh_bundle(key, lat, lon):
+    try:
+        weather_client.flight.do(key, _load_bundle, key, lat, lon)
+    except Exception as e:
+        print("Error refreshing forecast:", e)
+
+def _store_bundle(key, data):
+    bundle = ForecastBundle(data)
+    weather_client.cache.set(key, bundle)
+    _background.submit(weather_client.last_good.save, key[0], data)
+    if HISTORY_ENABLED:
+        _background.submit(_record_forecast_history, key[0], bundle)
+    return bundle
+
+def _record_forecast_history(cell, bundle):
+    try:
+        hourly = bundle.hourly()
+        get_history_store().record_forecast(
+            location_id(*cell), "open_meteo", time.time(), hourly["time"],
+            temp=hourly["temp"], humidity=hourly["humidity"], rain=hourly["rain"], wind=hourly["wind"],
+        )
+    except Exception as e:
+        print("Error recording forecast history:", e)
+
+def record_prediction(lat, lon, kind, values=None, labels=None, valid_times=None, targets=None):
+    """Append predictions made for a location to the history store (never raises)."""
+    if not HISTORY_ENABLED:
+        return
+    try:
+        if valid_times is None:
+            valid_times = [datetime.now(timezone.utc)] * len(values if values is not None else labels)
+        get_history_store().record_predictions(location_id(lat, lon), kind, time.time(), valid_times,
+                                               values=values, labels=labels, targets=targets)
+    except Exception as e:
+        print("Error recording prediction history:", e)
+
+def record_predictions_many(kind, locations, values=None, labels=None, valid_times=None):
+    """record_prediction for many ``(lat, lon)`` entries in a single history write (never raises)."""
+    if not HISTORY_ENABLED or not locations:
+        return
+    try:
+        if valid_times is None:
+            valid_times = [datetime.now(timezone.utc)] * len(locations)
+        get_history_store().record_prediction_rows(kind, time.time(), [location_id(lat, lon) for lat, lon in locations],
+                                                   valid_times, values=values, labels=labels)
+    except Exception as e:
+        print("Error recording prediction history:", e)
+
+def _offline_bundle(key, error):
+    data = weather_client.last_good.load(key[0])
+    if data is None:
+        raise error
+    print("Serving last good forecast after upstream error:", error)
+    weather_client.offline_served += 1
+    bundle = ForecastBundle(data)
+    # Cached as already stale, so the next request retries upstream in the background
+    weather_client.cache.set(key, bundle, ttl=0)
+    return bundle
+
+def _load_bundle(key, lat, lon):
+    # A leader that finished just before we joined may already have filled the cache
+    bundle = weather_client.cache.peek(key)
+    if bundle is not None:
+        return bundle
+    try:
+        data = weather_client.fetch(lat, lon, **FORECAST_PARAMS)
+    except Exception as e:
+        return _offline_bundle(key, e)
+    return _store_bundle(key, data)
+
+# Locations per multi-location request (keeps the query string well under URL limits)
+BATCH_CHUNK_SIZE = 100
+BATCH_CONCURRENCY = 4
+
+def fetch_forecast_bundles(fields, chunk_size=BATCH_CHUNK_SIZE, max_concurrency=BATCH_CONCURRENCY):
+    """Fetch bundles for many fields with as few upstream calls as possible.
+
+    ``fields`` has the fields.json shape, ``{name: {"lat": ..., "lon": ...}}``.
+    Fields sharing a grid cell share a bundle, fresh cached cells are not
+    refetched, and the remaining cells are split into multi-location requests
+    that run at most ``max_concurrency`` at a time. When a chunk fails its
+    cells fall back to the stale or last good forecast, else map to None.
+    """
+    cells = {name: grid_key(f["lat"], f["lon"], weather_client.resolution) for name, f in fields.items()}
+    bundles = {}
+    missing = []
+    for cell in dict.fromkeys(cells.values()):
+        bundle, fresh = weather_client.cache.lookup((cell, "bundle"))
+        if bundle is not None:
+            bundles[cell] = bundle
+        if not fresh:
+            missing.append(cell)
+
+    def fetch_chunk(chunk):
+        try:
+            payloads = weather_client.fetch_many(chunk, **FORECAST_PARAMS)
+        except Exception as e:
+            print("Error fetching forecast batch:", e)
+            for cell in chunk:
+                if cell not in bundles:
+                    try:
+                        bundles[cell] = _offline_bundle((cell, "bundle"), e)
+                    except Exception:
+                        pass
+            return
+        for cell, data in zip(chunk, payloads):
+            bundles[cell] = _store_bundle((cell, "bundle"), data)
+
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(chunks)))) as pool:
+            list(pool.map(fetch_chunk, chunks))
+
+    return {name: bundles.get(cell) for name, cell in cells.items()}
+
+def get_hourly_forecasts(fields, **kwargs):
+    """Per-field hourly frames for every saved field; empty frame when unavailable."""
+    bundles = fetch_forecast_bundles(fields, **kwargs)
+    return {name: b.hourly().copy() if b is not None else pd.DataFrame() for name, b in bundles.items()}
 
 def fetch_weather_data(lat, lon):
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=temperature_2m,relative_humidity_2m,precipitation,windspeed_10m&current_weather=true"
-        res = requests.get(url)
-        data = res.json()
-
-        if 'current_weather' in data:
-            temp = data['current_weather']['temperature']
-            wind = data['current_weather']['windspeed']
-            hourly = data['hourly']
-            humidity = hourly['relative_humidity_2m'][0]
-            rain = hourly['precipitation'][0]
-            return {
-                "temp": temp,
-                "humidity": humidity,
-                "rain": rain,
-                "wind": wind
-            }
-        else:
+        weather = get_forecast_bundle(lat, lon).current()
+        if weather is None:
             print("No current weather data found.")
-            return None
+        return weather
     except Exception as e:
         print("Error fetching weather data:", e)
         return None
 
 def get_hourly_forecast(lat, lon):
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=temperature_2m,relative_humidity_2m,precipitation,windspeed_10m&timezone=auto"
-        res = requests.get(url)
-        data = res.json()
-
-        hourly = data.get("hourly", {})
-        df = pd.DataFrame({
-            "hour": pd.to_datetime(hourly["time"]).hour,
-            "temp": hourly["temperature_2m"],
-            "humidity": hourly["relative_humidity_2m"],
-            "rain": hourly["precipitation"],
-            "wind": hourly["windspeed_10m"]
-        })
-
-        # Assume constant ozone value (to be updated from app.py input)
-        df["ozone"] = 60  # Placeholder
-        return df
+        return get_forecast_bundle(lat, lon).hourly().copy()
     except Exception as e:
         print("Error fetching forecast:", e)
         return pd.DataFrame()
 
 def get_7_day_forecast(lat, lon):
     try:
-        url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&daily=temperature_2m_max,temperature_2m_min,precipitation_sum,windspeed_10m_max,relative_humidity_2m_max&timezone=auto"
-        res = requests.get(url)
-        data = res.json()
-
-        daily = data.get("daily", {})
-        if not daily:
-            return pd.DataFrame()
-
-        df = pd.DataFrame({
-            "day": pd.to_datetime(daily["time"]).strftime("%a"),
-            "temp": daily["temperature_2m_max"],
-            "rain": daily["precipitation_sum"],
-            "wind": daily["windspeed_10m_max"],
-            "humidity": daily["relative_humidity_2m_max"]
-        })
-
-        return df
+        return get_forecast_bundle(lat, lon).daily().copy()
+    except Exception as e:
+        print("Error fetching 7-day forecast:", e)
+        return pd.DataFrame()
+
+async def get_forecast_bundle_async(lat, lon):
+    key = (grid_key(lat, lon, weather_client.resolution), "bundle")
+    bundle = _cached_bundle(key, lat, lon)
+    if bundle is None:
+        bundle = await weather_client.flight.do_async(key, _load_bundle_async, key, lat, lon)
+    return bundle
+
+async def _load_bundle_async(key, lat, lon):
+    bundle = weather_client.cache.peek(key)
+    if bundle is not None:
+        return bundle
+    try:
+        data = await weather_client.afetch(lat, lon, **FORECAST_PARAMS)
+    except Exception as e:
+        return await asyncio.to_thread(_offline_bundle, key, e)
+    return _store_bundle(key, data)
+
+async def fetch_weather_data_async(lat, lon):
+    try:
+        weather = (await get_forecast_bundle_async(lat, lon)).current()
+        if weather is None:
+            print("No current weather data found.")
+        return weather
+    except Exception as e:
+        print("Error fetching weather data:", e)
+        return None
+
+async def get_hourly_forecast_async(lat, lon):
+    try:
+        bundle = await get_forecast_bundle_async(lat, lon)
+        # Building the frame parses every timestamp; keep it off the event loop
+        return await asyncio.to_thread(lambda: bundle.hourly().copy())
+    except Exception as e:
+        print("Error fetching forecast:", e)
+        return pd.DataFrame()
+
+async def get_7_day_forecast_async(lat, lon):
+    try:
+        bundle = await get_forecast_bundle_async(lat, lon)
+        return await asyncio.to_thread(lambda: bundle.daily().copy())
     except Exception as e:
         print("Error fetching 7-day forecast:", e)
         return pd.DataFrame()
@@ -96,25 +409,45 @@ def generate_weather_alerts(forecast_df):
 
     return alerts
 
-def recommend_fertilizer(input_df, model):
-    input_df = pd.get_dummies(input_df)
-    for col in model.feature_names_in_:
-        if col not in input_df.columns:
-            input_df[col] = 0
-    input_df = input_df[model.feature_names_in_]
-    return model.predict(input_df)[0]
-
-def predict_stress_level(model, input_df):
-    input_df = pd.get_dummies(input_df)
-    for col in model.feature_names_in_:
-        if col not in input_df.columns:
-            input_df[col] = 0
-    input_df = input_df[model.feature_names_in_]
-
-    prediction = model.predict(input_df)[0]
+# How raw form inputs map onto the fertilizer/stress models' get_dummies columns
+FERTILIZER_SCHEMA = dict(
+    categorical=("stage",),
+    unknown="error",
+    # fert_model.pkl was trained with humidity, which the fertilizer forms never send
+    defaults={"humidity": 0.0},
+)
+STRESS_SCHEMA = dict(
+    categorical=("color", "symptom"),
+    # Dashboard labels -> the labels stress_model.pkl was trained on; Purple Tint,
+    # Curling and Stunted Growth have no trained equivalent and encode as all-zero
+    aliases={
+        "color": {"Dark Green": "Green", "Yellowing": "Yellow", "Brown Spots": "Brown"},
+    },
+    unknown="zero",
+    # The stress forms never ask for soil moisture
+    defaults={"soil": 0.0},
+)
+
+def _model_features(inputs, model, options):
+    """Inputs (a mapping for one prediction, or a DataFrame batch) -> the model's feature matrix."""
+    schema = compile_schema(model, **options)
+    if isinstance(inputs, pd.DataFrame):
+        X = schema.transform(inputs)
+    else:
+        X = schema.transform_one(inputs)
+    return schema.model_input(model, X)
+
+def recommend_fertilizer(inputs, model):
+    return model.predict(_model_features(inputs, model, FERTILIZER_SCHEMA))[0]
+
+def predict_stress_level(model, inputs):
+    prediction = model.predict(_model_features(inputs, model, STRESS_SCHEMA))[0]
+    return prediction, stress_explanation(prediction)
+
+def stress_explanation(prediction):
     explanation = {
         "Low": "Healthy plant: Dark green leaves, no visible symptoms.",
         "Medium": "Mild stress detected: Possible leaf curling or slight discoloration.",
         "High": "High stress detected: Brown spots, yellowing, stunted growth due to ozone or nutrient imbalance."
     }
-    return prediction, explanation.get(prediction, "Unknown stress level.")
+    return explanation.get(prediction, "Unknown stress level.")
@@ -1,54 +1,82 @@
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from utils import fetch_weather_data, get_hourly_forecast, generate_weather_alerts, get_7_day_forecast
-import joblib
-import pandas as pd
+from contextlib import asynccontextmanager
+from utils import fetch_weather_data_async, get_hourly_forecast_async, generate_weather_alerts, get_7_day_forecast_async, get_hourly_forecasts, record_prediction, weather_client
+from typing import Dict, Optional
+from model_registry import registry
+from bulk import load_saved_fields
+from spray_schedule import schedule_request
+from spray_windows import SPRAY_WINDOW_HOURS, spray_response, spray_windows
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the spray model before serving, off the event loop
+    await run_in_threadpool(registry.preload)
+    yield
+    await weather_client.aclose()
+
+
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-time_model = joblib.load("model/best_window_model.pkl")
+registry.register("spray", "model/best_window_model.pkl")
 
 @app.get("/", response_class=HTMLResponse)
-def index(request: Request):
+async def index(request: Request):
     return templates.TemplateResponse("weather.html", {"request": request})
 
 @app.get("/weather")
-def get_weather(lat: float, lon: float):
-    weather = fetch_weather_data(lat, lon)
+async def get_weather(lat: float, lon: float):
+    weather = await fetch_weather_data_async(lat, lon)
     if not weather:
         return JSONResponse({'error': 'Weather data unavailable'}, status_code=500)
     return {"weather": weather}
 
+def spray_probability(hourly_data):
+    # registry.get may load or reload the model from disk, so it runs in the threadpool too
+    return registry.get("spray").predict_proba(hourly_data[["hour", "temp", "humidity", "wind", "ozone", "rain"]])[:, 1]
+
 @app.get("/spray_window")
-def spray_window(lat: float, lon: float):
-    hourly_data = get_hourly_forecast(lat, lon)
+async def spray_window(lat: float, lon: float, hours: int = SPRAY_WINDOW_HOURS, top: int = 1, per_day: bool = False,
+                       daylight: bool = False, rain_free_hours: Optional[int] = None):
+    hourly_data = await get_hourly_forecast_async(lat, lon)
     if hourly_data.empty:
         return JSONResponse({'result': 'No hourly forecast data available.', 'window': None})
-    hourly_data['probability'] = time_model.predict_proba(
-        hourly_data[["hour", "temp", "humidity", "wind", "ozone", "rain"]]
-    )[:, 1]
-    best_window = None
-    best_score = -1
-    for i in range(len(hourly_data) - 2):
-        window = hourly_data.iloc[i:i+3]
-        avg_prob = window['probability'].mean()
-        if avg_prob > best_score:
-            best_score = avg_prob
-            best_window = f"{int(window.iloc[0]['hour'])}:00 to {int(window.iloc[2]['hour']) + 1}:00"
-    if best_score >= 0.5:
-        msg = f"Best 3-hour window to spray: {best_window} (Confidence: {best_score:.2f})"
-    else:
-        msg = f"No ideal 3-hour window, but highest confidence: {best_window} (Confidence: {best_score:.2f})"
-    return {"result": msg, "window": best_window, "confidence": best_score}
+    hourly_data['probability'] = await run_in_threadpool(spray_probability, hourly_data)
+    await run_in_threadpool(record_prediction, lat, lon, "spray", values=hourly_data['probability'],
+                            valid_times=hourly_data['time'])
+    try:
+        windows = await run_in_threadpool(spray_windows, hourly_data, width=hours, top=top, per_day=per_day,
+                                          daylight=daylight, rain_free_hours=rain_free_hours)
+    except ValueError as e:
+        return JSONResponse({'result': None, 'window': None, 'error': str(e)}, status_code=400)
+    return spray_response(windows, hours)
+
+@app.post("/spray_schedule")
+async def spray_schedule(request: Request):
+    """Conflict-free spray jobs across fields and sprayers: see spray_schedule.schedule_request for the body."""
+    try:
+        body = await request.json()
+        return await run_in_threadpool(schedule_request, body, load_saved_fields)
+    except ValueError as e:
+        return JSONResponse({'error': str(e)}, status_code=400)
 
 @app.get("/weather_alerts")
-def weather_alerts(lat: float, lon: float):
-    forecast_df = get_7_day_forecast(lat, lon)
+async def weather_alerts(lat: float, lon: float):
+    forecast_df = await get_7_day_forecast_async(lat, lon)
     if forecast_df.empty:
         return {"alerts": ["No forecast data available for alerts."]}
-    alerts = generate_weather_alerts(forecast_df)
+    alerts = await run_in_threadpool(generate_weather_alerts, forecast_df)
     return {"alerts": alerts}
+
+@app.post("/hourly_forecast/batch")
+async def hourly_forecast_batch(fields: Dict[str, Dict[str, float]]):
+    """Hourly forecasts for many fields ({name: {"lat", "lon"}}) in a few multi-location calls."""
+    frames = await run_in_threadpool(get_hourly_forecasts, fields)
+    return await run_in_threadpool(
+        lambda: {name: df.to_dict(orient="list") if not df.empty else None for name, df in frames.items()})
@@ -0,0 +1,369 @@
+"""Local stand-in for the Open-Meteo and MET Norway forecast APIs.
+
+Record real responses once, then replay them with controllable latency,
+error rate and payload size so the apps can be benchmarked offline:
+
+    python weather_standin.py record --lat 12.97 --lon 77.59
+    python weather_standin.py record --fields actual/data/fields.json
+    python weather_standin.py serve --port 8090 --latency-ms 150 --jitter-ms 50 --error-rate 0.02
+    python weather_standin.py concurrency --requests 20 --latency-ms 500
+
+Point the apps at it with:
+
+    OPEN_METEO_URL=http://127.0.0.1:8090/v1/forecast
+    MET_URL=http://127.0.0.1:8090/weatherapi/locationforecast/2.0/compact
+"""
+import argparse
+import asyncio
+import glob
+import importlib
+import json
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import requests
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from utils import FORECAST_PARAMS, HTTP_TIMEOUT, grid_key
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "weather")
+ACTUAL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "actual")
+REAL_OPEN_METEO_URL = "https://api.open-meteo.com/v1/forecast"
+REAL_MET_URL = "https://api.met.no/weatherapi/locationforecast/2.0/compact"
+MET_USER_AGENT = "smart-agri-dashboard/1.0 contact@example.com"
+
+# Replay knobs; set from the command line before uvicorn starts
+config = {
+    "latency_ms": 0.0,
+    "jitter_ms": 0.0,
+    "error_rate": 0.0,
+    "payload_scale": 1.0,
+    "fixture_dir": FIXTURE_DIR,
+}
+
+
+# ---------------------- RECORD ----------------------
+def _fixture_path(directory, source, lat, lon):
+    return os.path.join(directory, f"{source}_{lat}_{lon}.json")
+
+
+def record(locations, directory=FIXTURE_DIR):
+    """Capture real Open-Meteo (utils.FORECAST_PARAMS) and MET responses as fixtures."""
+    os.makedirs(directory, exist_ok=True)
+    session = requests.Session()
+    for lat, lon in locations:
+        cell = grid_key(lat, lon)
+        captures = {
+            "open_meteo": (REAL_OPEN_METEO_URL,
+                           {"latitude": cell[0], "longitude": cell[1], **FORECAST_PARAMS}, {}),
+            "met": (REAL_MET_URL, {"lat": round(lat, 4), "lon": round(lon, 4)},
+                    {"User-Agent": MET_USER_AGENT}),
+        }
+        for source, (url, params, headers) in captures.items():
+            res = session.get(url, params=params, headers=headers, timeout=HTTP_TIMEOUT)
+            res.raise_for_status()
+            fixture = {
+                "lat": lat,
+                "lon": lon,
+                "recorded_at": datetime.now(timezone.utc).isoformat(),
+                "headers": {k: v for k, v in res.headers.items() if k in ("Expires", "Last-Modified")},
+                "body": res.json(),
+            }
+            path = _fixture_path(directory, source, lat, lon)
+            with open(path, "w") as f:
+                json.dump(fixture, f)
+            print(f"Recorded {source} for ({lat}, {lon}) -> {path}")
+
+
+# ---------------------- REPLAY ----------------------
+_fixtures = {}
+
+
+def load_fixtures(source):
+    if source not in _fixtures:
+        found = []
+        for path in glob.glob(os.path.join(config["fixture_dir"], f"{source}_*.json")):
+            with open(path, "r") as f:
+                found.append(json.load(f))
+        _fixtures[source] = found
+    return _fixtures[source]
+
+
+def nearest_fixture(source, lat, lon):
+    fixtures = load_fixtures(source)
+    if not fixtures:
+        return None
+    return min(fixtures, key=lambda fx: (fx["lat"] - lat) ** 2 + (fx["lon"] - lon) ** 2)
+
+
+def _scale_list(values, scale):
+    if scale == 1.0 or not values:
+        return values
+    n = max(1, int(round(len(values) * scale)))
+    return [values[i % len(values)] for i in range(n)]
+
+
+def scale_payload(source, body, scale):
+    """Grow or shrink the time axis of a payload to test larger/smaller responses."""
+    if scale == 1.0:
+        return body
+    body = json.loads(json.dumps(body))
+    if source == "met":
+        body["properties"]["timeseries"] = _scale_list(body["properties"]["timeseries"], scale)
+    else:
+        for block in ("hourly", "daily"):
+            if block in body:
+                body[block] = {k: _scale_list(v, scale) for k, v in body[block].items()}
+    return body
+
+
+def synthetic_open_meteo(lat, lon):
+    """Plausible Open-Meteo payload for when nothing was recorded for this source."""
+    start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    hours = [start + timedelta(hours=h) for h in range(168)]
+    temp = [round(22 + 6 * math.sin((t.hour - 9) / 24 * 2 * math.pi), 1) for t in hours]
+    return {
+        "latitude": lat,
+        "longitude": lon,
+        "current_weather": {"temperature": temp[0], "windspeed": 3.2},
+        "hourly": {
+            "time": [t.strftime("%Y-%m-%dT%H:%M") for t in hours],
+            "temperature_2m": temp,
+            "relative_humidity_2m": [round(95 - 2 * (t - 16), 1) for t in temp],
+            "precipitation": [0.4 if t.hour in (15, 16) else 0.0 for t in hours],
+            "windspeed_10m": [round(2 + (t.hour % 6) * 0.5, 1) for t in hours],
+        },
+        "daily": {
+            "time": [(start + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(7)],
+            "temperature_2m_max": [max(temp[d * 24:(d + 1) * 24]) for d in range(7)],
+            "temperature_2m_min": [min(temp[d * 24:(d + 1) * 24]) for d in range(7)],
+            "precipitation_sum": [0.8] * 7,
+            "windspeed_10m_max": [4.5] * 7,
+            "relative_humidity_2m_max": [92] * 7,
+        },
+    }
+
+
+def synthetic_met(lat, lon):
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    timeseries = []
+    for h in range(216):
+        t = start + timedelta(hours=h)
+        temp = round(22 + 6 * math.sin((t.hour - 9) / 24 * 2 * math.pi), 1)
+        timeseries.append({
+            "time": t.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "data": {
+                "instant": {"details": {
+                    "air_temperature": temp,
+                    "relative_humidity": round(95 - 2 * (temp - 16), 1),
+                    "cloud_area_fraction": 40.0,
+                    "wind_speed": 3.0,
+                }},
+                "next_1_hours": {"details": {"precipitation_amount": 0.2 if t.hour == 15 else 0.0}},
+                "next_6_hours": {"details": {"precipitation_amount": 0.6}},
+            },
+        })
+    return {"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "properties": {"timeseries": timeseries}}
+
+
+app = FastAPI(title="Weather stand-in")
+
+
+async def _simulate_upstream():
+    delay = config["latency_ms"] + random.uniform(-1, 1) * config["jitter_ms"]
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    if random.random() < config["error_rate"]:
+        return JSONResponse({"error": True, "reason": "stand-in injected failure"}, status_code=503)
+    return None
+
+
+def _replay(source, lat, lon):
+    fixture = nearest_fixture(source, lat, lon)
+    if fixture is None:
+        body = synthetic_open_meteo(lat, lon) if source == "open_meteo" else synthetic_met(lat, lon)
+        headers = {}
+    else:
+        body, headers = fixture["body"], fixture.get("headers", {})
+    return scale_payload(source, body, config["payload_scale"]), headers
+
+
+async def _json_response(body, headers=None):
+    content = await asyncio.to_thread(json.dumps, body)
+    return Response(content, media_type="application/json", headers=headers)
+
+
+@app.get("/v1/forecast")
+async def open_meteo_forecast(request: Request):
+    error = await _simulate_upstream()
+    if error is not None:
+        return error
+    lats = [float(v) for v in request.query_params["latitude"].split(",")]
+    lons = [float(v) for v in request.query_params["longitude"].split(",")]
+    # Building (or scaling) the payloads is CPU work; keep it off the loop the delays run on
+    bodies = await asyncio.to_thread(lambda: [_replay("open_meteo", lat, lon)[0] for lat, lon in zip(lats, lons)])
+    return await _json_response(bodies if len(bodies) > 1 else bodies[0])
+
+
+@app.get("/weatherapi/locationforecast/2.0/compact")
+async def met_forecast(request: Request, lat: float, lon: float):
+    error = await _simulate_upstream()
+    if error is not None:
+        return error
+    body, headers = await asyncio.to_thread(_replay, "met", lat, lon)
+    since = request.headers.get("If-Modified-Since")
+    if since and since == headers.get("Last-Modified"):
+        return Response(status_code=304, headers=headers)
+    return await _json_response(body, headers=headers)
+
+
+# ---------------------- CONCURRENCY CHECK ----------------------
+CONCURRENCY_APPS = ("weather_fastapi", "main_fastapi", "actual")
+
+
+def _concurrency_target(app_name, cells):
+    """The app and one request path per (lat, lon) cell, each needing its own upstream call."""
+    if app_name == "actual":
+        # The MET app resolves its static files and models relative to actual/
+        os.chdir(ACTUAL_DIR)
+        sys.path.insert(0, ACTUAL_DIR)
+        module = importlib.import_module("main")
+        fields = {f"field{i}": {"lat": lat, "lon": lon} for i, (lat, lon) in enumerate(cells)}
+        module.read_fields = lambda: fields
+        return module.app, [f"/api/forecast/{name}" for name in fields]
+    module = importlib.import_module(app_name)
+    if app_name == "weather_fastapi":
+        return module.app, [f"/spray_window?lat={lat}&lon={lon}" for lat, lon in cells]
+    return module.app, [f"/predict_yield?lat={lat}&lon={lon}&ozone=40&soil=30" for lat, lon in cells]
+
+
+def _route_upstream_here():
+    """Point the apps' async weather clients at this stand-in, in-process, with empty caches."""
+    import httpx
+    from utils import weather_client
+
+    transport = httpx.ASGITransport(app=app)
+    weather_client.cache.clear()
+    weather_client._async_session = httpx.AsyncClient(transport=transport)
+    if "met_client" in sys.modules:
+        met_client = sys.modules["met_client"]
+        met_client.met_cache.clear()
+        met_client._async_client = httpx.AsyncClient(transport=transport)
+
+
+async def _timed_burst(client, paths, tick=0.01):
+    """(wall time, worst event-loop lag) for all paths requested at once."""
+    lag = 0.0
+
+    async def ticker():
+        nonlocal lag
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(tick)
+            lag = max(lag, time.perf_counter() - start - tick)
+
+    watch = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    responses = await asyncio.gather(*(client.get(path) for path in paths))
+    wall = time.perf_counter() - start
+    watch.cancel()
+    for response in responses:
+        response.raise_for_status()
+    return wall, lag
+
+
+async def check_concurrency(app_name, n=20, latency_ms=500.0):
+    """n simultaneous requests with a slow upstream should take about one upstream latency, not n.
+
+    The stand-in's delay is an ``asyncio.sleep`` in the same event loop as
+    the app, so any blocking call on the request path serialises the
+    requests. The same burst is first timed with no upstream delay, which
+    is the CPU the requests need anyway (models, JSON); the slow burst
+    may only add about one latency on top of that (serial would add n), and
+    the loop must never stall for half a latency. Worker threads share the
+    GIL, so short stalls under load are expected.
+    """
+    import httpx
+
+    # A degree apart: distinct Open-Meteo grid cells and MET keys, so nothing is coalesced or cached
+    cells = [(10.0 + i, 70.0 + i) for i in range(2 * n + 1)]
+    target, paths = _concurrency_target(app_name, cells)
+    config.update(latency_ms=0.0, jitter_ms=0.0, error_rate=0.0)
+    async with target.router.lifespan_context(target):
+        _route_upstream_here()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=target), base_url="http://app") as client:
+            # Warm-up: model loads and first-use setup are not what is measured
+            (await client.get(paths[0])).raise_for_status()
+            base, _ = await _timed_burst(client, paths[1:n + 1])
+            config["latency_ms"] = latency_ms
+            wall, lag = await _timed_burst(client, paths[n + 1:])
+    latency = latency_ms / 1000
+    print(f"{app_name}: {n} concurrent requests, {latency_ms:.0f} ms upstream -> {wall * 1e3:.0f} ms wall, "
+          f"{base * 1e3:.0f} ms of it without the delay: +{(wall - base) / latency:.2f} latencies "
+          f"(serial would be +{n}); worst loop stall {lag * 1e3:.0f} ms")
+    assert wall - base < 2 * latency, f"{app_name}: the slow upstream added {(wall - base) / latency:.1f} latencies"
+    assert lag < latency / 2, f"{app_name}: the event loop stalled for {lag * 1e3:.0f} ms"
+    return wall - base
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    rec = sub.add_parser("record", help="capture real responses into fixture files")
+    rec.add_argument("--lat", type=float)
+    rec.add_argument("--lon", type=float)
+    rec.add_argument("--fields", help="fields.json to record every saved field")
+    rec.add_argument("--out", default=FIXTURE_DIR)
+
+    srv = sub.add_parser("serve", help="replay fixtures over HTTP")
+    srv.add_argument("--host", default="127.0.0.1")
+    srv.add_argument("--port", type=int, default=8090)
+    srv.add_argument("--latency-ms", type=float, default=0.0)
+    srv.add_argument("--jitter-ms", type=float, default=0.0)
+    srv.add_argument("--error-rate", type=float, default=0.0)
+    srv.add_argument("--payload-scale", type=float, default=1.0,
+                     help="multiply the number of time steps in each response")
+    srv.add_argument("--fixtures", default=FIXTURE_DIR)
+
+    conc = sub.add_parser("concurrency", help="check that N slow upstream calls overlap in each app")
+    conc.add_argument("--app", choices=CONCURRENCY_APPS, action="append",
+                      help="app to check (repeatable; default all)")
+    conc.add_argument("--requests", type=int, default=20)
+    conc.add_argument("--latency-ms", type=float, default=500.0)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        locations = []
+        if args.fields:
+            with open(args.fields, "r") as f:
+                locations += [(v["lat"], v["lon"]) for v in json.load(f).values()]
+        if args.lat is not None and args.lon is not None:
+            locations.append((args.lat, args.lon))
+        if not locations:
+            parser.error("record needs --lat/--lon or --fields")
+        record(locations, args.out)
+    elif args.command == "concurrency":
+        # No background MET prefetch competing with the measured requests, and no history files
+        # left behind (HISTORY_ENABLED=1 includes the history writes)
+        os.environ.setdefault("PREFETCH_ENABLED", "0")
+        os.environ.setdefault("HISTORY_ENABLED", "0")
+        # actual/ changes directory, so it goes last
+        for name in sorted(args.app or CONCURRENCY_APPS, key=CONCURRENCY_APPS.index):
+            asyncio.run(check_concurrency(name, args.requests, args.latency_ms))
+    else:
+        import uvicorn
+
+        config.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+                      payload_scale=args.payload_scale, fixture_dir=args.fixtures)
+        uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()